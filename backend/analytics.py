@@ -0,0 +1,310 @@
+"""
+Vectorized spending analytics.
+
+A user's history is loaded once as columnar NumPy arrays, then every metric is
+computed with array operations (bincount, cumsum, lexsort) so the cost stays
+flat in Python regardless of how many receipts the user has.
+"""
+from dataclasses import dataclass
+from datetime import date
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import literal, union_all
+from sqlalchemy.orm import Session
+
+import archive
+import fx
+import models
+import schemas
+from money import MONEY_SCALE, minor_amount
+
+# Outlier thresholds: classic z-score, and the modified z-score from Iglewicz & Hoaglin
+ZSCORE_THRESHOLD = 3.0
+MAD_THRESHOLD = 3.5
+
+KIND_SPENT = 0
+KIND_INCOME = 1
+
+
+@dataclass
+class History:
+    """Columnar view of a user's receipts and income (one entry per row)"""
+    ids: np.ndarray          # int64 receipt / income id
+    kinds: np.ndarray        # int8 KIND_SPENT or KIND_INCOME
+    months: np.ndarray       # int32 months since epoch (year * 12 + month - 1)
+    days: np.ndarray         # datetime64[D]
+    amounts: np.ndarray      # float64
+    categories: np.ndarray   # int32 code into category_names
+    merchants: np.ndarray    # int32 code into merchant_names (source for income)
+    category_names: List[str]
+    merchant_names: List[str]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+def _factorize(values, names: List[str], default: str = "Uncategorized") -> np.ndarray:
+    lookup: Dict[str, int] = {}
+    codes = np.fromiter(
+        (lookup.setdefault(v or default, len(lookup)) for v in values),
+        dtype=np.int32,
+        count=len(values)
+    )
+    names.extend(lookup)
+    return codes
+
+
+def load_history(db: Session, user_id: str, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                 currency: Optional[str] = None) -> History:
+    """
+    Load receipts and income for a user as columnar arrays in a single query, plus
+    archived receipts when the range reaches archived months (see archive.py).
+    Amounts are converted into `currency` (default: the user's settings currency).
+    """
+    receipts = db.query(
+        literal(KIND_SPENT).label('kind'),
+        models.Receipt.id,
+        models.Receipt.date,
+        minor_amount(models.Receipt.total_amount_minor, models.Receipt.total_amount).label('amount'),
+        models.Receipt.category,
+        models.Receipt.merchant_name.label('merchant'),
+        models.Receipt.currency
+    ).filter(models.Receipt.user_id == user_id, models.Receipt.date != None)
+    incomes = db.query(
+        literal(KIND_INCOME).label('kind'),
+        models.Income.id,
+        models.Income.date,
+        minor_amount(models.Income.amount_minor, models.Income.amount),
+        models.Income.category,
+        models.Income.source,
+        models.Income.currency
+    ).filter(models.Income.user_id == user_id, models.Income.date != None)
+
+    if start_date:
+        receipts = receipts.filter(models.Receipt.date >= start_date)
+        incomes = incomes.filter(models.Income.date >= start_date)
+    if end_date:
+        receipts = receipts.filter(models.Receipt.date <= end_date)
+        incomes = incomes.filter(models.Income.date <= end_date)
+
+    rows = db.execute(union_all(receipts.statement, incomes.statement)).all()
+    archived = archive.read_receipts(db, user_id, start_date, end_date)
+    if archived:
+        live_ids = {row.id for row in rows if row.kind == KIND_SPENT}
+        rows += [
+            (KIND_SPENT, r["id"], r["date"], r["total_amount_minor"], r["category"], r["merchant_name"], r["currency"])
+            for r in archived if r["id"] not in live_ids and r["date"] is not None
+        ]
+    kinds, ids, dates, amounts, categories, merchants, currencies = zip(*rows) if rows else ((),) * 7
+    history = build_history(kinds, ids, dates, amounts, categories, merchants)
+    history.amounts /= MONEY_SCALE
+
+    currency_names: List[str] = []
+    currency_codes = _factorize(currencies, currency_names, default="")
+    history.amounts = fx.rate_cache.convert(
+        db, history.amounts, currency_codes, currency_names, history.days,
+        currency or fx.user_currency(db, user_id)
+    )
+    # No rate into the user's currency: left out of the sums, as the SQL aggregates do
+    history.amounts = np.nan_to_num(history.amounts, nan=0.0)
+    return history
+
+
+def build_history(kinds, ids, dates, amounts, categories, merchants) -> History:
+    """Build a History from parallel column sequences"""
+    days = np.array(dates, dtype='datetime64[D]')
+    category_names: List[str] = []
+    merchant_names: List[str] = []
+    return History(
+        ids=np.asarray(ids, dtype=np.int64),
+        kinds=np.asarray(kinds, dtype=np.int8),
+        months=days.astype('datetime64[M]').astype(np.int32),
+        days=days,
+        amounts=np.fromiter((a or 0.0 for a in amounts), dtype=np.float64, count=len(amounts)),
+        categories=_factorize(categories, category_names),
+        merchants=_factorize(merchants, merchant_names),
+        category_names=category_names,
+        merchant_names=merchant_names
+    )
+
+
+def monthly_totals(history: History, first_month: int, n_months: int) -> np.ndarray:
+    """
+    Totals per (kind, category, month) as a dense [2, n_categories, n_months] array,
+    computed in a single bincount pass over all rows.
+    """
+    n_categories = len(history.category_names)
+    flat = (history.kinds.astype(np.int64) * n_categories + history.categories) * n_months + (history.months - first_month)
+    totals = np.bincount(flat, weights=history.amounts, minlength=2 * n_categories * n_months)
+    return totals.reshape(2, n_categories, n_months)
+
+
+def period_deltas(matrix: np.ndarray, lag: int):
+    """Absolute and relative change against the value `lag` months earlier (NaN where undefined)"""
+    delta = np.full(matrix.shape, np.nan)
+    pct = np.full(matrix.shape, np.nan)
+    if matrix.shape[1] > lag:
+        previous = matrix[:, :-lag]
+        delta[:, lag:] = matrix[:, lag:] - previous
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pct[:, lag:] = np.where(previous != 0, delta[:, lag:] / previous * 100, np.nan)
+    return delta, pct
+
+
+def rolling_mean(matrix: np.ndarray, window: int) -> np.ndarray:
+    """Trailing rolling mean along months; partial windows average what is available"""
+    cumsum = np.cumsum(matrix, axis=1)
+    shifted = np.zeros_like(cumsum)
+    shifted[:, window:] = cumsum[:, :-window]
+    counts = np.minimum(np.arange(1, matrix.shape[1] + 1), window)
+    return (cumsum - shifted) / counts
+
+
+def _group_sort(groups: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Order rows by (group, value) with one float argsort on a composite key,
+    which is several times faster than np.lexsort on two keys.
+    """
+    low = values.min()
+    span = values.max() - low + 1.0
+    return np.argsort(groups * span + (values - low))
+
+
+def _group_median(sorted_values: np.ndarray, starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    lower = sorted_values[starts + (sizes - 1) // 2]
+    upper = sorted_values[starts + sizes // 2]
+    return (lower + upper) / 2
+
+
+def outlier_scores(groups: np.ndarray, values: np.ndarray, method: str = "zscore") -> np.ndarray:
+    """
+    Per-row outlier score within its group.
+    "zscore" is (x - mean) / std and is O(n) via bincount.
+    "mad" is the modified z-score 0.6745 * (x - median) / MAD; it is more robust to
+    skewed amounts but needs two sorts, so it costs roughly 2-3x more on large histories.
+    Rows in groups with no spread score 0.
+    """
+    if len(values) == 0:
+        return np.zeros(0)
+    if method == "zscore":
+        counts = np.bincount(groups)
+        sums = np.bincount(groups, weights=values)
+        squares = np.bincount(groups, weights=values * values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = sums / counts
+            stds = np.sqrt(np.maximum(squares / counts - means * means, 0))
+            scores = (values - means[groups]) / stds[groups]
+        return np.nan_to_num(scores, nan=0.0, posinf=0.0, neginf=0.0)
+
+    order = _group_sort(groups, values)
+    sorted_groups = groups[order]
+    sorted_values = values[order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    sizes = np.diff(np.r_[starts, len(sorted_values)])
+    medians = _group_median(sorted_values, starts, sizes)
+    group_index = np.repeat(np.arange(len(starts)), sizes)
+
+    deviations = np.abs(sorted_values - medians[group_index])
+    # Only the sorted deviations are needed here, so sort keys directly instead of argsort + gather
+    span = deviations.max() + 1.0
+    sorted_deviations = np.sort(group_index * span + deviations) - group_index * span
+    mads = _group_median(sorted_deviations, starts, sizes)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sorted_scores = 0.6745 * (sorted_values - medians[group_index]) / mads[group_index]
+    scores = np.empty_like(sorted_scores)
+    scores[order] = sorted_scores
+    return np.nan_to_num(scores, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def _series(values: np.ndarray) -> List[Optional[float]]:
+    return [None if v != v else v for v in np.round(values, 2).tolist()]
+
+
+def _trends(history: History, matrix: np.ndarray, present: np.ndarray, window: int) -> List[schemas.CategoryTrend]:
+    mom_delta, mom_pct = period_deltas(matrix, 1)
+    yoy_delta, yoy_pct = period_deltas(matrix, 12)
+    rolling = rolling_mean(matrix, window)
+
+    order = np.argsort(-matrix.sum(axis=1), kind='stable')
+    return [
+        schemas.CategoryTrend(
+            category=history.category_names[c],
+            totals=_series(matrix[c]),
+            rolling_avg=_series(rolling[c]),
+            mom_delta=_series(mom_delta[c]),
+            mom_pct=_series(mom_pct[c]),
+            yoy_delta=_series(yoy_delta[c]),
+            yoy_pct=_series(yoy_pct[c])
+        )
+        for c in order if present[c]
+    ]
+
+
+def compute(
+    history: History,
+    window: int = 3,
+    method: str = "zscore",
+    group_by: str = "merchant",
+    threshold: Optional[float] = None,
+    max_outliers: int = 50
+) -> schemas.AnalyticsData:
+    """Trends per category plus outlier receipts for an already loaded history"""
+    if len(history) == 0:
+        return schemas.AnalyticsData(months=[], spending=[], income=[], outliers=[])
+
+    first_month = int(history.months.min())
+    n_months = int(history.months.max()) - first_month + 1
+    months = np.arange(first_month, first_month + n_months).astype('datetime64[M]').astype('datetime64[D]').tolist()
+
+    totals = monthly_totals(history, first_month, n_months)
+    present = np.bincount(history.kinds.astype(np.int64) * len(history.category_names) + history.categories,
+                          minlength=2 * len(history.category_names)).reshape(2, -1) > 0
+
+    spent = history.kinds == KIND_SPENT
+    groups = (history.merchants if group_by == "merchant" else history.categories)[spent]
+    amounts = history.amounts[spent]
+    scores = outlier_scores(groups, amounts, method)
+    limit = threshold if threshold is not None else (MAD_THRESHOLD if method == "mad" else ZSCORE_THRESHOLD)
+
+    flagged = np.flatnonzero(np.abs(scores) > limit)
+    flagged = flagged[np.argsort(-np.abs(scores[flagged]), kind='stable')][:max_outliers]
+    spent_idx = np.flatnonzero(spent)[flagged]
+
+    outliers = [
+        schemas.ReceiptOutlier(
+            receipt_id=int(history.ids[i]),
+            merchant_name=history.merchant_names[history.merchants[i]],
+            category=history.category_names[history.categories[i]],
+            date=history.days[i].item(),
+            amount=round(float(history.amounts[i]), 2),
+            score=round(float(scores[j]), 2)
+        )
+        for i, j in zip(spent_idx, flagged)
+    ]
+
+    return schemas.AnalyticsData(
+        months=months,
+        spending=_trends(history, totals[KIND_SPENT], present[KIND_SPENT], window),
+        income=_trends(history, totals[KIND_INCOME], present[KIND_INCOME], window),
+        outliers=outliers
+    )
+
+
+def get_analytics(
+    db: Session,
+    user_id: str,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    window: int = 3,
+    method: str = "zscore",
+    group_by: str = "merchant",
+    threshold: Optional[float] = None
+) -> schemas.AnalyticsData:
+    """Load a user's history and compute trends and outliers"""
+    currency = fx.user_currency(db, user_id)
+    history = load_history(db, user_id, start_date, end_date, currency=currency)
+    result = compute(history, window=window, method=method, group_by=group_by, threshold=threshold)
+    result.currency = currency
+    return result
@@ -0,0 +1,45 @@
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session
+from typing import Optional
+import datetime
+import schemas
+import analytics
+import forecasting
+from database import get_db
+from auth_utils import get_current_user
+from responses import fast_json_response
+
+router = APIRouter(prefix="/analytics", tags=["analytics"])
+
+@router.get("/", response_model=schemas.AnalyticsData)
+def get_analytics(
+    start_date: Optional[datetime.date] = Query(None),
+    end_date: Optional[datetime.date] = Query(None),
+    window: int = Query(3, ge=1, le=24),
+    method: str = Query("zscore", pattern="^(zscore|mad)$"),
+    group_by: str = Query("merchant", pattern="^(merchant|category)$"),
+    threshold: Optional[float] = Query(None, gt=0),
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Monthly trends (MoM, YoY, rolling average) per category and outlier receipts"""
+    return fast_json_response(schemas.AnalyticsData, analytics.get_analytics(
+        db=db,
+        user_id=current_user_id,
+        start_date=start_date,
+        end_date=end_date,
+        window=window,
+        method=method,
+        group_by=group_by,
+        threshold=threshold
+    ))
+
+@router.get("/forecast", response_model=schemas.CashFlowForecast)
+def get_forecast(
+    months: int = Query(6, ge=1, le=24),
+    confidence: float = Query(0.8, gt=0, lt=1),
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Project the balance for the next N months from recurring and irregular cash flow"""
+    return forecasting.get_forecast(db=db, user_id=current_user_id, months=months, confidence=confidence)
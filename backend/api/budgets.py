@@ -0,0 +1,76 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy.orm import Session
+from typing import List, Optional
+import datetime
+import schemas
+import budgets
+from database import get_db, get_read_db
+from auth_utils import get_current_user
+
+router = APIRouter(prefix="/budgets", tags=["budgets"])
+
+@router.get("/", response_model=List[schemas.Budget])
+def read_budgets(
+    month: Optional[datetime.date] = Query(None, description="Any day of the month to report (default: current month)"),
+    db: Session = Depends(get_read_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Budgets of the current user with the month's spending against each"""
+    return budgets.get_budgets(db=db, user_id=current_user_id, month=month)
+
+@router.post("/", response_model=schemas.Budget, status_code=status.HTTP_201_CREATED)
+def create_budget(
+    budget: schemas.BudgetCreate,
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Create a monthly budget, overall or for one category"""
+    created = budgets.create_budget(db=db, budget=budget, user_id=current_user_id)
+    if created is None:
+        raise HTTPException(status_code=409, detail="A budget already exists for this category")
+    return created
+
+@router.get("/alerts", response_model=List[schemas.BudgetAlert])
+def read_alerts(
+    after_id: int = Query(0, ge=0, description="Last alert id already seen"),
+    unread: bool = False,
+    limit: int = Query(50, ge=1, le=200),
+    db: Session = Depends(get_read_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Budget alerts newer than after_id, oldest first (poll with the last id received)"""
+    return budgets.get_alerts(db=db, user_id=current_user_id, after_id=after_id, unread=unread, limit=limit)
+
+@router.post("/alerts/read", status_code=status.HTTP_204_NO_CONTENT)
+def mark_alerts_read(
+    body: schemas.BudgetAlertsRead,
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Mark every alert up to an id as read"""
+    budgets.mark_read(db=db, user_id=current_user_id, up_to_id=body.up_to_id)
+    return None
+
+@router.put("/{budget_id}", response_model=schemas.Budget)
+def update_budget(
+    budget_id: int,
+    budget: schemas.BudgetUpdate,
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Change a budget's amount or thresholds"""
+    updated = budgets.update_budget(db=db, budget_id=budget_id, budget_update=budget, user_id=current_user_id)
+    if updated is None:
+        raise HTTPException(status_code=404, detail="Budget not found")
+    return updated
+
+@router.delete("/{budget_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_budget(
+    budget_id: int,
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Delete a budget and its alerts"""
+    if not budgets.delete_budget(db=db, budget_id=budget_id, user_id=current_user_id):
+        raise HTTPException(status_code=404, detail="Budget not found")
+    return None
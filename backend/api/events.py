@@ -0,0 +1,44 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+import json
+import events
+from auth_utils import get_current_user, get_stream_user, issue_stream_ticket, STREAM_TICKET_SECONDS
+
+router = APIRouter(prefix="/events", tags=["events"])
+
+# Comment lines keep proxies from closing idle streams
+HEARTBEAT_SECONDS = 15
+RETRY_MS = 5000
+
+async def _stream(user_id: str):
+    subscription = events.broker.subscribe(user_id)
+    try:
+        yield f"retry: {RETRY_MS}\nevent: ready\ndata: {{}}\n\n"
+        while True:
+            payload = await subscription.get(HEARTBEAT_SECONDS)
+            if payload is None:
+                yield ": ping\n\n"
+            else:
+                yield f"event: {payload['type']}\ndata: {json.dumps(payload)}\n\n"
+    finally:
+        events.broker.unsubscribe(subscription)
+
+@router.post("/ticket")
+def create_stream_ticket(current_user_id: str = Depends(get_current_user)):
+    """
+    Short-lived ticket for opening the stream: GET /events/stream?ticket=...
+    (EventSource cannot send an Authorization header).
+    """
+    return {"ticket": issue_stream_ticket(current_user_id), "expires_in": STREAM_TICKET_SECONDS}
+
+@router.get("/stream")
+async def stream_events(current_user_id: str = Depends(get_stream_user)):
+    """
+    Server-Sent Events stream of the current user's changes to receipts, items and income.
+    Each event is {"type", "action", "id"}; on "resync" the client should refetch.
+    """
+    return StreamingResponse(
+        _stream(current_user_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
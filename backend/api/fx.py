@@ -0,0 +1,32 @@
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session
+from typing import List, Optional
+import datetime
+import schemas
+import fx
+from database import get_main_db
+from auth_utils import get_current_user, require_admin
+
+router = APIRouter(prefix="/fx", tags=["fx"])
+
+@router.get("/rates", response_model=List[schemas.ExchangeRate])
+def read_rates(
+    base: Optional[str] = None,
+    quote: Optional[str] = None,
+    start_date: Optional[datetime.date] = Query(None),
+    end_date: Optional[datetime.date] = Query(None),
+    db: Session = Depends(get_main_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """List stored exchange rates"""
+    return fx.get_rates(db, base=base, quote=quote, start_date=start_date, end_date=end_date)
+
+@router.post("/rates", dependencies=[Depends(require_admin)])
+def upload_rates(
+    rates: List[schemas.ExchangeRateCreate],
+    db: Session = Depends(get_main_db)
+):
+    """Insert or update exchange rates (admin)"""
+    count = fx.upsert_rates(db, rates)
+    fx.replicate_rates(rates)
+    return {"status": "success", "count": count}
@@ -1,9 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 from typing import List, Optional
-from database import get_db
+from database import get_db, get_read_db
 import schemas
 import services
+from responses import fast_json_response
 from auth_utils import get_current_user
 
 router = APIRouter(prefix="/income", tags=["income"])
@@ -24,7 +25,7 @@ def read_incomes(
     sort_by: str = Query("date"),
     order: str = Query("desc"),
     category: Optional[str] = None,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user_id: str = Depends(get_current_user)
 ):
     """Retrieve income entries with optional filtering, sorting and pagination"""
@@ -37,17 +38,17 @@ def read_incomes(
         category=category, 
         user_id=current_user_id
     )
-    return {
+    return fast_json_response(schemas.PaginatedIncomes, {
         "items": items,
         "total": total,
         "skip": skip,
         "limit": limit
-    }
+    })
 
 @router.get("/{income_id}", response_model=schemas.Income)
 def read_income(
     income_id: int, 
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user_id: str = Depends(get_current_user)
 ):
     """Get a specific income entry by ID"""
@@ -1,9 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from sqlalchemy.orm import Session
 from typing import List
 import schemas
 import services
-from database import get_db
+import suggestions
+from responses import fast_json_response
+from database import get_db, get_read_db
 from auth_utils import get_current_user
 
 router = APIRouter(prefix="/items", tags=["items"])
@@ -14,7 +16,7 @@ def read_pending_items(
     limit: int = 10,
     sort_by: str = "name",
     order: str = "asc",
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user_id: str = Depends(get_current_user)
 ):
     """Retrieve all pending items (To Buy List) for current user with pagination/sorting"""
@@ -26,12 +28,21 @@ def read_pending_items(
         sort_by=sort_by,
         order=order
     )
-    return {
+    return fast_json_response(schemas.PaginatedItems, {
         "items": items,
         "total": total,
         "skip": skip,
         "limit": limit
-    }
+    })
+
+@router.get("/suggestions", response_model=List[schemas.BuySuggestion])
+def read_buy_suggestions(
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_read_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Products the user usually buys every N days, due soonest first (not already pending)"""
+    return suggestions.get_suggestions(db=db, user_id=current_user_id, limit=limit)
 
 @router.post("/pending", response_model=schemas.Item, status_code=status.HTTP_201_CREATED)
 def create_pending_item(
@@ -0,0 +1,41 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session
+from typing import List, Optional
+import schemas
+import models
+import jobs
+from database import get_db
+from auth_utils import get_current_user, require_admin
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+@router.get("/", response_model=List[schemas.Job], dependencies=[Depends(require_admin)])
+def read_jobs(
+    status: Optional[str] = Query(None, pattern="^(queued|running|succeeded|dead)$"),
+    kind: Optional[str] = None,
+    user_id: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_db)
+):
+    """List background jobs, newest first (admin)"""
+    return jobs.get_jobs(db, status=status, kind=kind, user_id=user_id, limit=limit)
+
+@router.post("/{job_id}/retry", dependencies=[Depends(require_admin)])
+def retry_job(job_id: int, db: Session = Depends(get_db)):
+    """Re-queue a dead job (admin)"""
+    if not jobs.retry(db, [job_id]):
+        raise HTTPException(status_code=404, detail="Dead job not found")
+    jobs.notify()
+    return {"status": "success"}
+
+@router.get("/{job_id}", response_model=schemas.Job)
+def read_job(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Retrieve one of the current user's jobs"""
+    job = db.query(models.Job).filter(models.Job.id == job_id, models.Job.user_id == current_user_id).first()
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
@@ -0,0 +1,49 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy.orm import Session
+from typing import List
+import schemas
+import merchants
+from database import get_db, get_read_db
+from auth_utils import get_current_user
+
+router = APIRouter(prefix="/merchants", tags=["merchants"])
+
+@router.get("/", response_model=List[schemas.Merchant])
+def read_merchants(
+    db: Session = Depends(get_read_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Canonical merchants of the current user, most used first"""
+    return merchants.get_merchants(db=db, user_id=current_user_id)
+
+@router.get("/suggest", response_model=schemas.MerchantSuggestion)
+def suggest_merchant(
+    name: str = Query(..., min_length=1),
+    db: Session = Depends(get_read_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Canonical merchant and suggested category for a merchant name being typed"""
+    suggestion = merchants.suggest(db=db, user_id=current_user_id, name=name)
+    if suggestion is None:
+        raise HTTPException(status_code=404, detail="No matching merchant")
+    return suggestion
+
+@router.get("/merge-suggestions", response_model=List[schemas.MerchantMergeSuggestion])
+def read_merge_suggestions(
+    db: Session = Depends(get_read_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Merchants that look like a longer name of another one, to confirm with the merge endpoint"""
+    return merchants.merge_suggestions(db=db, user_id=current_user_id)
+
+@router.post("/{merchant_id}/merge", status_code=status.HTTP_204_NO_CONTENT)
+def merge_merchant(
+    merchant_id: int,
+    merge: schemas.MerchantMerge,
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Fold a merchant into another one (its receipts and aliases move over)"""
+    if not merchants.merge(db=db, user_id=current_user_id, source_id=merchant_id, target_id=merge.into_id):
+        raise HTTPException(status_code=404, detail="Merchant not found")
+    return None
@@ -0,0 +1,51 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session
+from typing import List, Optional
+import datetime
+import schemas
+import catalog
+from responses import fast_json_response
+from database import get_read_db
+from auth_utils import get_current_user
+
+router = APIRouter(prefix="/products", tags=["products"])
+
+@router.get("/", response_model=List[schemas.Product])
+def read_products(
+    q: Optional[str] = Query(None, description="Words the product name must contain"),
+    limit: int = Query(50, ge=1, le=500),
+    db: Session = Depends(get_read_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Catalog products of the current user, most purchased first"""
+    return catalog.search_products(db=db, user_id=current_user_id, q=q, limit=limit)
+
+@router.get("/{product_id}/prices", response_model=schemas.PriceHistory)
+def read_price_history(
+    product_id: int,
+    start_date: Optional[datetime.date] = Query(None),
+    end_date: Optional[datetime.date] = Query(None),
+    db: Session = Depends(get_read_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Unit price of a product at every purchase, oldest first"""
+    history = catalog.price_history(
+        db=db, user_id=current_user_id, product_id=product_id, start_date=start_date, end_date=end_date
+    )
+    if history is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return fast_json_response(schemas.PriceHistory, history)
+
+@router.get("/{product_id}/cheapest", response_model=schemas.CheapestMerchants)
+def read_cheapest_merchants(
+    product_id: int,
+    since: Optional[datetime.date] = Query(None),
+    limit: int = Query(5, ge=1, le=50),
+    db: Session = Depends(get_read_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Merchants with the lowest average unit price for a product"""
+    result = catalog.cheapest_merchants(db=db, user_id=current_user_id, product_id=product_id, since=since, limit=limit)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return result
@@ -2,19 +2,24 @@ from fastapi import APIRouter, Depends, HTTPException, Query, File, UploadFile
 from sqlalchemy.orm import Session
 from typing import List, Optional
 import datetime
+import models
 import schemas
 import services
+import jobs
+import duplicates
+from responses import fast_json_response
 import os
 import uuid
 import shutil
-from database import get_db
+import tracing
+from database import get_db, get_read_db
 from auth_utils import get_current_user
 
 router = APIRouter(prefix="/receipts", tags=["receipts"])
 
 
 # Receipt Endpoints
-@router.post("/", response_model=schemas.Receipt, status_code=201)
+@router.post("/", response_model=schemas.ReceiptCreated, status_code=201)
 def create_receipt(
     receipt: schemas.ReceiptCreate, 
     db: Session = Depends(get_db),
@@ -37,7 +42,10 @@ def read_receipts(
     order: str = Query("desc"),
     category: Optional[str] = None,
     merchant_name: Optional[str] = None,
-    db: Session = Depends(get_db),
+    merchant_id: Optional[int] = None,
+    start_date: Optional[datetime.date] = Query(None),
+    end_date: Optional[datetime.date] = Query(None),
+    db: Session = Depends(get_read_db),
     current_user_id: str = Depends(get_current_user)
 ):
     """Retrieve all receipts for current user with optional filtering, sorting and pagination"""
@@ -49,27 +57,50 @@ def read_receipts(
         order=order,
         category=category,
         merchant_name=merchant_name,
+        merchant_id=merchant_id,
+        start_date=start_date,
+        end_date=end_date,
         user_id=current_user_id
     )
-    return {
+    return fast_json_response(schemas.PaginatedReceipts, {
         "items": items,
         "total": total,
         "skip": skip,
         "limit": limit
-    }
+    })
+
+
+@router.get("/duplicates", response_model=schemas.DuplicateGroups)
+def read_duplicates(
+    db: Session = Depends(get_read_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """
+    Groups of the current user's receipts that likely record the same purchase.
+    Receipts without a fingerprint yet are left out and queued for the find_duplicates job.
+    """
+    pending = duplicates.pending(db, current_user_id)
+    if pending and not db.query(models.Job.id).filter(
+        models.Job.user_id == current_user_id,
+        models.Job.kind == "find_duplicates",
+        models.Job.status.in_(("queued", "running"))
+    ).first():
+        jobs.enqueue(db, "find_duplicates", {"user_id": current_user_id}, user_id=current_user_id)
+        jobs.notify()
+    return {"groups": duplicates.scan(db, current_user_id), "pending": pending}
 
 
 @router.get("/{receipt_id}", response_model=schemas.Receipt)
 def read_receipt(
     receipt_id: int, 
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user_id: str = Depends(get_current_user)
 ):
     """Retrieve a specific receipt by ID (owned by user)"""
     db_receipt = services.get_receipt(db=db, receipt_id=receipt_id, user_id=current_user_id)
     if db_receipt is None:
         raise HTTPException(status_code=404, detail="Receipt not found")
-    return db_receipt
+    return fast_json_response(schemas.Receipt, db_receipt)
 
 
 @router.put("/{receipt_id}", response_model=schemas.Receipt)
@@ -104,6 +135,35 @@ def delete_receipt(
     return None
 
 
+def _require_filter(selection: schemas.ReceiptFilter) -> None:
+    if not selection.model_dump(exclude_none=True):
+        raise HTTPException(status_code=422, detail="At least one filter is required")
+
+
+@router.post("/bulk/delete", response_model=schemas.BulkResult)
+def bulk_delete_receipts(
+    body: schemas.ReceiptBulkDelete,
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Delete every receipt matching the filter, with its items"""
+    _require_filter(body.filter)
+    return services.bulk_delete_receipts(db=db, user_id=current_user_id, selection=body.filter)
+
+
+@router.post("/bulk/update", response_model=schemas.BulkResult)
+def bulk_update_receipts(
+    body: schemas.ReceiptBulkUpdate,
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Set the category and/or merchant of every receipt matching the filter"""
+    _require_filter(body.filter)
+    if body.category is None and body.merchant_name is None:
+        raise HTTPException(status_code=422, detail="Nothing to update")
+    return services.bulk_update_receipts(db=db, user_id=current_user_id, bulk_update=body)
+
+
 # Item Endpoints
 @router.post("/{receipt_id}/items", response_model=schemas.Item, status_code=201)
 def create_item(
@@ -118,13 +178,13 @@ def create_item(
     if db_receipt is None:
         raise HTTPException(status_code=404, detail="Receipt not found")
     
-    return services.create_item(db=db, item=item, receipt_id=receipt_id)
+    return services.create_item(db=db, item=item, user_id=current_user_id, receipt_id=receipt_id)
 
 
 @router.get("/{receipt_id}/items", response_model=List[schemas.Item])
 def read_items(
     receipt_id: int, 
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user_id: str = Depends(get_current_user)
 ):
     """Retrieve all items for a specific receipt"""
@@ -139,7 +199,7 @@ def read_items(
 @router.get("/items/{item_id}", response_model=schemas.Item)
 def read_item(
     item_id: int, 
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user_id: str = Depends(get_current_user)
 ):
     """Retrieve a specific item by ID (must belong to user's receipt)"""
@@ -182,16 +242,36 @@ def delete_item(
 def get_dashboard_stats(
     start_date: Optional[datetime.date] = Query(None),
     end_date: Optional[datetime.date] = Query(None),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user_id: str = Depends(get_current_user)
 ):
     """Get dashboard statistics including top merchants and spending by category"""
-    return services.get_dashboard_stats(
+    return fast_json_response(schemas.DashboardData, services.get_dashboard_stats(
         db=db, 
         start_date=start_date, 
         end_date=end_date,
         user_id=current_user_id
-    )
+    ))
+
+
+@router.get("/dashboard/timeseries", response_model=schemas.TimeSeriesData)
+def get_dashboard_timeseries(
+    interval: schemas.TimeSeriesInterval = Query(schemas.TimeSeriesInterval.MONTH),
+    start_date: Optional[datetime.date] = Query(None),
+    end_date: Optional[datetime.date] = Query(None),
+    by_category: bool = Query(False),
+    db: Session = Depends(get_read_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Get spending and income bucketed by day, week or month for charts"""
+    return fast_json_response(schemas.TimeSeriesData, services.get_dashboard_timeseries(
+        db=db,
+        user_id=current_user_id,
+        interval=interval,
+        start_date=start_date,
+        end_date=end_date,
+        by_category=by_category
+    ))
 
 
 @router.post("/upload")
@@ -213,8 +293,9 @@ async def upload_receipt_image(file: UploadFile = File(...)):
     
     # Save file
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        with tracing.span("storage.write", {"storage.path": file_path, "storage.content_type": file.content_type or ""}):
+            with open(file_path, "wb") as buffer:
+                shutil.copyfileobj(file.file, buffer)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Could not save file: {str(e)}")
         
@@ -222,9 +303,13 @@ async def upload_receipt_image(file: UploadFile = File(...)):
     return {"url": f"/uploads/{unique_filename}"}
 
 
-@router.delete("/upload/{filename}")
-async def delete_upload(filename: str):
-    """Delete a previously uploaded file"""
+@router.delete("/upload/{filename}", status_code=202)
+def delete_upload(
+    filename: str,
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Schedule deletion of a file uploaded for one of the current user's receipts"""
     UPLOAD_DIR = "uploads"
     file_path = os.path.join(UPLOAD_DIR, filename)
     
@@ -232,11 +317,14 @@ async def delete_upload(filename: str):
     if not os.path.abspath(file_path).startswith(os.path.abspath(UPLOAD_DIR)):
         raise HTTPException(status_code=400, detail="Invalid filename")
         
-    if os.path.exists(file_path):
-        try:
-            os.remove(file_path)
-            return {"message": "File deleted successfully"}
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Could not delete file: {str(e)}")
-    else:
+    # Files of other users' receipts are reported as missing rather than forbidden
+    owned = db.query(models.Receipt.id).filter(
+        models.Receipt.user_id == current_user_id,
+        models.Receipt.image_url.endswith(f"/uploads/{filename}", autoescape=True)
+    ).first()
+    if not owned or not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found")
+
+    job = jobs.enqueue(db, "delete_uploads", {"filenames": [filename]}, user_id=current_user_id)
+    jobs.notify()
+    return {"message": "File deletion scheduled", "job_id": job.id}
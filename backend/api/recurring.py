@@ -0,0 +1,56 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+from typing import List
+import schemas
+import recurring
+from database import get_db, get_read_db
+from auth_utils import get_current_user
+
+router = APIRouter(prefix="/recurring", tags=["recurring"])
+
+@router.get("/", response_model=List[schemas.RecurringTemplate])
+def read_templates(
+    db: Session = Depends(get_read_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Recurring receipt and income templates of the current user"""
+    return recurring.get_templates(db=db, user_id=current_user_id)
+
+@router.post("/", response_model=schemas.RecurringTemplate, status_code=status.HTTP_201_CREATED)
+def create_template(
+    template: schemas.RecurringTemplateCreate,
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Create a template; occurrences from start_date up to today are written right away"""
+    try:
+        return recurring.create_template(db=db, template=template, user_id=current_user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+@router.put("/{template_id}", response_model=schemas.RecurringTemplate)
+def update_template(
+    template_id: int,
+    template: schemas.RecurringTemplateUpdate,
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Change a template from its next occurrence on"""
+    try:
+        updated = recurring.update_template(db=db, template_id=template_id, template_update=template, user_id=current_user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if updated is None:
+        raise HTTPException(status_code=404, detail="Template not found")
+    return updated
+
+@router.delete("/{template_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_template(
+    template_id: int,
+    db: Session = Depends(get_db),
+    current_user_id: str = Depends(get_current_user)
+):
+    """Stop a template; rows it already created are kept"""
+    if not recurring.delete_template(db=db, template_id=template_id, user_id=current_user_id):
+        raise HTTPException(status_code=404, detail="Template not found")
+    return None
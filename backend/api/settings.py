@@ -12,7 +12,7 @@ def read_settings(
     db: Session = Depends(get_db),
     current_user_id: str = Depends(get_current_user)
 ):
-    """Retrieve user-specific settings"""
+    """Retrieve user-specific settings (on the primary: the first read creates the defaults)"""
     return services.get_settings(db, user_id=current_user_id)
 
 @router.patch("/", response_model=schemas.Settings)
@@ -1,24 +1,18 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
-from database import get_db
+from database import MAIN_SHARD, get_main_db, locate, shard_session
 import models, schemas
-import os
-from supabase import create_client, Client
 
 router = APIRouter(
     prefix="/users",
     tags=["users"]
 )
 
-# Initialize Supabase Admin Client
-# Ensure these environment variables are set in your backend environment
-SUPABASE_URL = os.environ.get("NEXT_PUBLIC_SUPABASE_URL") 
-SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-
 from auth_utils import get_current_user
+import jobs
 
 @router.post("/", response_model=schemas.User)
-def create_or_sync_user(user: schemas.UserCreate, db: Session = Depends(get_db), current_user_id: str = Depends(get_current_user)):
+def create_or_sync_user(user: schemas.UserCreate, db: Session = Depends(get_main_db), current_user_id: str = Depends(get_current_user)):
     if user.id != current_user_id:
         raise HTTPException(status_code=403, detail="Not authorized to sync this user")
         
@@ -45,14 +39,14 @@ def create_or_sync_user(user: schemas.UserCreate, db: Session = Depends(get_db),
     return db_user
 
 @router.get("/{user_id}", response_model=schemas.User)
-def get_user(user_id: str, db: Session = Depends(get_db)):
+def get_user(user_id: str, db: Session = Depends(get_main_db)):
     user = db.query(models.User).filter(models.User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
 @router.put("/{user_id}", response_model=schemas.User)
-def update_user(user_id: str, user_update: schemas.UserUpdate, db: Session = Depends(get_db)):
+def update_user(user_id: str, user_update: schemas.UserUpdate, db: Session = Depends(get_main_db)):
     user = db.query(models.User).filter(models.User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -66,29 +60,25 @@ def update_user(user_id: str, user_update: schemas.UserUpdate, db: Session = Dep
     db.refresh(user)
     return user
 
-@router.delete("/{user_id}")
-def delete_user(user_id: str, db: Session = Depends(get_db)):
-    # 1. Delete from Local DB
+@router.delete("/{user_id}", status_code=202)
+def delete_user(user_id: str, db: Session = Depends(get_main_db), current_user_id: str = Depends(get_current_user)):
+    """Schedule deletion of the user, all their data and uploads, and their Supabase Auth account"""
+    if user_id != current_user_id:
+        raise HTTPException(status_code=403, detail="Not authorized to delete this user")
     user = db.query(models.User).filter(models.User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    db.delete(user)
-    db.commit()
-
-    # 2. Delete from Supabase Auth
-    # Lazy initialization to prevent server blocking
-    if SUPABASE_URL and SUPABASE_SERVICE_KEY:
-        try:
-            print(f"Initializing Supabase Client for user deletion...")
-            supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-            supabase.auth.admin.delete_user(user_id)
-            print(f"Deleted user {user_id} from Supabase Auth")
-        except Exception as e:
-            print(f"Error deleting user from Supabase: {e}")
-            # We don't raise 500 here to ensure the client sees the deletion as successful
-            # (since local data is gone).
-    else:
-        print("Supabase credentials not found. Auth deletion skipped.")
 
-    return {"status": "success", "message": "User deleted"}
+    shard, moving = locate(user_id)
+    if moving:
+        raise HTTPException(status_code=503, detail="User data is being moved; try again shortly", headers={"Retry-After": "30"})
+    # Runs in the background job runner on the user's shard (see jobs.delete_user); poll GET /jobs/{job_id}
+    # Same session on the main shard: on SQLite a second one would wait for this one's write lock
+    data = db if shard == MAIN_SHARD else shard_session(shard)
+    try:
+        job_id = jobs.enqueue(data, "delete_user", {"user_id": user_id}, user_id=user_id).id
+    finally:
+        if data is not db:
+            data.close()
+    jobs.notify()
+    return {"status": "accepted", "message": "User deletion scheduled", "job_id": job_id}
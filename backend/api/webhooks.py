@@ -1,7 +1,9 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from database import get_db
-import models, schemas
+from database import get_service_db
+import webhook_queue
+import json
 import logging
 
 router = APIRouter(
@@ -12,73 +14,28 @@ router = APIRouter(
 logger = logging.getLogger(__name__)
 
 @router.post("/auth")
-async def handle_auth_webhook(request: Request, db: Session = Depends(get_db)):
+async def handle_auth_webhook(request: Request, db: Session = Depends(get_service_db)):
     """
-    Handle Supabase auth webhooks (USER_CREATED)
+    Queue Supabase auth webhooks (USER_CREATED); users are created by the webhook_queue worker
     """
+    body = await request.body()
     try:
-        payload = await request.json()
-        logger.info(f"Received webhook payload: {payload}")
-        
-        event_type = payload.get("type")
-        record = payload.get("record")
-
-        if event_type == "INSERT" and record:       
-            user_id = record.get("id")
-            email = record.get("email")
-            raw_user_meta_data = record.get("raw_user_meta_data", {})
-            full_name = raw_user_meta_data.get("full_name") or raw_user_meta_data.get("name")
-            avatar_url = raw_user_meta_data.get("avatar_url")
-
-            if not user_id or not email:
-                logger.warning("Invalid webhook payload: missing id or email")
-                # Return 200 to acknowledge receipt even if invalid to prevent retries if it's malformed
-                return {"status": "ignored", "reason": "missing_data"}
-
-            # Check if user exists
-            existing_user = db.query(models.User).filter(models.User.id == user_id).first()
-            if existing_user:
-                logger.info(f"User {user_id} already exists")
-                return {"status": "exists"}
-
-            # Create user
-            new_user = models.User(
-                id=user_id,
-                email=email,
-                full_name=full_name,
-                avatar_url=avatar_url
-            )
-            db.add(new_user)
-            db.commit()
-            db.refresh(new_user)
-            
-            logger.info(f"Created user {user_id}")
-            return {"status": "created", "user_id": user_id}
-            
-        else:
-             if "id" in payload and "email" in payload:
-                 user_id = payload.get("id")
-                 email = payload.get("email")
-                 raw_user_meta_data = payload.get("raw_user_meta_data", {})
-                 full_name = raw_user_meta_data.get("full_name")
-                 avatar_url = raw_user_meta_data.get("avatar_url")
-                 
-                 existing_user = db.query(models.User).filter(models.User.id == user_id).first()
-                 if existing_user:
-                    return {"status": "exists"}
-                 
-                 new_user = models.User(
-                    id=user_id,
-                    email=email,
-                    full_name=full_name,
-                    avatar_url=avatar_url
-                 )
-                 db.add(new_user)
-                 db.commit()
-                 return {"status": "created"}
-
-        return {"status": "ignored", "reason": "unknown_event"}
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid JSON payload")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid JSON payload")
 
+    event_id = webhook_queue.event_id_for(request.headers, body)
+    try:
+        # Async for the raw body and notify(); the insert must not block the event loop
+        queued = await run_in_threadpool(webhook_queue.enqueue, db, event_id, payload)
     except Exception as e:
-        logger.error(f"Error processing webhook: {str(e)}")
+        logger.error(f"Error queueing webhook: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
+
+    if not queued:
+        logger.info(f"Duplicate webhook event {event_id}")
+        return {"status": "duplicate", "event_id": event_id}
+    webhook_queue.notify()
+    return {"status": "queued", "event_id": event_id}
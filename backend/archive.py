@@ -0,0 +1,319 @@
+"""
+Cold archive of old receipts in Parquet.
+
+Months older than ARCHIVE_AFTER_MONTHS are exported, receipts and their items, to
+zstd-compressed Parquet files under ARCHIVE_DIR (one directory per month, rows
+sorted by user so per-user reads skip most row groups) and then removed from the
+database: on a partitioned Postgres table (see partitions.py) the month's partition
+is detached and dropped, elsewhere the exported rows are deleted in batches.
+`receipt_archives` records which months are archived.
+
+Archived receipts stay readable through `read_receipts`, used by the analytics
+history and `export`; the dashboard and receipt list only cover live rows.
+pyarrow is only needed once something is archived.
+
+A file is always written before its rows leave the database, and rows are never
+deleted unless they were exported, so an interrupted run at worst exports rows
+twice; readers keep one copy per receipt id.
+
+Usage:
+    python archive.py status
+    python archive.py run [--before 2023-01-01] [--dry-run]
+    python archive.py export USER_ID receipts.csv
+"""
+import argparse
+import csv
+import logging
+import os
+import sys
+import time
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+
+import env
+import models
+import partitions
+import tracing
+from money import from_minor, to_minor
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", "36"))
+DELETE_BATCH_SIZE = 1000
+ROW_GROUP_SIZE = 64 * 1024
+
+RECEIPT_COLUMNS = [
+    "id", "user_id", "merchant_name", "date", "total_amount", "total_amount_minor",
+    "currency", "category", "location", "image_url", "created_at",
+]
+ITEM_COLUMNS = ["id", "receipt_id", "user_id", "name", "price", "price_minor", "quantity"]
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("The receipt archive needs pyarrow (pip install pyarrow)")
+    return pyarrow
+
+
+def _schemas(pa):
+    receipts = pa.schema([
+        ("id", pa.int64()), ("user_id", pa.string()), ("merchant_name", pa.string()),
+        ("date", pa.date32()), ("total_amount", pa.float64()), ("total_amount_minor", pa.int64()),
+        ("currency", pa.string()), ("category", pa.string()), ("location", pa.string()),
+        ("image_url", pa.string()), ("created_at", pa.timestamp("us")),
+    ])
+    items = pa.schema([
+        ("id", pa.int64()), ("receipt_id", pa.int64()), ("user_id", pa.string()), ("name", pa.string()),
+        ("price", pa.float64()), ("price_minor", pa.int64()), ("quantity", pa.int64()),
+    ])
+    return receipts, items
+
+
+def cutoff(today: Optional[date] = None, months: int = ARCHIVE_AFTER_MONTHS) -> date:
+    """First day of the oldest month that stays live"""
+    month = partitions.month_start(today or date.today())
+    index = month.year * 12 + month.month - 1 - months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def archived_months(db: Session, start_date: Optional[date] = None, end_date: Optional[date] = None) -> List[date]:
+    query = db.query(models.ReceiptArchive.month)
+    if start_date:
+        query = query.filter(models.ReceiptArchive.month >= partitions.month_start(start_date))
+    if end_date:
+        query = query.filter(models.ReceiptArchive.month <= end_date)
+    return [month for (month,) in query.order_by(models.ReceiptArchive.month)]
+
+
+def _month_dir(kind: str, month: date) -> str:
+    return os.path.join(ARCHIVE_DIR, kind, f"month={month:%Y-%m}")
+
+
+def _files(kind: str, month: date) -> List[str]:
+    directory = _month_dir(kind, month)
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(".parquet")]
+
+
+def _write(pa, rows, schema, kind: str, month: date) -> int:
+    directory = _month_dir(kind, month)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"part-{time.time_ns()}.parquet")
+    table = pa.Table.from_pylist([dict(zip(schema.names, row)) for row in rows], schema=schema)
+    with tracing.span("storage.write", {"storage.path": path, "storage.rows": len(rows)}):
+        pa.parquet.write_table(table, path + ".tmp", compression="zstd", row_group_size=ROW_GROUP_SIZE)
+        os.replace(path + ".tmp", path)
+        written = pa.parquet.read_metadata(path).num_rows
+    if written != len(rows):
+        raise RuntimeError(f"{path}: wrote {written} rows, expected {len(rows)}")
+    return written
+
+
+def _delete_ids(db: Session, model, column, ids: List[int]) -> None:
+    for i in range(0, len(ids), DELETE_BATCH_SIZE):
+        db.query(model).filter(column.in_(ids[i:i + DELETE_BATCH_SIZE])).delete(synchronize_session=False)
+
+
+def archive_month(db: Session, month: date) -> Dict[str, int]:
+    """Export one month of receipts and items, then remove them from the database"""
+    pa = _pyarrow()
+    receipt_schema, item_schema = _schemas(pa)
+    start, end = month, partitions.next_month(month)
+    bind = db.get_bind()
+
+    partition = None
+    if partitions.supported(bind) and partitions.is_partitioned(db.connection()):
+        name = partitions.partition_name(month)
+        if db.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar():
+            partition = name
+            # New rows for this month wait until the partition is gone
+            db.execute(text(f"LOCK TABLE {name} IN EXCLUSIVE MODE"))
+
+    receipt_cols = [getattr(models.Receipt, c) for c in RECEIPT_COLUMNS]
+    receipts = db.execute(
+        select(*receipt_cols).where(models.Receipt.date >= start, models.Receipt.date < end)
+        .order_by(models.Receipt.user_id, models.Receipt.date, models.Receipt.id)
+    ).all()
+    receipt_ids = [row.id for row in receipts]
+    items = []
+    for i in range(0, len(receipt_ids), DELETE_BATCH_SIZE):
+        items += db.execute(
+            select(*[getattr(models.Item, c) for c in ITEM_COLUMNS])
+            .where(models.Item.receipt_id.in_(receipt_ids[i:i + DELETE_BATCH_SIZE]))
+        ).all()
+    if not receipts and partition is None:
+        return {"receipts": 0, "items": 0}
+
+    # Minor units are filled for rows not yet backfilled, so the archive is exact
+    receipts = [
+        (*row[:5], row.total_amount_minor if row.total_amount_minor is not None else to_minor(row.total_amount), *row[6:])
+        for row in receipts
+    ]
+    if receipts:
+        _write(pa, receipts, receipt_schema, "receipts", month)
+    if items:
+        items.sort(key=lambda row: (row.user_id or "", row.receipt_id, row.id))
+        _write(pa, items, item_schema, "items", month)
+
+    _delete_ids(db, models.Item, models.Item.id, [row.id for row in items])
+    if partition:
+        db.execute(text(f"ALTER TABLE receipts DETACH PARTITION {partition}"))
+        db.execute(text(f"DROP TABLE {partition}"))
+    else:
+        _delete_ids(db, models.Receipt, models.Receipt.id, receipt_ids)
+
+    manifest = db.get(models.ReceiptArchive, month) or models.ReceiptArchive(month=month, receipts=0, items=0)
+    manifest.receipts += len(receipts)
+    manifest.items += len(items)
+    manifest.archived_at = datetime.utcnow()
+    db.add(manifest)
+    db.commit()
+    return {"receipts": len(receipts), "items": len(items)}
+
+
+def run(db: Session, before: Optional[date] = None, dry_run: bool = False) -> Dict[str, Dict[str, int]]:
+    """Archive every month before `before` (default: ARCHIVE_AFTER_MONTHS ago) that has live receipts"""
+    before = partitions.month_start(before or cutoff())
+    first = db.query(models.Receipt.date).filter(
+        models.Receipt.date != None, models.Receipt.date < before
+    ).order_by(models.Receipt.date).limit(1).scalar()
+    results = {}
+    month = partitions.month_start(first) if first else before
+    while month < before:
+        if dry_run:
+            count = db.query(models.Receipt.id).filter(
+                models.Receipt.date >= month, models.Receipt.date < partitions.next_month(month)
+            ).count()
+            if count:
+                results[f"{month:%Y-%m}"] = {"receipts": count}
+        else:
+            result = archive_month(db, month)
+            if result["receipts"]:
+                results[f"{month:%Y-%m}"] = result
+                logger.info(f"Archived {month:%Y-%m}: {result}")
+        month = partitions.next_month(month)
+    return results
+
+
+def read_receipts(db: Session, user_id: str, start_date: Optional[date] = None,
+                  end_date: Optional[date] = None) -> List[dict]:
+    """A user's archived receipts in a date range (one row per receipt id)"""
+    months = archived_months(db, start_date, end_date)
+    if not months:
+        return []
+    pa = _pyarrow()
+    ds = pa.dataset
+    paths = [path for month in months for path in _files("receipts", month)]
+    if not paths:
+        logger.warning(f"Archived months {months} have no files under {ARCHIVE_DIR}")
+        return []
+    receipt_schema, _ = _schemas(pa)
+    condition = ds.field("user_id") == user_id
+    if start_date:
+        condition &= ds.field("date") >= start_date
+    if end_date:
+        condition &= ds.field("date") <= end_date
+    with tracing.span("storage.read", {"storage.files": len(paths)}, root=False):
+        dataset = ds.dataset(paths, schema=receipt_schema, format="parquet")
+        table = dataset.to_table(filter=condition)
+    rows = {}
+    for row in table.to_pylist():
+        rows.setdefault(row["id"], row)
+    return sorted(rows.values(), key=lambda row: (row["date"], row["id"]))
+
+
+def purge_user(db: Session, user_id: str) -> int:
+    """Rewrite archive files without a user's receipts and their items; returns rows removed"""
+    months = archived_months(db)
+    if not months:
+        return 0
+    pa = _pyarrow()
+    pc = pa.compute
+    removed = 0
+
+    def rewrite(kind, month, keep_mask):
+        nonlocal removed
+        dropped = []
+        with tracing.span("storage.rewrite", {"storage.kind": kind, "storage.month": f"{month:%Y-%m}"}) as span:
+            for path in _files(kind, month):
+                table = pa.parquet.read_table(path)
+                keep = pc.fill_null(keep_mask(table), True)
+                if pc.all(keep).as_py():
+                    continue
+                dropped += table.filter(pc.invert(keep))["id"].to_pylist()
+                kept = table.filter(keep)
+                if kept.num_rows:
+                    pa.parquet.write_table(kept, path + ".tmp", compression="zstd", row_group_size=ROW_GROUP_SIZE)
+                    os.replace(path + ".tmp", path)
+                else:
+                    os.remove(path)
+            span.set_attribute("storage.rows", len(dropped))
+        removed += len(dropped)
+        return dropped
+
+    for month in months:
+        receipt_ids = pa.array(
+            rewrite("receipts", month, lambda t: pc.not_equal(t["user_id"], user_id)), pa.int64()
+        )
+        rewrite("items", month, lambda t: pc.and_kleene(
+            pc.not_equal(t["user_id"], user_id), pc.invert(pc.is_in(t["receipt_id"], value_set=receipt_ids))
+        ))
+    return removed
+
+
+def export(db: Session, user_id: str, path: str) -> int:
+    """Write all of a user's receipts, live and archived, to a CSV file"""
+    live = db.execute(
+        select(*[getattr(models.Receipt, c) for c in RECEIPT_COLUMNS]).where(models.Receipt.user_id == user_id)
+    ).mappings().all()
+    rows = {row["id"]: dict(row) for row in read_receipts(db, user_id)}
+    rows.update({row["id"]: dict(row) for row in live})
+    columns = [c for c in RECEIPT_COLUMNS if c not in ("user_id", "total_amount", "total_amount_minor")]
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns + ["total_amount"])
+        for row in sorted(rows.values(), key=lambda row: (row["date"] or date.min, row["id"])):
+            amount = row["total_amount_minor"]
+            writer.writerow([row[c] for c in columns] + [
+                from_minor(amount) if amount is not None else row["total_amount"]
+            ])
+    return len(rows)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "run", "export"])
+    parser.add_argument("args", nargs="*", help="export: USER_ID PATH")
+    parser.add_argument("--before", type=date.fromisoformat, help="archive months before this date")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        if args.command == "run":
+            for month, result in run(db, args.before, args.dry_run).items():
+                print(f"{month}  {result}")
+        elif args.command == "export":
+            if len(args.args) != 2:
+                parser.error("export needs USER_ID PATH")
+            print(f"Exported {export(db, *args.args)} receipts")
+        for manifest in db.query(models.ReceiptArchive).order_by(models.ReceiptArchive.month):
+            print(f"{manifest.month:%Y-%m}  receipts={manifest.receipts}  items={manifest.items}  archived_at={manifest.archived_at:%Y-%m-%d %H:%M}")
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
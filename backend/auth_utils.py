@@ -1,45 +1,132 @@
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, Header, HTTPException, Query, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from supabase import create_client, Client
+import base64
+import hashlib
+import hmac
+import logging
 import os
+import secrets
+import time
 from typing import Optional
 
-SUPABASE_URL = os.environ.get("SUPABASE_URL") or os.environ.get("NEXT_PUBLIC_SUPABASE_URL")
-SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+import env
+import ratelimit
+import supabase_client
+import tracing
+
+logger = logging.getLogger(__name__)
 
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
+
+ADMIN_API_KEY = os.environ.get("ADMIN_API_KEY")
+
+# Stream tickets (see issue_stream_ticket) are signed with this key; set it to the same
+# value on every worker, or a ticket only works on the worker that issued it
+STREAM_TICKET_SECRET = (os.environ.get("STREAM_TICKET_SECRET") or secrets.token_hex(32)).encode()
+STREAM_TICKET_SECONDS = int(os.getenv("STREAM_TICKET_SECONDS", "60"))
 
-def get_supabase_client() -> Client:
-    if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
+def require_admin(x_admin_key: Optional[str] = Header(None)):
+    """Operator endpoints are restricted to callers presenting ADMIN_API_KEY"""
+    if not ADMIN_API_KEY or x_admin_key != ADMIN_API_KEY:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin key required")
+
+def get_supabase_client() -> supabase_client.SupabaseAuthClient:
+    try:
+        return supabase_client.get_client()
+    except supabase_client.NotConfiguredError as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Supabase credentials not configured in backend"
+            detail=str(e)
+        )
+
+def _user_for_token(token: str) -> str:
+    with tracing.span("auth.verify_token", root=False) as span:
+        user_id = _verify(token)
+        span.set_attribute("enduser.id", user_id)
+    ratelimit.remember_identity(token, user_id)
+    return user_id
+
+def _verify(token: str) -> str:
+    supabase = get_supabase_client()
+
+    try:
+        user_id = supabase.get_user_id(token)
+    except supabase_client.UnavailableError as e:
+        logger.warning(f"Auth Error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Authentication service unavailable",
+            headers={"Retry-After": str(int(supabase_client.RESET_TIMEOUT))},
+        )
+
+    if not user_id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
         )
-    return create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+    return user_id
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def get_request_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)) -> Optional[str]:
+    """
+    The User ID of the Bearer token, or None without one. FastAPI caches it per request,
+    so get_db (which needs the caller's shard) and get_current_user validate the token once.
+    """
+    return _user_for_token(credentials.credentials) if credentials else None
+
+def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    user_id: Optional[str] = Depends(get_request_user)
+):
     """
     Validates the Bearer token and returns the User ID.
     """
-    token = credentials.credentials
-    supabase = get_supabase_client()
-    
+    return user_id
+
+def _ticket_signature(payload: str) -> str:
+    return hmac.new(STREAM_TICKET_SECRET, f"stream:{payload}".encode(), hashlib.sha256).hexdigest()
+
+def issue_stream_ticket(user_id: str) -> str:
+    """
+    Short-lived credential for the event stream only, so the long-lived access token
+    never appears in URLs (proxy and access logs, browser history). It is a signed
+    user id and expiry: any worker sharing STREAM_TICKET_SECRET accepts it, and
+    EventSource can reconnect with it until it expires.
+    """
+    payload = base64.urlsafe_b64encode(f"{user_id}:{int(time.time()) + STREAM_TICKET_SECONDS}".encode()).decode()
+    return f"{payload}.{_ticket_signature(payload)}"
+
+def _user_for_ticket(ticket: str) -> str:
+    payload, _, signature = ticket.partition(".")
     try:
-        user_response = supabase.auth.get_user(token)
-        
-        if not user_response or not user_response.user:
-             raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid authentication credentials",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-            
-        return user_response.user.id
-        
-    except Exception as e:
-        print(f"Auth Error: {e}")
+        user_id, _, expires = base64.urlsafe_b64decode(payload.encode()).decode().rpartition(":")
+        valid = hmac.compare_digest(signature, _ticket_signature(payload)) and int(expires) > time.time()
+    except ValueError:
+        valid = False
+    if not valid or not user_id:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
+            detail="Invalid or expired stream ticket",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    ratelimit.remember_identity(ticket, user_id)
+    return user_id
+
+def get_stream_user(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+    ticket: Optional[str] = Query(None)
+):
+    """
+    Like get_current_user, but also accepts ?ticket= from POST /events/ticket since
+    EventSource cannot send headers. Access tokens are not accepted in the query string.
+    """
+    if credentials:
+        return _user_for_token(credentials.credentials)
+    if not ticket:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    return _user_for_ticket(ticket)
@@ -0,0 +1,410 @@
+"""
+Per-endpoint benchmarks against a throwaway SQLite database.
+
+Usage:
+    python benchmark.py [suite ...] [--rows 2000] [--repeat 50]
+
+Seeds one user with receipts (with items) and income entries, then times the
+hot endpoints through the ASGI app. Requires httpx (for fastapi.testclient).
+The cold_start suite instead spawns fresh interpreters and times import of
+`main` plus the lifespan and first response; the catalog suite times price
+lookups over a large synthetic product_prices table, and the recurring suite
+one materialization run over many due templates. The backends suite runs the same
+typical-user workload on SQLite and, given --postgres-url (or BENCH_POSTGRES_URL),
+on Postgres, each in a fresh interpreter.
+"""
+import argparse
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+BENCH_USER = "bench-user"
+
+
+def setup_app(db_path: str = None):
+    if db_path:
+        os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+    from fastapi.testclient import TestClient
+    import main
+    import migrations
+    from auth_utils import get_current_user
+    from database import engine
+
+    migrations.upgrade(engine, log=lambda message: None)
+
+    main.app.dependency_overrides[get_current_user] = lambda: BENCH_USER
+    return TestClient(main.app)
+
+
+def seed(rows: int):
+    import models
+    from database import SessionLocal
+
+    rng = random.Random(42)
+    merchants = ["Carrefour", "Monoprix", "Aziza", "Shell", "Pharmacie", "Zara", "STEG", "SONEDE"]
+    categories = ["Food", "Transportation", "Shopping", "Health", "Bills", "Housing"]
+    start = date.today() - timedelta(days=5 * 365)
+
+    db = SessionLocal()
+    try:
+        for i in range(rows):
+            receipt = models.Receipt(
+                user_id=BENCH_USER,
+                merchant_name=rng.choice(merchants),
+                date=start + timedelta(days=rng.randrange(5 * 365)),
+                total_amount=round(rng.uniform(1, 500), 2),
+                currency="TND",
+                category=rng.choice(categories),
+            )
+            receipt.items = [
+                models.Item(name=f"item-{j}", price=round(rng.uniform(0.5, 50), 2), quantity=rng.randint(1, 4), user_id=BENCH_USER)
+                for j in range(rng.randint(1, 6))
+            ]
+            db.add(receipt)
+            if i % 10 == 0:
+                db.add(models.Income(
+                    user_id=BENCH_USER,
+                    source=rng.choice(["ACME Corp", "Upwork", "Dividends"]),
+                    amount=round(rng.uniform(100, 5000), 2),
+                    currency="TND",
+                    category=rng.choice(["Salary", "Freelance", "Investment"]),
+                    date=start + timedelta(days=rng.randrange(5 * 365)),
+                ))
+        db.commit()
+    finally:
+        db.close()
+
+
+def timed(client, url: str, repeat: int):
+    samples = []
+    body = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        response = client.get(url)
+        samples.append((time.perf_counter() - t0) * 1000)
+        response.raise_for_status()
+        body = response.content
+    return statistics.median(samples), body
+
+
+ENDPOINTS = [
+    "/receipts/?limit=100",
+    "/income/?limit=100",
+    "/receipts/dashboard/stats",
+]
+
+
+def bench_fast_json(client, repeat: int):
+    import responses
+
+    print(f"{'endpoint':<40}{'default ms':>12}{'fast ms':>12}{'speedup':>10}  identical")
+    for url in ENDPOINTS:
+        responses.FAST_JSON_RESPONSES = False
+        slow, slow_body = timed(client, url, repeat)
+        responses.FAST_JSON_RESPONSES = True
+        fast, fast_body = timed(client, url, repeat)
+        print(f"{url:<40}{slow:>12.2f}{fast:>12.2f}{slow / fast:>9.2f}x  {slow_body == fast_body}")
+
+
+def bench_analytics(rows: int, repeat: int):
+    """Time the vectorized analytics on a synthetic in-memory history (excludes DB fetch)"""
+    import numpy as np
+    import analytics
+
+    rng = np.random.default_rng(42)
+    days = np.datetime64(date.today() - timedelta(days=5 * 365)) + rng.integers(0, 5 * 365, rows).astype('timedelta64[D]')
+    history = analytics.History(
+        ids=np.arange(rows, dtype=np.int64),
+        kinds=(rng.random(rows) < 0.1).astype(np.int8),
+        months=days.astype('datetime64[M]').astype(np.int32),
+        days=days,
+        amounts=rng.lognormal(3, 1, rows),
+        categories=rng.integers(0, 11, rows).astype(np.int32),
+        merchants=rng.integers(0, 500, rows).astype(np.int32),
+        category_names=[f"category-{i}" for i in range(11)],
+        merchant_names=[f"merchant-{i}" for i in range(500)],
+    )
+    print(f"{'analytics':<40}{'method':>12}{'median ms':>12}")
+    for method in ("mad", "zscore"):
+        samples = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            analytics.compute(history, method=method)
+            samples.append((time.perf_counter() - t0) * 1000)
+        print(f"{f'compute() on {rows} rows':<40}{method:>12}{statistics.median(samples):>12.2f}")
+
+
+COLD_START = """
+import json, os, sys, time
+t0 = time.perf_counter()
+import main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(main.app) as client:
+    client.get("/").raise_for_status()
+    first_response = time.perf_counter()
+import startup
+print(json.dumps({
+    "import_ms": (imported - t0) * 1000,
+    "first_request_ms": (first_response - t0) * 1000,
+    "phases_ms": startup.profile.report()["phases_ms"] if hasattr(startup, "profile") else {},
+}))
+"""
+
+
+def bench_cold_start(db_path: str, repeat: int):
+    """Time-to-first-request of a fresh interpreter: import main, run the lifespan, serve GET /"""
+    import json
+
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{db_path}")
+    backend = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", COLD_START], cwd=backend, env=env,
+            capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+
+    print(f"{'cold start':<40}{'median ms':>12}{'min ms':>12}")
+    for key in ("import_ms", "first_request_ms"):
+        values = [run[key] for run in runs]
+        print(f"{key:<40}{statistics.median(values):>12.2f}{min(values):>12.2f}")
+    phases = {}
+    for run in runs:
+        for name, ms in run["phases_ms"].items():
+            phases.setdefault(name, []).append(ms)
+    for name, values in phases.items():
+        print(f"{f'  phase: {name}':<40}{statistics.median(values):>12.2f}{min(values):>12.2f}")
+
+
+BACKEND_WORKLOAD = """
+import json, os, statistics, sys, time
+import benchmark
+import jobs
+from database import SessionLocal
+client = benchmark.setup_app()
+db = SessionLocal()
+jobs.delete_user(db, {"user_id": benchmark.BENCH_USER})
+db.close()
+rows, repeat = int(sys.argv[1]), int(sys.argv[2])
+t0 = time.perf_counter()
+benchmark.seed(rows)
+results = {"seed_ms": (time.perf_counter() - t0) * 1000}
+for url in benchmark.ENDPOINTS:
+    results[f"GET {url}"] = benchmark.timed(client, url, repeat)[0]
+receipt = {"merchant_name": "Carrefour", "date": "2024-05-01", "total_amount": 12.5, "category": "Food",
+           "items": [{"name": "Milk", "price": 2.5, "quantity": 5}]}
+samples = []
+for _ in range(repeat):
+    t1 = time.perf_counter()
+    client.post("/receipts/", json=receipt).raise_for_status()
+    samples.append((time.perf_counter() - t1) * 1000)
+results["POST /receipts/"] = statistics.median(samples)
+print(json.dumps(results))
+"""
+
+
+def bench_backends(rows: int, repeat: int, postgres_url: str = None):
+    """Typical-user seed, reads and writes on SQLite and Postgres, each in a fresh interpreter"""
+    import json
+
+    backend = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        urls = {"sqlite": f"sqlite:///{os.path.join(tmp, 'bench.db')}"}
+        if postgres_url:
+            urls["postgres"] = postgres_url
+        results = {}
+        for name, url in urls.items():
+            out = subprocess.run(
+                [sys.executable, "-c", BACKEND_WORKLOAD, str(rows), str(repeat)], cwd=backend,
+                env=dict(os.environ, DATABASE_URL=url, DATABASE_READ_URLS=""), capture_output=True, text=True, check=True
+            ).stdout
+            results[name] = json.loads(out.strip().splitlines()[-1])
+
+    print(f"{'backends (median ms)':<40}" + "".join(f"{name:>12}" for name in results))
+    for key in results["sqlite"]:
+        print(f"{key:<40}" + "".join(f"{run[key]:>12.2f}" for run in results.values()))
+    if not postgres_url:
+        print("(pass --postgres-url or set BENCH_POSTGRES_URL to compare with Postgres)")
+
+
+def bench_ratelimit(calls: int):
+    """Per-request overhead of RateLimitMiddleware around a no-op ASGI app"""
+    import asyncio
+    import ratelimit
+
+    async def noop(scope, receive, send):
+        pass
+
+    async def send(message):
+        pass
+
+    def scope(path):
+        return {
+            "type": "http", "method": "GET", "path": path, "client": ("127.0.0.1", 1),
+            "headers": [(b"host", b"localhost"), (b"authorization", b"Bearer bench-token")],
+        }
+
+    async def run(app, path):
+        request = scope(path)
+        t0 = time.perf_counter()
+        for _ in range(calls):
+            await app(request, None, send)
+        return (time.perf_counter() - t0) / calls * 1e6
+
+    ratelimit.USER_LIMIT = ratelimit.Limit(rate=1e9, burst=10**9)
+    limited = ratelimit.ROUTE_LIMITS[("GET", "/receipts/dashboard/stats")]
+    ratelimit.ROUTE_LIMITS[("GET", "/receipts/dashboard/stats")] = ratelimit.RouteLimit(
+        limited.name, ratelimit.Limit(rate=1e9, burst=10**9), concurrency=10**9
+    )
+    print(f"{'rate limit overhead':<40}{'backend':>12}{'us/request':>12}")
+    baseline = asyncio.run(run(noop, "/receipts/"))
+    for name, backend in [("memory", ratelimit.MemoryBackend()), ("standin", ratelimit.SharedBackend(ratelimit.StandInStore()))]:
+        app = ratelimit.RateLimitMiddleware(noop, backend=backend, enabled=True)
+        for path in ("/receipts/", "/receipts/dashboard/stats"):
+            print(f"{path:<40}{name:>12}{asyncio.run(run(app, path)) - baseline:>12.2f}")
+
+
+def bench_catalog(rows: int, repeat: int, products: int = 5000):
+    """Time price history and cheapest-merchant lookups over `rows` indexed line items"""
+    import models
+    import catalog
+    from database import SessionLocal
+    from sqlalchemy import insert
+
+    rng = random.Random(42)
+    merchants = ["Carrefour", "Monoprix", "Aziza", "Geant", "MG", "Magasin General"]
+    start = date.today() - timedelta(days=5 * 365)
+    db = SessionLocal()
+    try:
+        db.execute(insert(models.Product), [
+            {"id": i + 1, "user_id": BENCH_USER, "key": f"product {i}", "name": f"Product {i}"} for i in range(products)
+        ])
+        for offset in range(0, rows, 100_000):
+            db.execute(insert(models.ProductPrice), [
+                {
+                    "user_id": BENCH_USER,
+                    "product_id": rng.randint(1, products),
+                    "receipt_id": i,
+                    "date": start + timedelta(days=rng.randrange(5 * 365)),
+                    "merchant_name": rng.choice(merchants),
+                    "currency": "TND",
+                    "price_minor": rng.randint(500, 50_000),
+                    "quantity": 1,
+                }
+                for i in range(offset, min(rows, offset + 100_000))
+            ])
+        db.commit()
+
+        print(f"{'catalog':<40}{'rows':>12}{'median ms':>12}")
+        for name, call in [
+            ("price_history", lambda product_id: catalog.price_history(db, BENCH_USER, product_id)),
+            ("cheapest_merchants", lambda product_id: catalog.cheapest_merchants(db, BENCH_USER, product_id)),
+        ]:
+            samples = []
+            for _ in range(repeat):
+                product_id = rng.randint(1, products)
+                t0 = time.perf_counter()
+                call(product_id)
+                samples.append((time.perf_counter() - t0) * 1000)
+            print(f"{name:<40}{rows:>12}{statistics.median(samples):>12.2f}")
+    finally:
+        db.close()
+
+
+def bench_recurring(templates: int, users: int = 10_000):
+    """Time one materialization run of `templates` templates, each due once"""
+    import models
+    import recurring
+    from database import SessionLocal
+    from sqlalchemy import func, insert
+
+    today = date.today()
+    db = SessionLocal()
+    try:
+        for offset in range(0, templates, 100_000):
+            db.execute(insert(models.RecurringTemplate), [
+                {
+                    "user_id": f"user-{i % users}",
+                    "kind": "receipt" if i % 3 else "income",
+                    "name": f"Template {i}",
+                    "amount": 10.0,
+                    "amount_minor": 1000,
+                    "currency": "TND",
+                    "category": "Bills" if i % 3 else "Salary",
+                    "frequency": "monthly",
+                    "interval": 1,
+                    "day": today.day,
+                    "start_date": today,
+                    "next_date": today,
+                }
+                for i in range(offset, min(templates, offset + 100_000))
+            ])
+        db.commit()
+
+        t0 = time.perf_counter()
+        created = recurring.materialize(db, today)
+        elapsed = time.perf_counter() - t0
+        rows = db.query(func.count(models.Receipt.id)).scalar() + db.query(func.count(models.Income.id)).scalar()
+        print(f"{'recurring':<40}{'templates':>12}{'rows':>12}{'seconds':>12}")
+        print(f"{'materialize':<40}{templates:>12}{created:>12}{elapsed:>12.2f}")
+        assert rows == created == templates
+    finally:
+        db.close()
+
+
+SUITES = ["fast_json", "analytics", "cold_start", "ratelimit", "catalog", "recurring", "backends"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("suites", nargs="*", choices=SUITES, default=SUITES, help="benchmarks to run")
+    parser.add_argument("--rows", type=int, default=2000, help="receipts to seed")
+    parser.add_argument("--analytics-rows", type=int, default=1_000_000, help="synthetic rows for the analytics suite")
+    parser.add_argument("--catalog-rows", type=int, default=1_000_000, help="indexed line items for the catalog suite")
+    parser.add_argument("--recurring-templates", type=int, default=1_000_000, help="due templates for the recurring suite")
+    parser.add_argument("--postgres-url", default=os.getenv("BENCH_POSTGRES_URL"),
+                        help="Postgres database for the backends suite (its bench-user rows are replaced)")
+    parser.add_argument("--repeat", type=int, default=50, help="requests per measurement")
+    args = parser.parse_args()
+
+    if "fast_json" in args.suites:
+        with tempfile.TemporaryDirectory() as tmp:
+            client = setup_app(os.path.join(tmp, "bench.db"))
+            seed(args.rows)
+            print(f"Seeded {args.rows} receipts for {BENCH_USER}\n")
+            bench_fast_json(client, args.repeat)
+            print()
+    if "analytics" in args.suites:
+        bench_analytics(args.analytics_rows, min(args.repeat, 10))
+        print()
+    if "cold_start" in args.suites:
+        with tempfile.TemporaryDirectory() as tmp:
+            bench_cold_start(os.path.join(tmp, "bench.db"), min(args.repeat, 20))
+        print()
+    if "ratelimit" in args.suites:
+        bench_ratelimit(100_000)
+        print()
+    if "catalog" in args.suites:
+        with tempfile.TemporaryDirectory() as tmp:
+            setup_app(os.path.join(tmp, "bench.db"))
+            bench_catalog(args.catalog_rows, args.repeat)
+        print()
+    if "recurring" in args.suites:
+        with tempfile.TemporaryDirectory() as tmp:
+            setup_app(os.path.join(tmp, "bench.db"))
+            bench_recurring(args.recurring_templates)
+        print()
+    if "backends" in args.suites:
+        bench_backends(args.rows, args.repeat, args.postgres_url)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,360 @@
+"""
+Monthly budgets and threshold alerts.
+
+spending_totals keeps a running total per (user, month, category), plus one row
+per month with category "*" for all spending, in the user's settings currency.
+services calls `apply` with the receipt's state before and after every write, in
+the same transaction, so the totals move by the difference and never need a scan.
+Each receipt stores what it added (receipts.budget_minor, converted with the rates
+known when it was written), and an update or delete subtracts exactly that: rates
+loaded later, or a stale rate cache in another worker, cannot make totals drift.
+`rebuild` re-converts everything with the current rates.
+Checking a budget is then a lookup of one row: `apply` raises a BudgetAlert the
+first time a month's total reaches each threshold of a touched budget.
+
+Alerts are polled through GET /budgets/alerts?after_id=N. Totals are rebuilt from
+receipts by `rebuild` (after the migration, and when the user changes currency).
+Archiving old receipts leaves the totals of past months in place.
+
+Usage:
+    python budgets.py rebuild [--user USER_ID]
+"""
+import argparse
+import sys
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import or_, update
+from sqlalchemy.orm import Session
+
+import fx
+import models
+import schemas
+from database import insert_for
+from money import from_minor, minor_amount
+
+ALL = "*"
+UNCATEGORIZED = schemas.ExpenseCategory.UNCATEGORIZED.value
+
+
+class Entry(NamedTuple):
+    """The part of a receipt that counts towards totals"""
+    date: Optional[date]
+    category: Optional[str]
+    amount_minor: Optional[int]
+    currency: Optional[str]
+    counted_minor: Optional[int] = None  # What the receipt added to the totals (receipts.budget_minor)
+
+
+def entry(receipt) -> Optional[Entry]:
+    """Entry of a receipt, or of a row with the same column names"""
+    if receipt is None:
+        return None
+    return Entry(receipt.date, receipt.category, receipt.total_amount_minor, receipt.currency, receipt.budget_minor)
+
+
+def _counts(state: Optional[Entry]) -> bool:
+    return state is not None and state.date is not None and bool(state.amount_minor)
+
+
+def _convert(db: Session, state: Entry, target: str) -> int:
+    """What a receipt adds to its user's totals; 0 without a rate (counted once rates are loaded and `rebuild` runs)"""
+    amount = fx.convert_amount(db, state.amount_minor, state.currency, state.date, target)
+    return round(amount) if amount is not None else 0
+
+
+def month_of(day: date) -> date:
+    return day.replace(day=1)
+
+
+Key = Tuple[str, date, str]  # (user_id, month, category)
+
+
+def _increment(db: Session, deltas: Dict[Key, int]) -> None:
+    """Add deltas to (user, month, category) totals with one batched upsert"""
+    rows = [
+        {"user_id": user_id, "month": month, "category": category, "total_minor": delta}
+        for (user_id, month, category), delta in deltas.items() if delta
+    ]
+    if not rows:
+        return
+    insert = insert_for(db, models.SpendingTotal)
+    db.execute(insert.on_conflict_do_update(
+        index_elements=["user_id", "month", "category"],
+        set_={"total_minor": models.SpendingTotal.total_minor + insert.excluded.total_minor}
+    ), rows)
+
+
+def apply(db: Session, user_id: str, old: Optional[Entry], new: Optional[Entry]) -> Optional[int]:
+    """
+    Move the running totals from a receipt's old state to its new one; the caller
+    commits and stores the returned amount the new state added in receipts.budget_minor.
+    """
+    return apply_many(db, [(user_id, old, new)])[0]
+
+
+def apply_many(db: Session, changes: Iterable[Tuple[str, Optional[Entry], Optional[Entry]]]) -> List[Optional[int]]:
+    """
+    `apply` for a batch of (user_id, old, new) receipt changes across users, in a few
+    statements; returns the amount each new state added (None when it adds nothing).
+    """
+    changes = list(changes)
+    counted: List[Optional[int]] = [None] * len(changes)
+    relevant = [i for i, (_, old, new) in enumerate(changes) if _counts(old) or _counts(new)]
+    if not relevant:
+        return counted
+    currencies = fx.user_currencies(db, {changes[i][0] for i in relevant})
+    deltas: Dict[Key, int] = defaultdict(int)
+    for i in relevant:
+        user_id, old, new = changes[i]
+        removed = None
+        if _counts(old):
+            removed = old.counted_minor
+            if removed is None:  # Written before receipts.budget_minor: the best estimate is today's rate
+                removed = _convert(db, old, currencies[user_id])
+            month = month_of(old.date)
+            deltas[(user_id, month, old.category or UNCATEGORIZED)] -= removed
+            deltas[(user_id, month, ALL)] -= removed
+        if _counts(new):
+            # Same amount, currency and day (a recategorization): the same contribution,
+            # otherwise convert the new state
+            if removed is not None and (new.date, new.amount_minor, new.currency) == (old.date, old.amount_minor, old.currency):
+                added = removed
+            else:
+                added = _convert(db, new, currencies[user_id])
+            month = month_of(new.date)
+            deltas[(user_id, month, new.category or UNCATEGORIZED)] += added
+            deltas[(user_id, month, ALL)] += added
+            counted[i] = added
+    _increment(db, deltas)
+
+    increased = [key for key, delta in deltas.items() if delta > 0]
+    if increased:
+        check(db, increased)
+    return counted
+
+
+def _totals(db: Session, keys: Iterable[Key]) -> Dict[Key, int]:
+    keys = set(keys)
+    rows = db.query(
+        models.SpendingTotal.user_id, models.SpendingTotal.month,
+        models.SpendingTotal.category, models.SpendingTotal.total_minor
+    ).filter(
+        models.SpendingTotal.user_id.in_({user_id for user_id, _, _ in keys}),
+        models.SpendingTotal.month.in_({month for _, month, _ in keys}),
+        models.SpendingTotal.category.in_({category for _, _, category in keys})
+    )
+    return {(user_id, month, category): total for user_id, month, category, total in rows}
+
+
+def check(db: Session, keys: Iterable[Key], budgets: Optional[List[models.Budget]] = None) -> int:
+    """Raise alerts for budgets on the given (user, month, category) totals; returns new alerts"""
+    months: Dict[Tuple[str, str], List[date]] = defaultdict(list)
+    for user_id, month, category in set(keys):
+        months[(user_id, category)].append(month)
+    if budgets is None:
+        categories = {category for _, category in months}
+        matches = [models.Budget.category.in_(categories - {ALL})]
+        if ALL in categories:
+            matches.append(models.Budget.category == None)
+        budgets = db.query(models.Budget).filter(
+            models.Budget.user_id.in_({user_id for user_id, _ in months}), or_(*matches)
+        ).all()
+    budgets = [budget for budget in budgets if (budget.user_id, budget.category or ALL) in months]
+    if not budgets:
+        return 0
+    db.flush()
+    totals = _totals(db, [
+        (budget.user_id, month, budget.category or ALL)
+        for budget in budgets for month in months[(budget.user_id, budget.category or ALL)]
+    ])
+    raised = 0
+    for budget in budgets:
+        category = budget.category or ALL
+        for month in months[(budget.user_id, category)]:
+            spent = totals.get((budget.user_id, month, category), 0)
+            for threshold in budget.thresholds:
+                if spent * 100 < budget.amount_minor * threshold:
+                    continue
+                result = db.execute(insert_for(db, models.BudgetAlert).values(
+                    user_id=budget.user_id, budget_id=budget.id, category=budget.category, month=month,
+                    threshold=threshold, spent_minor=spent, limit_minor=budget.amount_minor,
+                    created_at=datetime.utcnow()
+                ).on_conflict_do_nothing(index_elements=["budget_id", "month", "threshold"]))
+                raised += result.rowcount
+    return raised
+
+
+# Budgets
+
+def _status(budget: models.Budget, spent_minor: int, month: date, currency: str) -> schemas.Budget:
+    return schemas.Budget(
+        id=budget.id,
+        category=budget.category,
+        amount=budget.amount,
+        thresholds=budget.thresholds,
+        month=month,
+        spent=from_minor(spent_minor),
+        remaining=from_minor(budget.amount_minor - spent_minor),
+        percent=round(spent_minor * 100 / budget.amount_minor, 2) if budget.amount_minor else 0.0,
+        currency=currency
+    )
+
+
+def get_budgets(db: Session, user_id: str, month: Optional[date] = None) -> List[schemas.Budget]:
+    """Budgets of a user with their spending for `month` (default: the current month)"""
+    month = month_of(month or date.today())
+    budgets = db.query(models.Budget).filter(models.Budget.user_id == user_id).order_by(models.Budget.id).all()
+    totals = _totals(db, [(user_id, month, budget.category or ALL) for budget in budgets]) if budgets else {}
+    currency = fx.user_currency(db, user_id)
+    return [_status(budget, totals.get((user_id, month, budget.category or ALL), 0), month, currency) for budget in budgets]
+
+
+def get_budget(db: Session, budget_id: int, user_id: str) -> Optional[models.Budget]:
+    return db.query(models.Budget).filter(models.Budget.id == budget_id, models.Budget.user_id == user_id).first()
+
+
+def _evaluate(db: Session, budget: models.Budget) -> schemas.Budget:
+    """Check a new or changed budget against the current month right away"""
+    key = (budget.user_id, month_of(date.today()), budget.category or ALL)
+    check(db, [key], budgets=[budget])
+    db.commit()
+    spent = _totals(db, [key]).get(key, 0)
+    return _status(budget, spent, key[1], fx.user_currency(db, budget.user_id))
+
+
+def create_budget(db: Session, budget: schemas.BudgetCreate, user_id: str) -> Optional[schemas.Budget]:
+    """Create a budget; None if the user already has one for that category"""
+    category = budget.category.value if budget.category else None
+    if db.query(models.Budget.id).filter(models.Budget.user_id == user_id, models.Budget.category == category).first():
+        return None
+    db_budget = models.Budget(
+        user_id=user_id, category=category, amount=budget.amount, thresholds=sorted(set(budget.thresholds))
+    )
+    db.add(db_budget)
+    db.flush()
+    return _evaluate(db, db_budget)
+
+
+def update_budget(db: Session, budget_id: int, budget_update: schemas.BudgetUpdate, user_id: str) -> Optional[schemas.Budget]:
+    db_budget = get_budget(db, budget_id, user_id)
+    if not db_budget:
+        return None
+    if budget_update.amount is not None:
+        db_budget.amount = budget_update.amount
+    if budget_update.thresholds is not None:
+        db_budget.thresholds = sorted(set(budget_update.thresholds))
+    if budget_update.amount is not None or budget_update.thresholds is not None:
+        # Alerts of the current month were raised against the old limit
+        db.query(models.BudgetAlert).filter(
+            models.BudgetAlert.budget_id == budget_id,
+            models.BudgetAlert.month == month_of(date.today()),
+            models.BudgetAlert.read_at == None
+        ).delete(synchronize_session=False)
+    db.flush()
+    return _evaluate(db, db_budget)
+
+
+def delete_budget(db: Session, budget_id: int, user_id: str) -> bool:
+    db_budget = get_budget(db, budget_id, user_id)
+    if not db_budget:
+        return False
+    db.query(models.BudgetAlert).filter(models.BudgetAlert.budget_id == budget_id).delete(synchronize_session=False)
+    db.delete(db_budget)
+    db.commit()
+    return True
+
+
+# Alert feed
+
+def get_alerts(db: Session, user_id: str, after_id: int = 0, unread: bool = False, limit: int = 50) -> List[schemas.BudgetAlert]:
+    """Alerts newer than `after_id`, oldest first, so clients poll with the last id they saw"""
+    query = db.query(models.BudgetAlert).filter(
+        models.BudgetAlert.user_id == user_id, models.BudgetAlert.id > after_id
+    )
+    if unread:
+        query = query.filter(models.BudgetAlert.read_at == None)
+    return [
+        schemas.BudgetAlert(
+            id=alert.id, budget_id=alert.budget_id, category=alert.category, month=alert.month,
+            threshold=alert.threshold, spent=from_minor(alert.spent_minor), limit=from_minor(alert.limit_minor),
+            created_at=alert.created_at, read=alert.read_at is not None
+        )
+        for alert in query.order_by(models.BudgetAlert.id).limit(limit)
+    ]
+
+
+def mark_read(db: Session, user_id: str, up_to_id: int) -> int:
+    count = db.query(models.BudgetAlert).filter(
+        models.BudgetAlert.user_id == user_id,
+        models.BudgetAlert.id <= up_to_id,
+        models.BudgetAlert.read_at == None
+    ).update({models.BudgetAlert.read_at: datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+    return count
+
+
+# Rebuild
+
+def rebuild(db: Session, user_id: Optional[str] = None, log=print) -> int:
+    """
+    Recompute the running totals of live receipts from scratch with the current rates,
+    one user at a time, and what each receipt counts for (receipts.budget_minor)
+    """
+    users = db.query(models.Receipt.user_id).filter(models.Receipt.user_id != None).distinct()
+    if user_id:
+        users = users.filter(models.Receipt.user_id == user_id)
+    count = 0
+    for (owner,) in users.all():
+        currency = fx.user_currency(db, owner)
+        rates: Dict[Tuple[date, Optional[str]], Optional[float]] = {}  # One conversion per (day, currency)
+        totals: Dict[Tuple[date, str], int] = defaultdict(int)
+        changed = []
+        for receipt_id, day, category, receipt_currency, amount, budget_minor in db.query(
+            models.Receipt.id, models.Receipt.date, models.Receipt.category, models.Receipt.currency,
+            minor_amount(models.Receipt.total_amount_minor, models.Receipt.total_amount), models.Receipt.budget_minor
+        ).filter(models.Receipt.user_id == owner):
+            added = None
+            if _counts(Entry(day, category, amount, receipt_currency)):
+                if (day, receipt_currency) not in rates:
+                    rates[(day, receipt_currency)] = fx.convert_amount(db, 1.0, receipt_currency, day, currency)
+                # The same product convert_amount computes, so `apply` agrees with it
+                rate = rates[(day, receipt_currency)]
+                added = round(float(amount) * rate) if rate is not None else 0
+                totals[(month_of(day), category or UNCATEGORIZED)] += added
+                totals[(month_of(day), ALL)] += added
+            if added != budget_minor:
+                changed.append({"id": receipt_id, "budget_minor": added})
+
+        db.query(models.SpendingTotal).filter(models.SpendingTotal.user_id == owner).delete(synchronize_session=False)
+        if totals:
+            db.execute(models.SpendingTotal.__table__.insert(), [
+                {"user_id": owner, "month": month, "category": category, "total_minor": total}
+                for (month, category), total in totals.items()
+            ])
+        for start in range(0, len(changed), 1000):
+            db.execute(update(models.Receipt).execution_options(synchronize_session=False), changed[start:start + 1000])
+        db.commit()
+        count += 1
+        log(f"{owner}: {len(totals)} totals")
+    return count
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--user", help="only this user")
+    args = parser.parse_args(argv)
+
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        print(f"Users rebuilt: {rebuild(db, user_id=args.user)}")
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,43 @@
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+import threading
+
+_MISSING = object()
+
+
+class UserCache:
+    """
+    In-process LRU cache of per-user computed results.
+
+    Every entry is stored with the data fingerprint it was computed from; a lookup with
+    a different fingerprint is a miss, so results are reused exactly until the user's
+    data changes, even when the write happened on another worker.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, Hashable], Tuple[Hashable, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str, key: Hashable, fingerprint: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get((user_id, key), _MISSING)
+            if entry is _MISSING or entry[0] != fingerprint:
+                return default
+            self._entries.move_to_end((user_id, key))
+            return entry[1]
+
+    def set(self, user_id: str, key: Hashable, fingerprint: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[(user_id, key)] = (fingerprint, value)
+            self._entries.move_to_end((user_id, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str, key: Optional[Hashable] = None) -> None:
+        with self._lock:
+            if key is not None:
+                self._entries.pop((user_id, key), None)
+                return
+            for cache_key in [k for k in self._entries if k[0] == user_id]:
+                del self._entries[cache_key]
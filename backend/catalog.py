@@ -0,0 +1,427 @@
+"""
+Product catalog and item price history.
+
+Item names are free text ("Lait Délice 1L", "lait delice"), so every priced item of
+a dated receipt is resolved to a canonical Product of its user: the name is
+normalized (case, accents, punctuation, plurals, and pack sizes to one unit:
+"1L" and "1000 ml" both read "1000ml"), looked up exactly, then fuzzy-matched
+against the user's products of the same size before a new one is created. Sizes
+stay in the key, so the 1L and 6x1L packs of a milk are two products with their
+own price history.
+
+Each resolved line is copied into product_prices with the receipt's date, merchant
+and currency. That table is indexed on (user_id, product_id, date), so price
+history and cheapest-merchant queries are index range scans over one product's
+rows and never touch receipts or items, however many line items a user has.
+
+services keeps the index in sync when receipts and items change: names already in
+the catalog are indexed with the write, and a receipt with new names is queued for
+the index_receipt job, which fuzzy-matches or creates their products. Price rows are
+kept when archive.py moves old receipts out, so history also covers archived
+months. Existing data is indexed with `rebuild`, which also re-keys products
+whose key was normalized by an earlier version of `normalize`.
+
+Usage:
+    python catalog.py status
+    python catalog.py rebuild [--user USER_ID] [--batch-size 1000]
+"""
+import argparse
+import difflib
+import re
+import sys
+import unicodedata
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import exists, func, insert, update
+from sqlalchemy.orm import Session
+
+import fx
+import models
+import schemas
+from database import insert_for
+from money import from_minor, to_minor
+
+# Minimum difflib ratio for a name to join an existing product
+FUZZY_CUTOFF = 0.88
+
+# Pack sizes and counts: "1l", "1.5 kg", "500g", "x6", "6x", "2pcs"
+PACK_SIZE = re.compile(
+    r"\b(?:x\s*(\d+)|(\d+(?:[.,]\d+)?)\s*(x|kg|mg|gr|g|cl|ml|lt|l|pcs|pc|pk)?)\b"
+)
+# Unit of a pack size -> (key unit, factor)
+UNITS = {
+    "kg": ("g", 1000), "g": ("g", 1), "gr": ("g", 1), "mg": ("g", 0.001),
+    "l": ("ml", 1000), "lt": ("ml", 1000), "cl": ("ml", 10), "ml": ("ml", 1),
+    "x": ("x", 1), "pcs": ("x", 1), "pc": ("x", 1), "pk": ("x", 1),
+}
+# Size tokens of a key: "1000ml", "500g", "x6", or a bare number
+SIZE_TOKEN = re.compile(r"^(?:x\d+|\d+(?:\.\d+)?(?:g|ml)?)$")
+
+
+def _size(match: re.Match) -> str:
+    if match[1]:
+        return f" x{int(match[1])} "
+    number = match[2].replace(",", ".")
+    if not match[3]:
+        return f" {number} "
+    unit, factor = UNITS[match[3]]
+    if unit == "x":
+        return f" x{number} "
+    return f" {float(number) * factor:g}{unit} "
+
+
+def normalize(name: str) -> str:
+    """Catalog key of an item name: lowercase ASCII words in order, pack sizes in grams, ml or counts"""
+    text = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode().lower()
+    text = PACK_SIZE.sub(_size, re.sub(r"(\d)x(?=\d)", r"\1x ", text))  # "6x1l": a count, then a size
+    words = []
+    for word in re.findall(r"\d+(?:\.\d+)?[a-z]*|[a-z0-9]+", text):
+        if word.isalpha():
+            if len(word) > 4 and word.endswith(("ies", "oes")):
+                word = word[:-3] + ("y" if word.endswith("ies") else "o")
+            elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+                word = word[:-1]
+        if word not in words:
+            words.append(word)
+    return " ".join(words)
+
+
+def sizes(key: str) -> tuple:
+    """The pack size tokens of a key, in order"""
+    return tuple(word for word in key.split() if SIZE_TOKEN.match(word))
+
+
+class Resolver:
+    """
+    Maps item names to product ids for one user, creating products as needed. With
+    exact=True only names whose key is already in the catalog resolve; the others
+    are counted in `missed` and left for a fuzzy pass (the index_receipt job).
+    """
+
+    def __init__(self, db: Session, user_id: str, exact: bool = False):
+        self.db = db
+        self.user_id = user_id
+        self.exact = exact
+        self.missed = 0
+        self.keys: Dict[str, int] = {}
+        self._loaded = False
+
+    def _load(self) -> None:
+        # The whole catalog is only needed for fuzzy matching, after an exact miss
+        self.keys.update(self.db.query(models.Product.key, models.Product.id).filter(
+            models.Product.user_id == self.user_id
+        ).all())
+        self._loaded = True
+
+    def _create(self, key: str, name: str) -> int:
+        self.db.execute(insert_for(self.db, models.Product).values(
+            user_id=self.user_id, key=key, name=name.strip()
+        ).on_conflict_do_nothing(index_elements=["user_id", "key"]))
+        return self.db.query(models.Product.id).filter(
+            models.Product.user_id == self.user_id, models.Product.key == key
+        ).scalar()
+
+    def prefetch(self, names: Iterable[str]) -> None:
+        """Exact lookups for a batch of names in one query"""
+        keys = {normalize(name) for name in names} - self.keys.keys()
+        if keys and not self._loaded:
+            self.keys.update(self.db.query(models.Product.key, models.Product.id).filter(
+                models.Product.user_id == self.user_id, models.Product.key.in_(keys)
+            ).all())
+
+    def resolve(self, name: str) -> Optional[int]:
+        key = normalize(name)
+        if not key:
+            return None
+        product_id = self.keys.get(key)
+        if product_id is None and self.exact:
+            # prefetch has looked the key up already
+            self.missed += 1
+            return None
+        if product_id is None and not self._loaded:
+            self._load()
+            product_id = self.keys.get(key)
+        if product_id is None:
+            # Only against products of the same size: "lait 500ml" is close to "lait 1000ml"
+            size = sizes(key)
+            candidates = [known for known in self.keys if sizes(known) == size]
+            match = difflib.get_close_matches(key, candidates, n=1, cutoff=FUZZY_CUTOFF)
+            product_id = self.keys[match[0]] if match else self._create(key, name)
+            self.keys[key] = product_id
+        return product_id
+
+
+def _price_rows(resolver: Resolver, receipt, items) -> List[dict]:
+    priced = [item for item in items if item.name and item.price and item.price > 0]
+    resolver.prefetch(item.name for item in priced)
+    rows = []
+    for item in priced:
+        product_id = resolver.resolve(item.name)
+        if product_id is None:
+            continue
+        rows.append({
+            "user_id": receipt.user_id,
+            "product_id": product_id,
+            "receipt_id": receipt.id,
+            "item_id": item.id,
+            "date": receipt.date,
+            "merchant_name": receipt.merchant_name,
+            "currency": receipt.currency,
+            "price_minor": item.price_minor if item.price_minor is not None else to_minor(item.price),
+            "quantity": item.quantity or 1,
+        })
+    return rows
+
+
+def unindex_receipt(db: Session, receipt_id: int) -> Set[int]:
+    """Remove the price rows of a receipt; returns the products they belonged to"""
+    return unindex_receipts(db, [receipt_id])
+
+
+def unindex_receipts(db: Session, receipt_ids: List[int]) -> Set[int]:
+    """`unindex_receipt` for many receipts in two statements"""
+    rows = db.query(models.ProductPrice).filter(models.ProductPrice.receipt_id.in_(receipt_ids))
+    product_ids = {row[0] for row in rows.with_entities(models.ProductPrice.product_id)}
+    if product_ids:
+        rows.delete(synchronize_session=False)
+    return product_ids
+
+
+def index_receipt(db: Session, receipt: models.Receipt, resolver: Optional[Resolver] = None) -> Set[int]:
+    """
+    Replace the price rows of a receipt from its current items; the caller commits.
+    Returns the products whose history changed (previously or now on the receipt).
+    Items the resolver leaves unresolved (exact=True) get no price rows.
+    """
+    db.flush()  # Sessions do not autoflush; pending item changes must be visible below
+    # The receipt's row lock orders concurrent re-indexing (a request and the job), so
+    # neither inserts its rows next to the other's
+    db.query(models.Receipt.id).filter(models.Receipt.id == receipt.id).with_for_update().scalar()
+    product_ids = unindex_receipt(db, receipt.id)
+    if receipt.date is None or not receipt.user_id:
+        return product_ids
+    items = db.query(models.Item).filter(models.Item.receipt_id == receipt.id).all()
+    rows = _price_rows(resolver or Resolver(db, receipt.user_id), receipt, items)
+    if rows:
+        db.execute(insert(models.ProductPrice), rows)
+    return product_ids | {row["product_id"] for row in rows}
+
+
+# Queries
+
+def _product(db: Session, user_id: str, product_id: int) -> Optional[schemas.Product]:
+    row = db.query(
+        models.Product.id, models.Product.name,
+        func.count(models.ProductPrice.id), func.max(models.ProductPrice.date)
+    ).outerjoin(
+        models.ProductPrice,
+        (models.ProductPrice.user_id == models.Product.user_id) & (models.ProductPrice.product_id == models.Product.id)
+    ).filter(
+        models.Product.id == product_id, models.Product.user_id == user_id
+    ).group_by(models.Product.id, models.Product.name).first()
+    if row is None:
+        return None
+    return schemas.Product(id=row[0], name=row[1], purchases=row[2], last_date=row[3])
+
+
+def _unit_price(currency: str):
+    """Price in `currency`, NULL without a rate: those purchases are left out of prices"""
+    return fx.converted(models.ProductPrice.price_minor, models.ProductPrice.currency, models.ProductPrice.date, currency)
+
+
+def search_products(db: Session, user_id: str, q: Optional[str] = None, limit: int = 50) -> List[schemas.Product]:
+    """Products of a user, most purchased first, optionally filtered by name"""
+    query = db.query(
+        models.Product.id, models.Product.name,
+        func.count(models.ProductPrice.id), func.max(models.ProductPrice.date)
+    ).outerjoin(
+        models.ProductPrice,
+        (models.ProductPrice.user_id == models.Product.user_id) & (models.ProductPrice.product_id == models.Product.id)
+    ).filter(models.Product.user_id == user_id)
+    if q:
+        for word in normalize(q).split():
+            query = query.filter(models.Product.key.contains(word))
+    rows = query.group_by(models.Product.id, models.Product.name).order_by(
+        func.count(models.ProductPrice.id).desc(), models.Product.name
+    ).limit(limit).all()
+    return [schemas.Product(id=row[0], name=row[1], purchases=row[2], last_date=row[3]) for row in rows]
+
+
+def price_history(
+    db: Session,
+    user_id: str,
+    product_id: int,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None
+) -> Optional[schemas.PriceHistory]:
+    """Every purchase of a product, oldest first, in the user's currency"""
+    product = _product(db, user_id, product_id)
+    if product is None:
+        return None
+    currency = fx.user_currency(db, user_id)
+    query = db.query(
+        models.ProductPrice.date, models.ProductPrice.merchant_name, _unit_price(currency),
+        models.ProductPrice.quantity, models.ProductPrice.receipt_id
+    ).filter(
+        models.ProductPrice.user_id == user_id,
+        models.ProductPrice.product_id == product_id
+    )
+    if start_date:
+        query = query.filter(models.ProductPrice.date >= start_date)
+    if end_date:
+        query = query.filter(models.ProductPrice.date <= end_date)
+    points = [
+        schemas.PricePoint(date=row[0], merchant_name=row[1], price=from_minor(row[2]), quantity=row[3], receipt_id=row[4])
+        for row in query.order_by(models.ProductPrice.date, models.ProductPrice.id).all() if row[2] is not None
+    ]
+    prices = [point.price for point in points]
+    return schemas.PriceHistory(
+        product=product,
+        points=points,
+        min_price=min(prices) if prices else None,
+        max_price=max(prices) if prices else None,
+        avg_price=round(sum(prices) / len(prices), 3) if prices else None,
+        currency=currency
+    )
+
+
+def cheapest_merchants(
+    db: Session,
+    user_id: str,
+    product_id: int,
+    since: Optional[date] = None,
+    limit: int = 5
+) -> Optional[schemas.CheapestMerchants]:
+    """Merchants where the user bought a product, lowest average unit price first"""
+    product = _product(db, user_id, product_id)
+    if product is None:
+        return None
+    currency = fx.user_currency(db, user_id)
+    price = _unit_price(currency)
+    query = db.query(
+        models.ProductPrice.merchant_name, func.min(price), func.avg(price),
+        func.count(models.ProductPrice.id), func.max(models.ProductPrice.date)
+    ).filter(
+        models.ProductPrice.user_id == user_id,
+        models.ProductPrice.product_id == product_id,
+        models.ProductPrice.merchant_name != None
+    )
+    if since:
+        query = query.filter(models.ProductPrice.date >= since)
+    rows = query.group_by(models.ProductPrice.merchant_name).order_by(func.avg(price).nulls_last(), func.min(price)).limit(limit).all()
+    return schemas.CheapestMerchants(
+        product=product,
+        merchants=[
+            schemas.MerchantPrice(
+                merchant_name=row[0], min_price=from_minor(row[1]), avg_price=from_minor(row[2]),
+                purchases=row[3], last_date=row[4]
+            )
+            for row in rows if row[1] is not None
+        ],
+        since=since,
+        currency=currency
+    )
+
+
+# Backfill
+
+def rekey(db: Session, user_id: Optional[str] = None) -> int:
+    """
+    Give products the key `normalize` now computes from their name; returns products
+    re-keyed. A key another product of the user already has is left alone: `rebuild`
+    then indexes the lines under that other product.
+    """
+    query = db.query(models.Product.id, models.Product.user_id, models.Product.key, models.Product.name)
+    if user_id:
+        query = query.filter(models.Product.user_id == user_id)
+    rows = query.order_by(models.Product.id).all()
+    taken = {(owner, key) for _, owner, key, _ in rows}
+    changed = []
+    for product_id, owner, key, name in rows:
+        new = normalize(name)
+        if new and (owner, new) not in taken:
+            taken.add((owner, new))
+            changed.append({"id": product_id, "key": new})
+    for start in range(0, len(changed), 1000):
+        db.execute(update(models.Product).execution_options(synchronize_session=False), changed[start:start + 1000])
+    db.commit()
+    return len(changed)
+
+
+def rebuild(db: Session, user_id: Optional[str] = None, batch_size: int = 1000, log=print) -> int:
+    """
+    Re-key products, then (re)index every dated receipt, in id order and batches, and
+    drop the products no price row uses any more; safe to interrupt and re-run
+    """
+    rekeyed = rekey(db, user_id)
+    if rekeyed:
+        log(f"Re-keyed {rekeyed} products")
+    resolvers: Dict[str, Resolver] = {}
+    last_id, total = 0, 0
+    while True:
+        query = db.query(models.Receipt).filter(
+            models.Receipt.id > last_id, models.Receipt.date != None
+        )
+        if user_id:
+            query = query.filter(models.Receipt.user_id == user_id)
+        receipts = query.order_by(models.Receipt.id).limit(batch_size).all()
+        if not receipts:
+            break
+        ids = [receipt.id for receipt in receipts]
+        items: Dict[int, list] = {}
+        for item in db.query(models.Item).filter(models.Item.receipt_id.in_(ids)):
+            items.setdefault(item.receipt_id, []).append(item)
+
+        db.query(models.ProductPrice).filter(models.ProductPrice.receipt_id.in_(ids)).delete(synchronize_session=False)
+        rows = []
+        for receipt in receipts:
+            if not receipt.user_id:
+                continue
+            if receipt.user_id not in resolvers:
+                if len(resolvers) >= 1000:
+                    resolvers.clear()
+                resolvers[receipt.user_id] = Resolver(db, receipt.user_id)
+            rows.extend(_price_rows(resolvers[receipt.user_id], receipt, items.get(receipt.id, [])))
+        if rows:
+            db.execute(insert(models.ProductPrice), rows)
+        db.commit()
+        db.expunge_all()
+
+        last_id = ids[-1]
+        total += len(rows)
+        log(f"Indexed receipts up to id {last_id}: {total} price rows")
+
+    unused = db.query(models.Product).filter(
+        ~exists().where(models.ProductPrice.product_id == models.Product.id)
+    )
+    if user_id:
+        unused = unused.filter(models.Product.user_id == user_id)
+    dropped = unused.delete(synchronize_session=False)
+    db.commit()
+    if dropped:
+        log(f"Dropped {dropped} products without prices")
+    return total
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "rebuild"])
+    parser.add_argument("--user", help="only this user's receipts")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        if args.command == "rebuild":
+            rebuild(db, user_id=args.user, batch_size=args.batch_size)
+        print(f"Products:     {db.query(func.count(models.Product.id)).scalar()}")
+        print(f"Price rows:   {db.query(func.count(models.ProductPrice.id)).scalar()}")
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+"""
+Duplicate receipt detection.
+
+The same purchase is often recorded twice: typed in and then uploaded, or imported
+again after a retry. Each receipt carries two indexed keys:
+
+- `fingerprint`: 32 hex characters. The first 16 hash the normalized merchant, date,
+  amount and currency; the last 16 hash the multiset of items (normalized name,
+  quantity, price), so item order and spelling variants do not matter.
+- `image_hash`: a 64-bit difference hash (dHash) of the uploaded image, equal for
+  the same picture re-encoded or resized. It needs Pillow; without it, and for
+  PDFs, it stays empty. Hashes are compared for equality, an index lookup: a
+  near-duplicate image (the receipt photographed twice, cropped or rotated)
+  differs in a few bits and is not matched by it, only by the fingerprint.
+
+Two receipts of a user are likely duplicates when their images hash the same, or
+when merchant, date and amount match and their items do too, or one of them has
+none (a quick manual entry next to a scanned receipt). Both checks are range
+lookups on the (user_id, fingerprint) and (user_id, image_hash) indexes, so
+create_receipt reports them without scanning the user's receipts.
+
+Receipts written before the columns existed are filled in by `backfill` (the
+find_duplicates job runs it before listing duplicates across the table, or for one
+user when GET /receipts/duplicates finds some of theirs `pending`).
+
+Usage:
+    python duplicates.py status
+    python duplicates.py scan [--user USER_ID] [--batch-size 1000]
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sys
+from typing import Iterable, List, Optional
+
+from sqlalchemy import func, or_, tuple_
+from sqlalchemy.orm import Session
+
+import catalog
+import merchants
+import models
+import tracing
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+HEAD = 16  # Hex characters of the merchant/date/amount part of a fingerprint
+HASH_SIZE = 8  # dHash grid: 8x8 comparisons, 64 bits
+
+
+def _digest(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=HEAD // 2).hexdigest()
+
+
+EMPTY_ITEMS = _digest("")
+
+
+def fingerprint(merchant_name: Optional[str], day, amount_minor: Optional[int], currency: Optional[str],
+                items: Iterable) -> str:
+    """Fingerprint of a receipt; `items` have name, quantity and price_minor"""
+    head = _digest(f"{merchants.normalize(merchant_name or '')}|{day}|{amount_minor}|{currency}")
+    lines = sorted(
+        f"{catalog.normalize(item.name or '')}|{item.quantity or 1}|{item.price_minor or 0}" for item in items
+    )
+    return head + (_digest("\n".join(lines)) if lines else EMPTY_ITEMS)
+
+
+def _pillow():
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+
+def image_hash(image_url: Optional[str]) -> Optional[str]:
+    """dHash of an uploaded image as 16 hex characters; None without Pillow, for PDFs or unreadable files"""
+    import jobs
+    from startup import UPLOAD_DIR
+    filename = jobs.upload_filename(image_url)
+    Image = _pillow()
+    if not filename or Image is None or filename.lower().endswith(".pdf"):
+        return None
+    try:
+        with tracing.span("storage.read", {"storage.path": filename}, root=False), \
+                Image.open(os.path.join(UPLOAD_DIR, filename)) as image:
+            # JPEG decoders can scale down while decoding, much cheaper than a full-size decode
+            image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+            pixels = list(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE)).getdata())
+    except Exception as e:
+        logger.warning(f"Could not hash image {filename}: {e}")
+        return None
+    bits = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            bits = bits << 1 | (left > pixels[row * (HASH_SIZE + 1) + column + 1])
+    # A blank or single-colour image carries no information to match on
+    return f"{bits:016x}" if bits else None
+
+
+def refresh(db: Session, receipt: models.Receipt, items: Optional[List[models.Item]] = None) -> None:
+    """Recompute a receipt's fingerprint from its current items; the caller commits"""
+    if items is None:
+        items = db.query(models.Item).filter(models.Item.receipt_id == receipt.id).all()
+    receipt.fingerprint = fingerprint(
+        receipt.merchant_name, receipt.date, receipt.total_amount_minor, receipt.currency, items
+    )
+
+
+def refresh_many(db: Session, receipt_ids: List[int]) -> None:
+    """`refresh` for many receipts, with their items read in one query; the caller commits"""
+    receipts = db.query(models.Receipt).filter(models.Receipt.id.in_(receipt_ids)).all()
+    items = {}
+    for item in db.query(models.Item).filter(models.Item.receipt_id.in_(receipt_ids)):
+        items.setdefault(item.receipt_id, []).append(item)
+    for receipt in receipts:
+        refresh(db, receipt, items.get(receipt.id, []))
+
+
+def _matches(a: str, b: str) -> bool:
+    """Whether two fingerprints with the same head describe the same purchase"""
+    return a == b or a[HEAD:] == EMPTY_ITEMS or b[HEAD:] == EMPTY_ITEMS
+
+
+def find(db: Session, receipt: models.Receipt) -> List[int]:
+    """Ids of the user's other receipts that are likely duplicates of this one"""
+    conditions = []
+    if receipt.fingerprint:
+        head = receipt.fingerprint[:HEAD]
+        conditions.append(models.Receipt.fingerprint.between(head + "0" * HEAD, head + "f" * HEAD))
+    if receipt.image_hash:
+        conditions.append(models.Receipt.image_hash == receipt.image_hash)
+    if not conditions:
+        return []
+    rows = db.query(models.Receipt.id, models.Receipt.fingerprint, models.Receipt.image_hash).filter(
+        models.Receipt.user_id == receipt.user_id, models.Receipt.id != receipt.id, or_(*conditions)
+    ).order_by(models.Receipt.id).all()
+    return [
+        row.id for row in rows
+        if (receipt.image_hash and row.image_hash == receipt.image_hash)
+        or (row.fingerprint and receipt.fingerprint and row.fingerprint[:HEAD] == receipt.fingerprint[:HEAD]
+            and _matches(row.fingerprint, receipt.fingerprint))
+    ]
+
+
+def backfill(db: Session, user_id: Optional[str] = None, batch_size: int = BATCH_SIZE, log=None) -> int:
+    """Fill missing fingerprints and image hashes, in id order and committed batches; returns receipts filled"""
+    last_id, total = 0, 0
+    while True:
+        query = db.query(models.Receipt.id, models.Receipt.image_url).filter(
+            models.Receipt.id > last_id, models.Receipt.fingerprint == None
+        )
+        if user_id:
+            query = query.filter(models.Receipt.user_id == user_id)
+        rows = query.order_by(models.Receipt.id).limit(batch_size).all()
+        if not rows:
+            return total
+        refresh_many(db, [row.id for row in rows])
+        for row in rows:
+            if row.image_url:
+                db.get(models.Receipt, row.id).image_hash = image_hash(row.image_url)
+        db.commit()
+        last_id, total = rows[-1].id, total + len(rows)
+        if log:
+            log(f"Fingerprinted {total} receipts")
+
+
+def pending(db: Session, user_id: str) -> int:
+    """Receipts of a user that `backfill` has not fingerprinted yet"""
+    return db.query(func.count(models.Receipt.id)).filter(
+        models.Receipt.user_id == user_id, models.Receipt.fingerprint == None
+    ).scalar()
+
+
+def _runs(db: Session, column, user_id: Optional[str], batch_size: int):
+    """
+    Receipts in (user_id, column) order, read in keyset batches off the index, as
+    runs of rows sharing user_id and the first HEAD characters of the column.
+    """
+    last = None
+    run: list = []
+    while True:
+        query = db.query(models.Receipt.user_id, column, models.Receipt.id).filter(
+            models.Receipt.user_id != None, column != None
+        )
+        if user_id:
+            query = query.filter(models.Receipt.user_id == user_id)
+        if last is not None:
+            query = query.filter(tuple_(models.Receipt.user_id, column, models.Receipt.id) > last)
+        rows = query.order_by(models.Receipt.user_id, column, models.Receipt.id).limit(batch_size).all()
+        for row in rows:
+            if run and (run[0][0], run[0][1][:HEAD]) != (row[0], row[1][:HEAD]):
+                yield run
+                run = []
+            run.append(tuple(row))
+        if len(rows) < batch_size:
+            break
+        last = tuple(rows[-1])
+    if run:
+        yield run
+
+
+def _fingerprint_groups(run: list) -> List[List[int]]:
+    """Split a run sharing a head into duplicate groups: by item multiset, receipts without items join all"""
+    by_items = {}
+    for _, value, receipt_id in run:
+        by_items.setdefault(value[HEAD:], []).append(receipt_id)
+    bare = by_items.pop(EMPTY_ITEMS, [])
+    if not by_items:
+        return [bare] if len(bare) > 1 else []
+    return [ids + bare for ids in by_items.values() if len(ids) + len(bare) > 1]
+
+
+def scan(db: Session, user_id: Optional[str] = None, batch_size: int = BATCH_SIZE) -> List[List[int]]:
+    """Groups of likely duplicate receipt ids, for one user or the whole table; overlapping groups are merged"""
+    groups = []
+    for run in _runs(db, models.Receipt.fingerprint, user_id, batch_size):
+        groups += _fingerprint_groups(run)
+    for run in _runs(db, models.Receipt.image_hash, user_id, batch_size):
+        if len(run) > 1:
+            groups.append([receipt_id for _, _, receipt_id in run])
+
+    # Receipts matching by fingerprint and by image end up in one group (union-find over ids)
+    parent = {}
+
+    def root(receipt_id):
+        while parent.setdefault(receipt_id, receipt_id) != receipt_id:
+            parent[receipt_id] = receipt_id = parent[parent[receipt_id]]
+        return receipt_id
+
+    for group in groups:
+        for receipt_id in group[1:]:
+            parent[root(receipt_id)] = root(group[0])
+    merged = {}
+    for receipt_id in parent:
+        merged.setdefault(root(receipt_id), []).append(receipt_id)
+    return sorted(sorted(group) for group in merged.values())
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "scan"])
+    parser.add_argument("--user", help="only this user's receipts")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    from database import shard_engines, shard_session
+    total = missing = hashed = 0
+    for name in shard_engines:
+        db = shard_session(name)
+        try:
+            if args.command == "scan":
+                backfill(db, args.user, args.batch_size, log=print)
+                groups = scan(db, args.user, args.batch_size)
+                for group in groups:
+                    print(f"{name}: duplicates " + ", ".join(map(str, group)))
+                print(f"{name}: {len(groups)} groups, {sum(map(len, groups))} receipts")
+            total += db.query(func.count(models.Receipt.id)).scalar()
+            missing += db.query(func.count(models.Receipt.id)).filter(models.Receipt.fingerprint == None).scalar()
+            hashed += db.query(func.count(models.Receipt.id)).filter(models.Receipt.image_hash != None).scalar()
+        finally:
+            db.close()
+    print(f"Receipts:           {total}")
+    print(f"Not fingerprinted:  {missing}")
+    print(f"Image hashes:       {hashed}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
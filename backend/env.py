@@ -0,0 +1,10 @@
+"""
+Loads .env into os.environ, once per process.
+
+Modules read their configuration from the environment at import, so every module
+that does, and every entry point (main.py, the CLIs), imports this first. Values
+already set in the environment win over .env.
+"""
+from dotenv import load_dotenv
+
+load_dotenv()
@@ -0,0 +1,248 @@
+"""
+Live change events for Server-Sent Events streams.
+
+Every committed write to receipts, items or income is turned into small events
+({"type": "receipt", "action": "created", "id": 12}) by session hooks, without
+touching the services: after_flush records the changed rows in session.info and
+after_commit publishes them, so rolled-back writes are never announced. Writes that
+bypass the session (bulk query updates) call `record` themselves.
+
+Brokers deliver events to the subscribers of a user:
+
+- LocalBroker: per process. Subscribers are bounded asyncio queues on the event
+  loop; publishers run in request threads and hand events over with
+  call_soon_threadsafe. An idle subscriber costs one queue and one suspended
+  coroutine, so a worker holds thousands of open streams.
+- SharedBroker: publishes to a pub/sub channel (Redis, EVENTS_BACKEND=redis, needs
+  the optional `redis` package) that every worker listens to and fans out to its
+  own LocalBroker, so a write on one worker reaches streams on all of them.
+  StandInPubSub implements the same publish/subscribe calls in-process
+  (EVENTS_BACKEND=standin) for tests and single-host setups.
+
+Events are not persisted: a client that reconnects (or receives a "resync" event
+after falling behind) should refetch what it displays.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import event
+
+import env
+import models
+from database import RoutingSession
+
+logger = logging.getLogger(__name__)
+
+EVENTS_BACKEND = os.getenv("EVENTS_BACKEND", "memory")
+EVENTS_REDIS_URL = os.getenv("EVENTS_REDIS_URL", "redis://localhost:6379/0")
+CHANNEL = "spendlog:events"
+
+# Events buffered per subscriber before it is told to resync instead
+QUEUE_SIZE = 100
+
+# Model -> event type; the row's user_id says whose streams receive it
+TRACKED = {
+    models.Receipt: "receipt",
+    models.Item: "item",
+    models.Income: "income",
+}
+
+
+class Subscription:
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.queue: "asyncio.Queue[dict]" = asyncio.Queue(QUEUE_SIZE)
+        self.overflowed = False
+
+    def put(self, payload: dict) -> None:
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self, timeout: float) -> Optional[dict]:
+        """Next event, {"type": "resync"} after an overflow, or None on timeout"""
+        if self.overflowed and self.queue.empty():
+            self.overflowed = False
+            return {"type": "resync"}
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class LocalBroker:
+    """Subscribers of this process, keyed by user; all state lives on the event loop"""
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def subscribe(self, user_id: str) -> Subscription:
+        self._loop = asyncio.get_running_loop()
+        subscription = Subscription(user_id)
+        self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscribers = self._subscribers.get(subscription.user_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.user_id]
+
+    def connections(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def deliver(self, user_id: str, events: List[dict]) -> None:
+        """Push events to a user's subscribers; must run on the event loop"""
+        for subscription in self._subscribers.get(user_id, ()):
+            for payload in events:
+                subscription.put(payload)
+
+    def publish(self, user_id: str, events: List[dict]) -> None:
+        """Safe to call from request threads"""
+        # Unlocked read: at worst an event races a subscriber that is just connecting
+        if self._loop is None or user_id not in self._subscribers:
+            return
+        self._loop.call_soon_threadsafe(self.deliver, user_id, events)
+
+    async def close(self) -> None:
+        pass
+
+
+class SharedBroker(LocalBroker):
+    """
+    Publishes through a shared pub/sub client (redis.asyncio or StandInPubSub); a
+    listener task per worker delivers every message to the local subscribers.
+    Broker errors are logged and the event is dropped; writes never fail on them.
+    """
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        self._listener: Optional[asyncio.Task] = None
+
+    def subscribe(self, user_id: str) -> Subscription:
+        subscription = super().subscribe(user_id)
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+        return subscription
+
+    async def _listen(self) -> None:
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(CHANNEL)
+        async for message in pubsub.listen():
+            if message.get("type") != "message":
+                continue
+            try:
+                data = json.loads(message["data"])
+                self.deliver(data["user_id"], data["events"])
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Malformed event message: {e}")
+
+    async def _send(self, message: str) -> None:
+        try:
+            await self.client.publish(CHANNEL, message)
+        except Exception as e:
+            logger.warning(f"Event broker error: {e}")
+
+    def publish(self, user_id: str, events: List[dict]) -> None:
+        # Streams may be open on other workers, so publish even without local subscribers
+        if self._loop is None:
+            return
+        message = json.dumps({"user_id": user_id, "events": events})
+        self._loop.call_soon_threadsafe(lambda: self._loop.create_task(self._send(message)))
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+
+
+class StandInPubSub:
+    """In-process stand-in for the Redis pub/sub calls SharedBroker uses"""
+
+    def __init__(self):
+        self._queues: Dict[str, List[asyncio.Queue]] = {}
+
+    async def publish(self, channel: str, message: str) -> int:
+        queues = self._queues.get(channel, [])
+        for queue in queues:
+            queue.put_nowait({"type": "message", "channel": channel, "data": message})
+        return len(queues)
+
+    def pubsub(self):
+        return _StandInSubscriber(self)
+
+
+class _StandInSubscriber:
+    def __init__(self, hub: StandInPubSub):
+        self.hub = hub
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    async def subscribe(self, channel: str) -> None:
+        self.hub._queues.setdefault(channel, []).append(self.queue)
+        await self.queue.put({"type": "subscribe", "channel": channel, "data": 1})
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
+
+
+def build_broker() -> LocalBroker:
+    if EVENTS_BACKEND == "redis":
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("EVENTS_BACKEND=redis requires the redis package (pip install redis)")
+        return SharedBroker(redis.from_url(EVENTS_REDIS_URL, decode_responses=True))
+    if EVENTS_BACKEND == "standin":
+        return SharedBroker(StandInPubSub())
+    return LocalBroker()
+
+
+broker = build_broker()
+
+
+def attach(loop: asyncio.AbstractEventLoop) -> None:
+    """Let request threads publish before the first stream connects (called by the lifespan)"""
+    broker._loop = loop
+
+
+# Session hooks
+
+def record(session, user_id: Optional[str], type_: str, action: str, id_: Optional[int]) -> None:
+    """Queue an event on a session, published when it commits"""
+    if user_id:
+        pending = session.info.setdefault("events", {})
+        payload = {"type": type_, "action": action, "id": id_}
+        if payload not in pending.setdefault(user_id, []):
+            pending[user_id].append(payload)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _collect(session, flush_context):
+    for rows, action in ((session.new, "created"), (session.dirty, "updated"), (session.deleted, "deleted")):
+        for row in rows:
+            type_ = TRACKED.get(type(row))
+            if type_ is None:
+                continue
+            if action == "updated" and not session.is_modified(row, include_collections=False):
+                continue
+            record(session, row.user_id, type_, action, row.id)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _publish(session):
+    pending = session.info.pop("events", None)
+    if pending:
+        for user_id, events in pending.items():
+            broker.publish(user_id, events)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _discard(session):
+    session.info.pop("events", None)
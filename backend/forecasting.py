@@ -0,0 +1,203 @@
+"""
+Cash-flow forecasting.
+
+Recurring series (salary, rent, subscriptions...) are detected per merchant / income
+source from the regularity of their intervals and amounts. The balance is projected
+forward from those series plus the average of the remaining, irregular cash flow,
+with confidence bands widening as the variance accumulates month over month.
+"""
+from datetime import date
+from statistics import NormalDist
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import func, union_all
+from sqlalchemy.orm import Session
+
+import analytics
+import fx
+import models
+import schemas
+from cache import UserCache
+
+# Series detection thresholds
+MIN_OCCURRENCES = 3
+MIN_PERIOD_DAYS = 6      # weekly
+MAX_PERIOD_DAYS = 95     # quarterly
+MAX_INTERVAL_CV = 0.2    # interval std / mean
+MAX_AMOUNT_CV = 0.25     # amount std / mean
+
+# Irregular cash flow is averaged over this many trailing months
+RESIDUAL_MONTHS = 12
+
+forecast_cache = UserCache()
+
+
+def data_fingerprint(db: Session, user_id: str):
+    """
+    Cheap aggregate that changes whenever a user's receipts or income change: count
+    and max id catch inserts and deletes, max(updated_at) edits of any row and field
+    """
+    receipts = db.query(
+        func.count(models.Receipt.id), func.max(models.Receipt.id),
+        func.sum(models.Receipt.total_amount), func.max(models.Receipt.updated_at)
+    ).filter(models.Receipt.user_id == user_id)
+    incomes = db.query(
+        func.count(models.Income.id), func.max(models.Income.id),
+        func.sum(models.Income.amount), func.max(models.Income.updated_at)
+    ).filter(models.Income.user_id == user_id)
+    return tuple(tuple(row) for row in db.execute(union_all(receipts.statement, incomes.statement)).all())
+
+
+def detect_recurring(history: analytics.History, today: date):
+    """
+    Find regular series per (kind, merchant/source).
+    Returns (series_index, row_is_recurring) where series_index holds one entry per
+    detected series as parallel arrays.
+    """
+    n = len(history)
+    if n == 0:
+        return None, np.zeros(0, dtype=bool)
+
+    groups = history.kinds.astype(np.int64) * len(history.merchant_names) + history.merchants
+    days = history.days.astype(np.int64)
+    order = np.lexsort((days, groups))
+    g, d, amounts = groups[order], days[order], history.amounts[order]
+
+    counts = np.bincount(g)
+    n_groups = len(counts)
+
+    # Intervals between consecutive occurrences within the same group
+    same = g[1:] == g[:-1]
+    intervals = (d[1:] - d[:-1])[same].astype(np.float64)
+    interval_groups = g[1:][same]
+    n_intervals = np.bincount(interval_groups, minlength=n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_interval = np.bincount(interval_groups, weights=intervals, minlength=n_groups) / n_intervals
+        interval_var = np.bincount(interval_groups, weights=intervals ** 2, minlength=n_groups) / n_intervals - mean_interval ** 2
+        mean_amount = np.bincount(g, weights=amounts, minlength=n_groups) / counts
+        amount_var = np.bincount(g, weights=amounts ** 2, minlength=n_groups) / counts - mean_amount ** 2
+        interval_cv = np.sqrt(np.maximum(interval_var, 0)) / mean_interval
+        amount_cv = np.sqrt(np.maximum(amount_var, 0)) / mean_amount
+
+    last_index = np.r_[np.flatnonzero(~same), len(g) - 1]
+    last_day = np.zeros(n_groups, dtype=np.int64)
+    last_day[g[last_index]] = d[last_index]
+    today_day = np.datetime64(today, 'D').astype(np.int64)
+
+    recurring = (
+        (counts >= MIN_OCCURRENCES)
+        & (mean_interval >= MIN_PERIOD_DAYS) & (mean_interval <= MAX_PERIOD_DAYS)
+        & (interval_cv <= MAX_INTERVAL_CV) & (amount_cv <= MAX_AMOUNT_CV)
+        # Still active: the next occurrence is not long overdue
+        & (today_day - last_day <= 2 * mean_interval)
+    )
+
+    series = np.flatnonzero(recurring)
+    last_row = np.empty(n_groups, dtype=np.int64)
+    last_row[g[last_index]] = order[last_index]
+    index = {
+        "group": series,
+        "row": last_row[series],
+        "kind": (series // max(len(history.merchant_names), 1)).astype(np.int8),
+        "period": mean_interval[series],
+        "amount": mean_amount[series],
+        "amount_std": np.sqrt(np.maximum(amount_var[series], 0)),
+        "count": counts[series],
+        "last_day": last_day[series],
+    }
+    return index, recurring[groups]
+
+
+def _month_index(days: np.ndarray) -> np.ndarray:
+    return days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+
+
+def project(history: analytics.History, months: int, confidence: float, today: date) -> schemas.CashFlowForecast:
+    """Project the monthly balance for the next `months` months"""
+    series, row_is_recurring = detect_recurring(history, today)
+    sign = np.where(history.kinds == analytics.KIND_INCOME, 1.0, -1.0)
+    starting_balance = float((history.amounts * sign).sum())
+
+    today_day = np.datetime64(today, 'D').astype(np.int64)
+    current_month = np.datetime64(today, 'M').astype(np.int64)
+    horizon = current_month + 1 + np.arange(months)
+    horizon_end = np.datetime64(int(horizon[-1]) + 1, 'M').astype('datetime64[D]').astype(np.int64)
+
+    projected = np.zeros((2, months))
+    variance = np.zeros(months)
+    recurring = []
+    if series is not None and len(series["group"]):
+        # Future occurrence dates per series as a [n_series, k] grid
+        periods = series["period"]
+        steps = int(np.ceil((horizon_end - series["last_day"].min()) / periods.min())) + 1
+        k = np.arange(1, steps + 1)
+        occurrence_days = series["last_day"][:, None] + np.rint(periods[:, None] * k[None, :]).astype(np.int64)
+        # Occurrences still due later this month are folded into the first projected month
+        month_of = np.maximum(_month_index(occurrence_days) - horizon[0], 0)
+        in_horizon = (occurrence_days > today_day) & (month_of < months)
+
+        per_series = np.broadcast_to(np.arange(len(periods))[:, None], occurrence_days.shape)
+        s_idx, m_idx = per_series[in_horizon], month_of[in_horizon]
+        np.add.at(projected, (series["kind"][s_idx], m_idx), series["amount"][s_idx])
+        np.add.at(variance, m_idx, series["amount_std"][s_idx] ** 2)
+
+        next_days = occurrence_days[:, 0]
+        for i in np.argsort(-series["amount"], kind='stable'):
+            row = series["row"][i]
+            recurring.append(schemas.RecurringSeries(
+                kind="income" if series["kind"][i] == analytics.KIND_INCOME else "expense",
+                name=history.merchant_names[history.merchants[row]],
+                category=history.category_names[history.categories[row]],
+                period_days=round(float(periods[i]), 1),
+                amount=round(float(series["amount"][i]), 2),
+                occurrences=int(series["count"][i]),
+                last_date=np.datetime64(int(series["last_day"][i]), 'D').item(),
+                next_date=np.datetime64(int(next_days[i]), 'D').item()
+            ))
+
+    # Irregular cash flow: mean and variance of trailing monthly totals per kind
+    months_back = _month_index(history.days) - (current_month - RESIDUAL_MONTHS)
+    window = (~row_is_recurring) & (months_back >= 0) & (months_back < RESIDUAL_MONTHS)
+    residual = np.zeros((2, RESIDUAL_MONTHS))
+    np.add.at(residual, (history.kinds[window], months_back[window]), history.amounts[window])
+    projected += residual.mean(axis=1)[:, None]
+    net_residual = residual[analytics.KIND_INCOME] - residual[analytics.KIND_SPENT]
+    variance += net_residual.var()
+
+    net = projected[analytics.KIND_INCOME] - projected[analytics.KIND_SPENT]
+    balance = starting_balance + np.cumsum(net)
+    band = NormalDist().inv_cdf((1 + confidence) / 2) * np.sqrt(np.cumsum(variance))
+
+    return schemas.CashFlowForecast(
+        starting_balance=round(starting_balance, 2),
+        confidence=confidence,
+        recurring=recurring,
+        months=[
+            schemas.ForecastPoint(
+                month=np.datetime64(int(horizon[i]), 'M').astype('datetime64[D]').item(),
+                income=round(float(projected[analytics.KIND_INCOME][i]), 2),
+                spending=round(float(projected[analytics.KIND_SPENT][i]), 2),
+                balance=round(float(balance[i]), 2),
+                lower=round(float(balance[i] - band[i]), 2),
+                upper=round(float(balance[i] + band[i]), 2)
+            )
+            for i in range(months)
+        ]
+    )
+
+
+def get_forecast(db: Session, user_id: str, months: int = 6, confidence: float = 0.8, today: Optional[date] = None) -> schemas.CashFlowForecast:
+    """Cached cash-flow forecast; recomputed only when the user's data fingerprint changes"""
+    today = today or date.today()
+    currency = fx.user_currency(db, user_id)
+    fingerprint = (data_fingerprint(db, user_id), fx.rate_cache.fingerprint(db), currency, today)
+    key = ("forecast", months, confidence)
+
+    forecast = forecast_cache.get(user_id, key, fingerprint)
+    if forecast is None:
+        history = analytics.load_history(db, user_id, currency=currency)
+        forecast = project(history, months, confidence, today)
+        forecast.currency = currency
+        forecast_cache.set(user_id, key, fingerprint, forecast)
+    return forecast
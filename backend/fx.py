@@ -0,0 +1,245 @@
+"""
+Currency conversion against the local exchange_rates table.
+
+Rates are loaded from a CSV file (`python fx.py rates.csv`) or the admin endpoint,
+into every shard; there is no live rate service. SQL aggregates convert each row with an as-of
+lookup (latest rate on or before the row's date), and vectorized paths use the
+in-memory RateCache so conversion never happens row by row in Python.
+"""
+import csv
+import sys
+import threading
+import time
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import case, func, or_, select
+from sqlalchemy.orm import Session
+
+import models
+import schemas
+
+DEFAULT_CURRENCY = "TND"
+
+
+def user_currency(db: Session, user_id: str) -> str:
+    """The user's settings currency, without creating a settings row"""
+    currency = db.query(models.Settings.currency).filter(models.Settings.user_id == user_id).scalar()
+    return currency or DEFAULT_CURRENCY
+
+
+def user_currencies(db: Session, user_ids: Iterable[str]) -> Dict[str, str]:
+    """`user_currency` for many users in one query"""
+    user_ids = set(user_ids)
+    found = dict(db.query(models.Settings.user_id, models.Settings.currency).filter(models.Settings.user_id.in_(user_ids)))
+    return {user_id: found.get(user_id) or DEFAULT_CURRENCY for user_id in user_ids}
+
+
+def _as_of_rate(base, quote, on_date):
+    return select(models.ExchangeRate.rate).where(
+        models.ExchangeRate.base_currency == base,
+        models.ExchangeRate.quote_currency == quote,
+        models.ExchangeRate.date <= on_date
+    ).order_by(models.ExchangeRate.date.desc()).limit(1).scalar_subquery()
+
+
+def converted(amount, currency, on_date, target: str):
+    """
+    SQL expression converting `amount` (in `currency` at `on_date`) into `target`.
+    Uses the direct pair, then the inverse pair, and is NULL when no rate is known,
+    so SUM and AVG leave the amount out rather than adding it in another currency
+    (COUNT(amount) - COUNT(converted) counts those rows).
+
+    The rates are correlated scalar subqueries rather than a join on exchange_rates:
+    an as-of join needs LATERAL, which SQLite lacks, and each subquery is one index
+    seek on (base, quote, date) per row, the same work the join would do.
+    """
+    direct = _as_of_rate(currency, target, on_date)
+    inverse = 1.0 / _as_of_rate(target, currency, on_date)
+    return case(
+        (or_(currency == None, currency == target), amount),
+        else_=amount * func.coalesce(direct, inverse)
+    )
+
+
+class RateCache:
+    """
+    Process-wide copy of the exchange_rates table as sorted NumPy arrays per pair,
+    so whole columns can be converted with one searchsorted per currency.
+    Reloaded after `ttl` seconds or when rates are written through this process.
+    """
+
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self.signature = 0
+        self._pairs: Dict[Tuple[str, str], Tuple[np.ndarray, np.ndarray]] = {}
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._loaded_at = 0.0
+
+    def _refresh(self, db: Session) -> None:
+        with self._lock:
+            if time.monotonic() - self._loaded_at < self.ttl:
+                return
+            rows = db.query(
+                models.ExchangeRate.base_currency,
+                models.ExchangeRate.quote_currency,
+                models.ExchangeRate.date,
+                models.ExchangeRate.rate
+            ).order_by(
+                models.ExchangeRate.base_currency,
+                models.ExchangeRate.quote_currency,
+                models.ExchangeRate.date
+            ).all()
+            grouped: Dict[Tuple[str, str], Tuple[List[date], List[float]]] = {}
+            for base, quote, day, rate in rows:
+                days, rates = grouped.setdefault((base, quote), ([], []))
+                days.append(day)
+                rates.append(rate)
+            pairs = {
+                pair: (np.array(days, dtype='datetime64[D]'), np.array(rates, dtype=np.float64))
+                for pair, (days, rates) in grouped.items()
+            }
+            self.signature = hash(tuple(tuple(row) for row in rows))
+            self._pairs = pairs
+            self._loaded_at = time.monotonic()
+
+    def fingerprint(self, db: Session) -> int:
+        """Changes whenever the loaded rate table changes; for result caches that depend on rates"""
+        self._refresh(db)
+        return self.signature
+
+    def _as_of(self, base: str, quote: str, days: np.ndarray) -> np.ndarray:
+        series = self._pairs.get((base, quote))
+        if series is None:
+            return np.full(len(days), np.nan)
+        idx = np.searchsorted(series[0], days, side='right') - 1
+        return np.where(idx >= 0, series[1][np.maximum(idx, 0)], np.nan)
+
+    def _lookup(self, base: str, quote: str, days: np.ndarray) -> np.ndarray:
+        rates = self._as_of(base, quote, days)
+        missing = np.isnan(rates)
+        if missing.any():
+            rates[missing] = 1.0 / self._as_of(quote, base, days[missing])
+        return rates
+
+    def convert(self, db: Session, amounts: np.ndarray, currencies: np.ndarray, currency_names: List[str],
+                days: np.ndarray, target: str) -> np.ndarray:
+        """
+        Convert amounts into `target`, matching the SQL `converted` semantics: NaN
+        where no rate is known. `currencies` holds codes into `currency_names`; one
+        lookup runs per distinct currency.
+        """
+        self._refresh(db)
+        result = amounts.astype(np.float64, copy=True)
+        for code, name in enumerate(currency_names):
+            if not name or name == target:
+                continue
+            mask = currencies == code
+            result[mask] *= self._lookup(name, target, days[mask])
+        return result
+
+
+rate_cache = RateCache()
+
+
+def convert_amount(db: Session, amount: float, currency: Optional[str], on_date: date, target: str) -> Optional[float]:
+    """Convert a single amount with the cached rates (same semantics as `converted`: None without a rate)"""
+    if not currency or currency == target:
+        return float(amount)
+    result = float(rate_cache.convert(
+        db, np.array([amount], dtype=np.float64), np.zeros(1, dtype=np.int64), [currency],
+        np.array([on_date], dtype='datetime64[D]'), target
+    )[0])
+    return None if np.isnan(result) else result
+
+
+def upsert_rates(db: Session, rates: Iterable[schemas.ExchangeRateCreate]) -> int:
+    """Insert or update rates keyed by (base, quote, date); returns the number of rows written"""
+    rates = list(rates)
+    if not rates:
+        return 0
+    pairs = {(r.base_currency.upper(), r.quote_currency.upper()) for r in rates}
+    existing = {
+        (row.base_currency, row.quote_currency, row.date): row
+        for row in db.query(models.ExchangeRate).filter(
+            or_(*[
+                (models.ExchangeRate.base_currency == base) & (models.ExchangeRate.quote_currency == quote)
+                for base, quote in pairs
+            ])
+        )
+    }
+    for rate in rates:
+        key = (rate.base_currency.upper(), rate.quote_currency.upper(), rate.date)
+        row = existing.get(key)
+        if row:
+            row.rate = rate.rate
+        else:
+            row = existing[key] = models.ExchangeRate(
+                base_currency=key[0], quote_currency=key[1], date=key[2], rate=rate.rate
+            )
+            db.add(row)
+    db.commit()
+    rate_cache.invalidate()
+    return len(rates)
+
+
+def replicate_rates(rates: List[schemas.ExchangeRateCreate]) -> None:
+    """Write rates to every shard but main: SQL conversions join exchange_rates in the user's own database"""
+    from database import MAIN_SHARD, shard_engines, shard_session
+    for name in shard_engines:
+        if name == MAIN_SHARD:
+            continue
+        db = shard_session(name)
+        try:
+            upsert_rates(db, rates)
+        finally:
+            db.close()
+
+
+def get_rates(db: Session, base: Optional[str] = None, quote: Optional[str] = None,
+              start_date: Optional[date] = None, end_date: Optional[date] = None) -> List[models.ExchangeRate]:
+    query = db.query(models.ExchangeRate)
+    if base:
+        query = query.filter(models.ExchangeRate.base_currency == base.upper())
+    if quote:
+        query = query.filter(models.ExchangeRate.quote_currency == quote.upper())
+    if start_date:
+        query = query.filter(models.ExchangeRate.date >= start_date)
+    if end_date:
+        query = query.filter(models.ExchangeRate.date <= end_date)
+    return query.order_by(
+        models.ExchangeRate.base_currency, models.ExchangeRate.quote_currency, models.ExchangeRate.date
+    ).all()
+
+
+def load_csv(db: Session, path: str) -> int:
+    """Load a CSV with columns date,base_currency,quote_currency,rate"""
+    with open(path, newline="") as f:
+        rates = [
+            schemas.ExchangeRateCreate(
+                date=row["date"],
+                base_currency=row["base_currency"],
+                quote_currency=row["quote_currency"],
+                rate=row["rate"]
+            )
+            for row in csv.DictReader(f)
+        ]
+    return upsert_rates(db, rates)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python fx.py rates.csv")
+        sys.exit(1)
+    from database import shard_engines, shard_session
+    for name in shard_engines:
+        session = shard_session(name)
+        try:
+            print(f"{name}: loaded {load_csv(session, sys.argv[1])} exchange rates")
+        finally:
+            session.close()
@@ -0,0 +1,431 @@
+"""
+Database-backed background jobs for slow side effects.
+
+Jobs are rows in `jobs`, so they survive restarts and are visible through the API
+(/jobs) and this module's CLI. JobRunner, started by the app lifespan, runs them in
+a fixed number of worker slots with optional per-kind limits. Failed jobs are retried
+with exponential backoff until max_attempts, then marked dead. A running job whose
+worker died becomes claimable again after VISIBILITY_TIMEOUT, so handlers must be
+idempotent.
+
+Usage:
+    python jobs.py status
+    python jobs.py run                 # run due jobs in this process until the queue is empty
+    python jobs.py retry JOB_ID [...]  # re-queue dead jobs
+    python jobs.py enqueue KIND [JSON] # e.g. enqueue archive_receipts '{"before": "2023-01-01"}'
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import and_, event, func, or_
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+import env
+import archive
+import models
+import tracing
+from database import RoutingSession
+from startup import UPLOAD_DIR
+
+logger = logging.getLogger(__name__)
+
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "4"))
+# Run the job workers inside the API process; disable when a separate worker runs `run`
+JOB_WORKER = os.getenv("JOB_WORKER", "true").lower() in ("1", "true", "yes")
+POLL_INTERVAL = 2.0
+VISIBILITY_TIMEOUT = timedelta(minutes=10)
+RETRY_BACKOFF = 5.0        # seconds, doubled per attempt
+MAX_RETRY_DELAY = 3600.0
+DELETE_BATCH_SIZE = 1000
+
+# Kinds that may not use every slot at once
+KIND_CONCURRENCY = {"delete_user": 2}
+
+Handler = Callable[[Session, Dict[str, Any]], Optional[Dict[str, Any]]]
+HANDLERS: Dict[str, Handler] = {}
+
+
+def job(kind: str):
+    """Register a handler: fn(db, payload) -> optional result dict"""
+    def register(fn: Handler) -> Handler:
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+def enqueue(db: Session, kind: str, payload: Dict[str, Any], user_id: Optional[str] = None,
+            max_attempts: int = 5, delay: float = 0, commit: bool = True) -> models.Job:
+    """
+    Add a job; with commit=False it is written atomically with the caller's
+    transaction, and idle workers are woken when that commits.
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    db_job = models.Job(
+        kind=kind, user_id=user_id, payload=payload, status="queued", attempts=0,
+        max_attempts=max_attempts, run_after=datetime.utcnow() + timedelta(seconds=delay),
+        traceparent=tracing.traceparent()
+    )
+    db.add(db_job)
+    if commit:
+        db.commit()
+        db.refresh(db_job)
+    else:
+        db.flush()
+        db.info["jobs_queued"] = True
+    return db_job
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _notify_queued(session):
+    if session.info.pop("jobs_queued", False):
+        notify()
+
+
+def claim(db: Session, worker_id: str, exclude_kinds: List[str] = ()) -> Optional[models.Job]:
+    """
+    Take the oldest due job. The claim is a conditional UPDATE on the row's previous
+    state, so two workers (or processes) never both win the same job.
+    """
+    now = datetime.utcnow()
+    due = or_(
+        and_(models.Job.status == "queued", models.Job.run_after <= now),
+        and_(models.Job.status == "running", models.Job.locked_at < now - VISIBILITY_TIMEOUT)
+    )
+    query = db.query(models.Job.id, models.Job.status, models.Job.locked_at).filter(due)
+    if exclude_kinds:
+        query = query.filter(models.Job.kind.notin_(list(exclude_kinds)))
+    for job_id, status, locked_at in query.order_by(models.Job.run_after, models.Job.id).limit(10):
+        previous_lock = models.Job.locked_at.is_(None) if locked_at is None else models.Job.locked_at == locked_at
+        claimed = db.query(models.Job).filter(
+            models.Job.id == job_id, models.Job.status == status, previous_lock
+        ).update({
+            "status": "running", "locked_by": worker_id, "locked_at": now,
+            "attempts": models.Job.attempts + 1
+        }, synchronize_session=False)
+        db.commit()
+        if claimed:
+            return db.get(models.Job, job_id)
+    return None
+
+
+def execute(db: Session, db_job: models.Job) -> None:
+    """Run a claimed job and record success, a scheduled retry, or a dead job"""
+    # The job continues the trace of the request that queued it
+    with tracing.span(f"job {db_job.kind}", {"job.id": db_job.id, "job.attempt": db_job.attempts},
+                      kind=tracing.CONSUMER, parent=tracing.extract(db_job.traceparent)):
+        _execute(db, db_job)
+
+
+def _execute(db: Session, db_job: models.Job) -> None:
+    job_id, kind, payload = db_job.id, db_job.kind, dict(db_job.payload)
+    try:
+        result = HANDLERS[kind](db, payload)
+    except Exception as e:
+        tracing.record_error(e)
+        db.rollback()
+        db_job = db.get(models.Job, job_id)
+        db_job.last_error = f"{type(e).__name__}: {e}"[:1000]
+        db_job.locked_by = db_job.locked_at = None
+        if db_job.attempts >= db_job.max_attempts:
+            db_job.status = "dead"
+            db_job.finished_at = datetime.utcnow()
+            logger.error(f"Job {job_id} ({kind}) dead after {db_job.attempts} attempts: {e}")
+        else:
+            delay = min(RETRY_BACKOFF * 2 ** (db_job.attempts - 1), MAX_RETRY_DELAY)
+            db_job.status = "queued"
+            db_job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+            logger.warning(f"Job {job_id} ({kind}) failed, retry in {delay:.0f}s: {e}")
+        db.commit()
+        return
+
+    db_job = db.get(models.Job, job_id)
+    db_job.status = "succeeded"
+    db_job.result = result
+    db_job.last_error = None
+    db_job.locked_by = db_job.locked_at = None
+    db_job.finished_at = datetime.utcnow()
+    db.commit()
+
+
+class JobRunner:
+    """Worker slots polling the jobs table of every shard; one per process is started by the lifespan"""
+
+    def __init__(self, concurrency: int = JOB_CONCURRENCY, poll_interval: float = POLL_INTERVAL):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._running: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._turn = itertools.count()
+
+    def notify(self) -> None:
+        """Wake idle slots; safe to call from request threads"""
+        if self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _saturated_kinds(self) -> List[str]:
+        return [kind for kind, limit in KIND_CONCURRENCY.items() if self._running.get(kind, 0) >= limit]
+
+    def run_next(self) -> bool:
+        """Claim and run one job in the calling thread; False when nothing was due"""
+        from database import shard_engines, shard_session
+        shards = list(shard_engines)
+        # Each call starts at the next shard, so a busy shard does not starve the others
+        start = next(self._turn) % len(shards)
+        for name in shards[start:] + shards[:start]:
+            db = shard_session(name)
+            try:
+                with self._lock:
+                    db_job = claim(db, self.worker_id, self._saturated_kinds())
+                    if db_job is None:
+                        continue
+                    kind = db_job.kind
+                    self._running[kind] = self._running.get(kind, 0) + 1
+                try:
+                    execute(db, db_job)
+                finally:
+                    with self._lock:
+                        self._running[kind] -= 1
+                return True
+            finally:
+                db.close()
+        return False
+
+    async def _slot(self) -> None:
+        while True:
+            try:
+                ran = await run_in_threadpool(self.run_next)
+            except Exception as e:
+                logger.error(f"Job runner error: {e}")
+                ran = False
+            if ran:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        await asyncio.gather(*[self._slot() for _ in range(self.concurrency)])
+
+
+runner = JobRunner()
+
+
+def notify() -> None:
+    """Wake idle workers after enqueueing"""
+    runner.notify()
+
+
+def get_jobs(db: Session, status: Optional[str] = None, kind: Optional[str] = None,
+             user_id: Optional[str] = None, limit: int = 100) -> List[models.Job]:
+    query = db.query(models.Job)
+    if status:
+        query = query.filter(models.Job.status == status)
+    if kind:
+        query = query.filter(models.Job.kind == kind)
+    if user_id:
+        query = query.filter(models.Job.user_id == user_id)
+    return query.order_by(models.Job.id.desc()).limit(limit).all()
+
+
+def retry(db: Session, job_ids: List[int]) -> int:
+    """Re-queue dead jobs with a fresh attempt budget"""
+    count = db.query(models.Job).filter(models.Job.id.in_(job_ids), models.Job.status == "dead").update({
+        "status": "queued", "attempts": 0, "run_after": datetime.utcnow(), "finished_at": None
+    }, synchronize_session=False)
+    db.commit()
+    return count
+
+
+# Handlers
+
+def _delete_in_batches(db: Session, model, *criteria) -> int:
+    """Delete matching rows DELETE_BATCH_SIZE at a time, committing each batch to keep locks short"""
+    total = 0
+    while True:
+        ids = [row_id for (row_id,) in db.query(model.id).filter(*criteria).limit(DELETE_BATCH_SIZE)]
+        if not ids:
+            return total
+        db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        total += len(ids)
+
+
+def upload_filename(url: Optional[str]) -> Optional[str]:
+    """File name under UPLOAD_DIR for an image_url served from /uploads, else None"""
+    if not url or "/uploads/" not in url:
+        return None
+    return os.path.basename(url.split("/uploads/", 1)[1])
+
+
+# Tables whose rows belong to a user through a user_id column (receipts are handled separately)
+USER_OWNED = [
+    models.Item, models.Income, models.Settings,
+    models.PurchasePattern, models.ProductPrice, models.Product,
+    models.MerchantAlias, models.Merchant,
+    models.BudgetAlert, models.Budget, models.SpendingTotal,
+    models.RecurringTemplate,
+]
+
+
+@job("delete_user")
+def delete_user(db: Session, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Delete every row and upload of a user, then the Supabase Auth account"""
+    import supabase_client
+
+    user_id = payload["user_id"]
+    deleted: Dict[str, int] = {}
+
+    # Receipts batch by batch: queue their files, then drop their items and the receipts
+    deleted["receipts"] = deleted["files_queued"] = 0
+    while True:
+        batch = db.query(models.Receipt.id, models.Receipt.image_url).filter(
+            models.Receipt.user_id == user_id
+        ).limit(DELETE_BATCH_SIZE).all()
+        if not batch:
+            break
+        ids = [row.id for row in batch]
+        files = [name for name in (upload_filename(row.image_url) for row in batch) if name]
+        if files:
+            enqueue(db, "delete_uploads", {"filenames": files}, user_id=user_id, commit=False)
+            deleted["files_queued"] += len(files)
+        db.query(models.Item).filter(models.Item.receipt_id.in_(ids)).delete(synchronize_session=False)
+        db.query(models.Receipt).filter(models.Receipt.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        deleted["receipts"] += len(ids)
+
+    for model in USER_OWNED:
+        deleted[model.__tablename__] = _delete_in_batches(db, model, model.user_id == user_id)
+    deleted["archived"] = archive.purge_user(db, user_id)
+    db.commit()
+
+    # The job runs on the user's shard; their users row and directory entry are on main
+    from database import MAIN_SHARD, shard_engines, shard_session
+    main = db if db.bind is shard_engines[MAIN_SHARD] else shard_session(MAIN_SHARD)
+    try:
+        deleted["users"] = main.query(models.User).filter(models.User.id == user_id).delete(synchronize_session=False)
+        main.query(models.UserShard).filter(models.UserShard.user_id == user_id).delete(synchronize_session=False)
+        main.commit()
+    finally:
+        if main is not db:
+            main.close()
+
+    # Last, so a Supabase outage only retries this step (the local deletes above are no-ops on retry)
+    try:
+        deleted["auth"] = int(supabase_client.get_client().delete_user(user_id))
+    except supabase_client.NotConfiguredError:
+        logger.warning("Supabase credentials not found. Auth deletion skipped.")
+        deleted["auth"] = 0
+    return deleted
+
+
+@job("archive_receipts")
+def archive_receipts(db: Session, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Create upcoming receipt partitions, then move months older than the cutoff to the Parquet archive"""
+    import partitions
+    from database import engine
+
+    created = partitions.ensure(engine)
+    before = date.fromisoformat(payload["before"]) if payload.get("before") else None
+    return {"partitions_created": created, "archived": archive.run(db, before)}
+
+
+@job("find_duplicates")
+def find_duplicates(db: Session, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Fingerprint receipts that have none, then list likely duplicates across the table or of payload["user_id"]"""
+    import duplicates
+    fingerprinted = duplicates.backfill(db, payload.get("user_id"))
+    groups = duplicates.scan(db, payload.get("user_id"))
+    logger.info(f"find_duplicates: {len(groups)} groups of likely duplicate receipts")
+    return {
+        "fingerprinted": fingerprinted,
+        "groups": len(groups),
+        "receipts": sum(map(len, groups)),
+        "sample": groups[:100],
+    }
+
+
+@job("index_receipt")
+def index_receipt(db: Session, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Index a receipt's prices with fuzzy matching, for names the request found no exact product for"""
+    import catalog
+    import suggestions
+    receipt = db.get(models.Receipt, payload["receipt_id"])
+    if receipt is None:
+        return {"products": 0}
+    product_ids = catalog.index_receipt(db, receipt)
+    suggestions.refresh(db, receipt.user_id, product_ids)
+    db.commit()
+    return {"products": len(product_ids)}
+
+
+@job("delete_uploads")
+def delete_uploads(db: Session, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Remove files from UPLOAD_DIR; files already gone count as removed"""
+    upload_dir = os.path.abspath(UPLOAD_DIR)
+    removed = 0
+    with tracing.span("storage.delete", {"storage.files": len(payload["filenames"])}) as span:
+        for filename in payload["filenames"]:
+            path = os.path.abspath(os.path.join(upload_dir, filename))
+            if os.path.dirname(path) != upload_dir:
+                logger.warning(f"Refusing to delete {filename!r} outside {UPLOAD_DIR}")
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        span.set_attribute("storage.removed", removed)
+    return {"removed": removed}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "run", "retry", "enqueue"])
+    parser.add_argument("args", nargs="*", help="retry: JOB_ID ...; enqueue: KIND [JSON payload]")
+    args = parser.parse_args(argv)
+
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        if args.command == "retry":
+            print(f"Re-queued {retry(db, [int(job_id) for job_id in args.args])} jobs")
+        elif args.command == "enqueue":
+            if not args.args:
+                parser.error("enqueue needs KIND")
+            payload = json.loads(args.args[1]) if len(args.args) > 1 else {}
+            print(f"Queued job {enqueue(db, args.args[0], payload).id}")
+        elif args.command == "run":
+            ran = 0
+            while runner.run_next():
+                ran += 1
+            print(f"Ran {ran} jobs")
+        counts = db.query(models.Job.kind, models.Job.status, func.count(models.Job.id)).group_by(
+            models.Job.kind, models.Job.status
+        ).all()
+        for kind, status, count in counts:
+            print(f"{kind:<20}{status:<12}{count:>8}")
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
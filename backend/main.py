@@ -1,28 +1,37 @@
+import env  # First: the modules below read their configuration at import
+from startup import profile, lifespan, state, check_database, UPLOAD_DIR
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
-import os
-from dotenv import load_dotenv
-load_dotenv()
-import models
-from database import engine
-from api import receipts, income, settings
-from api import webhooks
-from api import users
-from api import items
-
-# Create tables
-models.Base.metadata.create_all(bind=engine)
-
-# Create uploads directory if it doesn't exist
-UPLOAD_DIR = "uploads"
-if not os.path.exists(UPLOAD_DIR):
-    os.makedirs(UPLOAD_DIR)
-
-app = FastAPI()
+from ratelimit import RateLimitMiddleware
+from tracing import TracingMiddleware
+with profile.phase("import_routers"):
+    from api import receipts, income, settings
+    from api import webhooks
+    from api import users
+    from api import items
+    from api import analytics
+    from api import fx
+    from api import jobs
+    from api import products
+    from api import merchants
+    from api import budgets
+    from api import events
+    from api import recurring
+
+# Schema changes are applied by `python -m migrations` before deploy, never at startup.
+# The uploads directory and database warm-up are handled by the lifespan (see startup.py).
+
+app = FastAPI(lifespan=lifespan)
 
 # Mount static files for uploads
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR, check_dir=False), name="uploads")
+
+# Per-user rate limits and concurrency caps (see ratelimit.py); added before CORS so
+# that CORS wraps it and 429 responses still carry CORS headers
+app.add_middleware(RateLimitMiddleware)
 
 # Configure CORS
 app.add_middleware(
@@ -36,12 +45,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request spans (see tracing.py); added last so the span covers every other middleware
+app.add_middleware(TracingMiddleware)
+
 app.include_router(receipts.router)
 app.include_router(income.router)
 app.include_router(settings.router)
 app.include_router(webhooks.router)
 app.include_router(users.router)
 app.include_router(items.router)
+app.include_router(analytics.router)
+app.include_router(fx.router)
+app.include_router(jobs.router)
+app.include_router(products.router)
+app.include_router(merchants.router)
+app.include_router(budgets.router)
+app.include_router(events.router)
+app.include_router(recurring.router)
 
 @app.get("/")
 def root():
@@ -56,3 +76,10 @@ def root():
             "dashboard": "/receipts/dashboard/stats"
         }
     }
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: startup finished and the database answers"""
+    if not state["ready"] or not await run_in_threadpool(check_database):
+        return JSONResponse(status_code=503, content={"status": "starting", "startup": profile.report()})
+    return {"status": "ready", "startup": profile.report()}
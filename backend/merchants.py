@@ -0,0 +1,286 @@
+"""
+Canonical merchants.
+
+Receipts carry the merchant name as typed or scanned ("Carrefour", "CARREFOUR ",
+"Carrefour Market"). Each name is normalized (case, accents, punctuation, legal
+suffixes) and mapped to a Merchant of the user through merchant_aliases:
+
+1. exact alias hit;
+2. an existing merchant with the same key, or a close fuzzy match (a typo);
+3. otherwise a new merchant.
+
+The alias is recorded either way, so a name is only matched once. Receipts store
+the resulting merchant_id, which the dashboard groups on instead of the raw string.
+Merchants also carry a suggested category: the user's most used category for it.
+
+A name that extends another ("carrefour market" and "carrefour") is often the same
+merchant, but not always ("cafe de flore" is not any "cafe"), so such pairs are
+never merged automatically: `merge_suggestions` lists them for the user to confirm
+through the merge endpoint.
+
+create_receipt/update_receipt resolve names as they are written; older receipts are
+filled in by `normalize`.
+
+Usage:
+    python merchants.py status
+    python merchants.py normalize [--user USER_ID] [--batch-size 1000]
+"""
+import argparse
+import difflib
+import re
+import sys
+import unicodedata
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import models
+import schemas
+from database import insert_for
+
+FUZZY_CUTOFF = 0.85
+UNCATEGORIZED = schemas.ExpenseCategory.UNCATEGORIZED.value
+
+# Company forms that do not tell merchants apart
+LEGAL_SUFFIXES = {"sa", "sarl", "suarl", "sas", "ltd", "llc", "inc", "co", "corp", "gmbh"}
+
+
+def normalize(name: str) -> str:
+    """Alias key of a merchant name: lowercase ASCII words, without legal suffixes"""
+    text = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode().lower().replace(".", "")
+    words = [word for word in re.findall(r"[a-z0-9]+", text) if word not in LEGAL_SUFFIXES]
+    return " ".join(words)
+
+
+def display_name(name: str) -> str:
+    return " ".join(name.split())
+
+
+class Resolver:
+    """Maps merchant names to merchant ids for one user, creating merchants and aliases as needed"""
+
+    def __init__(self, db: Session, user_id: str):
+        self.db = db
+        self.user_id = user_id
+        self.aliases: Dict[str, int] = {}
+        self.merchants: Optional[Dict[str, int]] = None
+
+    def prefetch(self, names: Iterable[str]) -> None:
+        """Exact alias lookups for a batch of names in one query"""
+        keys = {normalize(name) for name in names if name} - self.aliases.keys()
+        if keys:
+            self.aliases.update(self.db.query(models.MerchantAlias.alias, models.MerchantAlias.merchant_id).filter(
+                models.MerchantAlias.user_id == self.user_id, models.MerchantAlias.alias.in_(keys)
+            ).all())
+
+    def _match(self, key: str) -> Optional[int]:
+        if self.merchants is None:
+            # Only needed after an alias miss
+            self.merchants = dict(self.db.query(models.Merchant.key, models.Merchant.id).filter(
+                models.Merchant.user_id == self.user_id
+            ).all())
+        if key in self.merchants:
+            return self.merchants[key]
+        match = difflib.get_close_matches(key, list(self.merchants), n=1, cutoff=FUZZY_CUTOFF)
+        return self.merchants[match[0]] if match else None
+
+    def _create(self, key: str, name: str) -> int:
+        self.db.execute(insert_for(self.db, models.Merchant).values(
+            user_id=self.user_id, key=key, name=display_name(name)
+        ).on_conflict_do_nothing(index_elements=["user_id", "key"]))
+        merchant_id = self.db.query(models.Merchant.id).filter(
+            models.Merchant.user_id == self.user_id, models.Merchant.key == key
+        ).scalar()
+        self.merchants[key] = merchant_id
+        return merchant_id
+
+    def resolve(self, name: Optional[str], create: bool = True) -> Optional[int]:
+        key = normalize(name) if name else ""
+        if not key:
+            return None
+        if key not in self.aliases:
+            self.prefetch([name])
+        merchant_id = self.aliases.get(key)
+        if merchant_id is None:
+            merchant_id = self._match(key)
+            if merchant_id is None:
+                if not create:
+                    return None
+                merchant_id = self._create(key, name)
+            if create:
+                self.db.execute(insert_for(self.db, models.MerchantAlias).values(
+                    user_id=self.user_id, alias=key, merchant_id=merchant_id
+                ).on_conflict_do_nothing(index_elements=["user_id", "alias"]))
+            self.aliases[key] = merchant_id
+        return merchant_id
+
+
+def resolve(db: Session, user_id: str, name: Optional[str]) -> Optional[int]:
+    """Merchant id for a receipt's merchant name; the caller commits"""
+    return Resolver(db, user_id).resolve(name)
+
+
+def suggest(db: Session, user_id: str, name: str) -> Optional[schemas.MerchantSuggestion]:
+    """Canonical merchant and suggested category for a name, without writing anything"""
+    merchant_id = Resolver(db, user_id).resolve(name, create=False)
+    if merchant_id is None:
+        return None
+    merchant = db.get(models.Merchant, merchant_id)
+    return schemas.MerchantSuggestion(id=merchant.id, name=merchant.name, category=merchant.category)
+
+
+def learn_category(db: Session, merchant_id: Optional[int], category: Optional[str]) -> None:
+    """Give a merchant its first category; `normalize` later replaces it with the most used one"""
+    if merchant_id is None or not category or category == UNCATEGORIZED:
+        return
+    db.query(models.Merchant).filter(
+        models.Merchant.id == merchant_id, models.Merchant.category == None
+    ).update({models.Merchant.category: category}, synchronize_session=False)
+
+
+def refresh_categories(db: Session, user_id: Optional[str] = None) -> int:
+    """Set each merchant's category to the category most of its receipts use"""
+    query = db.query(
+        models.Receipt.merchant_id, models.Receipt.category, func.count(models.Receipt.id)
+    ).filter(
+        models.Receipt.merchant_id != None,
+        models.Receipt.category != None,
+        models.Receipt.category != UNCATEGORIZED
+    )
+    if user_id:
+        query = query.filter(models.Receipt.user_id == user_id)
+    best: Dict[int, tuple] = {}
+    for merchant_id, category, count in query.group_by(models.Receipt.merchant_id, models.Receipt.category):
+        if merchant_id not in best or count > best[merchant_id][1]:
+            best[merchant_id] = (category, count)
+    for merchant_id, (category, _) in best.items():
+        db.query(models.Merchant).filter(models.Merchant.id == merchant_id).update(
+            {models.Merchant.category: category}, synchronize_session=False
+        )
+    db.commit()
+    return len(best)
+
+
+def get_merchants(db: Session, user_id: str) -> List[schemas.Merchant]:
+    """Merchants of a user with their receipt counts, most used first"""
+    rows = db.query(
+        models.Merchant.id, models.Merchant.name, models.Merchant.category, func.count(models.Receipt.id)
+    ).outerjoin(
+        models.Receipt,
+        (models.Receipt.user_id == models.Merchant.user_id) & (models.Receipt.merchant_id == models.Merchant.id)
+    ).filter(models.Merchant.user_id == user_id).group_by(
+        models.Merchant.id, models.Merchant.name, models.Merchant.category
+    ).order_by(func.count(models.Receipt.id).desc(), models.Merchant.name).all()
+    return [schemas.Merchant(id=row[0], name=row[1], category=row[2], receipts=row[3]) for row in rows]
+
+
+def merge(db: Session, user_id: str, source_id: int, target_id: int) -> bool:
+    """Fold one merchant into another: receipts and aliases move, the source is deleted"""
+    owned = db.query(func.count(models.Merchant.id)).filter(
+        models.Merchant.user_id == user_id, models.Merchant.id.in_([source_id, target_id])
+    ).scalar()
+    if source_id == target_id or owned != 2:
+        return False
+    db.query(models.Receipt).filter(
+        models.Receipt.user_id == user_id, models.Receipt.merchant_id == source_id
+    ).update({models.Receipt.merchant_id: target_id}, synchronize_session=False)
+    db.query(models.MerchantAlias).filter(models.MerchantAlias.merchant_id == source_id).update(
+        {models.MerchantAlias.merchant_id: target_id}, synchronize_session=False
+    )
+    db.query(models.RecurringTemplate).filter(
+        models.RecurringTemplate.user_id == user_id, models.RecurringTemplate.merchant_id == source_id
+    ).update({models.RecurringTemplate.merchant_id: target_id}, synchronize_session=False)
+    db.query(models.Merchant).filter(models.Merchant.id == source_id).delete(synchronize_session=False)
+    db.commit()
+    return True
+
+
+def merge_suggestions(db: Session, user_id: Optional[str] = None) -> List[schemas.MerchantMergeSuggestion]:
+    """
+    Merchants whose key extends a shorter merchant's ("carrefour market" after
+    "carrefour"), paired with the shortest such one. Sorted by code point, the keys a
+    key starts come right after it (a space sorts before letters and digits).
+    """
+    query = db.query(models.Merchant.user_id, models.Merchant.key, models.Merchant.id, models.Merchant.name)
+    if user_id:
+        query = query.filter(models.Merchant.user_id == user_id)
+    suggestions, root = [], None
+    # Sorted here: database collations may ignore spaces
+    for owner, key, merchant_id, name in sorted(query.all()):
+        if root and root[0] == owner and key.startswith(root[1] + " "):
+            suggestions.append(schemas.MerchantMergeSuggestion(
+                source_id=merchant_id, source_name=name, into_id=root[2], into_name=root[3]
+            ))
+        else:
+            root = (owner, key, merchant_id, name)
+    return suggestions
+
+
+# Batch normalizer
+
+def normalize_receipts(db: Session, user_id: Optional[str] = None, batch_size: int = 1000, log=print) -> int:
+    """
+    Fill receipts.merchant_id where missing, in id order and batches; safe to
+    interrupt and re-run.
+    """
+    resolvers: Dict[str, Resolver] = {}
+    last_id, total = 0, 0
+    while True:
+        query = db.query(models.Receipt.id, models.Receipt.user_id, models.Receipt.merchant_name).filter(
+            models.Receipt.id > last_id,
+            models.Receipt.merchant_id == None,
+            models.Receipt.user_id != None
+        )
+        if user_id:
+            query = query.filter(models.Receipt.user_id == user_id)
+        rows = query.order_by(models.Receipt.id).limit(batch_size).all()
+        if not rows:
+            break
+
+        by_merchant: Dict[int, List[int]] = {}
+        for receipt_id, owner, name in rows:
+            if owner not in resolvers:
+                if len(resolvers) >= 1000:
+                    resolvers.clear()
+                resolvers[owner] = Resolver(db, owner)
+            merchant_id = resolvers[owner].resolve(name)
+            if merchant_id is not None:
+                by_merchant.setdefault(merchant_id, []).append(receipt_id)
+        for merchant_id, ids in by_merchant.items():
+            db.query(models.Receipt).filter(models.Receipt.id.in_(ids)).update(
+                {models.Receipt.merchant_id: merchant_id}, synchronize_session=False
+            )
+        db.commit()
+
+        last_id = rows[-1][0]
+        total += sum(len(ids) for ids in by_merchant.values())
+        log(f"Normalized receipts up to id {last_id}: {total} linked")
+    refresh_categories(db, user_id)
+    return total
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "normalize"])
+    parser.add_argument("--user", help="only this user's receipts")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        if args.command == "normalize":
+            normalize_receipts(db, user_id=args.user, batch_size=args.batch_size)
+        print(f"Merchants:    {db.query(func.count(models.Merchant.id)).scalar()}")
+        print(f"Aliases:      {db.query(func.count(models.MerchantAlias.id)).scalar()}")
+        unlinked = db.query(func.count(models.Receipt.id)).filter(models.Receipt.merchant_id == None).scalar()
+        print(f"Unlinked:     {unlinked} receipts")
+        print(f"Suggested:    {len(merge_suggestions(db, args.user))} merges")
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
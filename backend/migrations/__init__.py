@@ -0,0 +1,10 @@
+"""
+Versioned schema and data migrations.
+
+    python -m migrations                 # apply pending migrations
+    python -m migrations plan            # dry run: print what would be executed
+    python -m migrations status          # applied / pending migrations and backfill checkpoints
+
+The application never runs DDL at startup; deploys run `python -m migrations` first.
+"""
+from migrations.runner import MigrationLockError, Operations, plan, status, upgrade
@@ -0,0 +1,66 @@
+import argparse
+import sys
+
+from sqlalchemy import create_engine
+
+import env
+
+from migrations import runner
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m migrations", description="Apply database migrations")
+    parser.add_argument("command", nargs="?", default="upgrade", choices=["upgrade", "plan", "status"])
+    parser.add_argument("--batch-size", type=int, default=runner.DEFAULT_BATCH_SIZE, help="rows per backfill transaction")
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between backfill batches")
+    parser.add_argument("--force-unlock", action="store_true", help="clear a lock left by a crashed runner first")
+    parser.add_argument("--shard", help="only this database (default: main and every DATABASE_SHARDS entry)")
+    args = parser.parse_args()
+
+    from database import MAIN_SHARD, SHARD_URLS, SQLALCHEMY_DATABASE_URL, _normalize_url
+    urls = {MAIN_SHARD: SQLALCHEMY_DATABASE_URL, **{name: _normalize_url(url) for name, url in SHARD_URLS.items()}}
+    if args.shard:
+        if args.shard not in urls:
+            parser.error(f"unknown shard {args.shard!r}; configured: {', '.join(urls)}")
+        urls = {args.shard: urls[args.shard]}
+    # Every shard has the full schema; a failure on one still lets the others run
+    return max(_run(args, create_engine(url)) for url in urls.values())
+
+
+def _run(args, engine) -> int:
+    print(f"Database: {engine.url.render_as_string(hide_password=True)}")
+
+    try:
+        if args.command == "status":
+            for name, applied, description in runner.status(engine):
+                print(f"[{'x' if applied else ' '}] {name} - {description}")
+            for name, last_id, updated_at in runner.checkpoints(engine):
+                print(f"    checkpoint {name}: last id {last_id} at {updated_at:%Y-%m-%d %H:%M:%S}")
+            return 0
+
+        if args.command == "plan":
+            pending = runner.plan(engine, batch_size=args.batch_size)
+            if not pending:
+                print("Nothing to migrate.")
+            for name, operations in pending:
+                print(f"{name}:")
+                for operation in operations or ["(no changes needed)"]:
+                    print(f"  {operation}")
+            return 0
+
+        if args.force_unlock:
+            runner.force_unlock(engine)
+        applied = runner.upgrade(engine, batch_size=args.batch_size, pause=args.pause)
+        print(f"Applied {len(applied)} migration(s)." if applied else "Nothing to migrate.")
+        return 0
+    except runner.MigrationLockError as e:
+        print(f"Migration skipped: {e}")
+        return 2
+    except Exception as e:
+        print(f"Migration failed: {e}")
+        return 1
+    finally:
+        engine.dispose()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,333 @@
+"""
+Migration runner: version tracking, single-runner locking, batched backfills and dry-run plans.
+
+Each migration is a function taking an `Operations` object. Operations are idempotent
+and run in their own short transactions, so a migration interrupted half-way can simply
+be run again; it is recorded in `schema_migrations` only once all its operations succeed.
+"""
+import os
+import socket
+import time
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import (
+    Column, DateTime, Integer, MetaData, String, Table, inspect, text
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+
+DEFAULT_BATCH_SIZE = 5000
+
+# Arbitrary application-wide key for pg_advisory_lock
+ADVISORY_LOCK_KEY = 727_310_032
+
+metadata = MetaData()
+
+schema_migrations = Table(
+    "schema_migrations", metadata,
+    Column("name", String, primary_key=True),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+migration_checkpoints = Table(
+    "migration_checkpoints", metadata,
+    Column("name", String, primary_key=True),
+    Column("last_id", Integer, nullable=False),
+    Column("updated_at", DateTime, nullable=False),
+)
+
+# Used as the runner lock on databases without advisory locks
+migration_lock = Table(
+    "migration_lock", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("locked_by", String, nullable=False),
+    Column("locked_at", DateTime, nullable=False),
+)
+
+Migration = Tuple[str, Callable[["Operations"], None]]
+
+
+class MigrationLockError(Exception):
+    """Another migration runner holds the lock"""
+
+
+class Operations:
+    """
+    Schema and data operations available to migrations.
+    With dry_run=True nothing is executed; each operation is appended to `plan` instead.
+    """
+
+    def __init__(self, engine: Engine, dry_run: bool = False, batch_size: int = DEFAULT_BATCH_SIZE,
+                 pause: float = 0.0, log: Callable[[str], None] = print, planned_tables: Optional[set] = None):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.pause = pause
+        self.log = log
+        self.plan: List[str] = []
+        # Tables a dry run would create earlier in the plan; they are created from the
+        # current models, so later operations on them are no-ops
+        self.planned_tables = planned_tables if planned_tables is not None else set()
+
+    def _skip_planned(self, table: str) -> bool:
+        return self.dry_run and table in self.planned_tables
+
+    def _record(self, description: str) -> bool:
+        """Log the operation; returns False in dry-run mode so the caller skips execution"""
+        if self.dry_run:
+            self.plan.append(description)
+            return False
+        self.log(f"  {description}")
+        return True
+
+    def execute(self, sql: str, dialects: Optional[Tuple[str, ...]] = None):
+        """Run raw SQL, optionally only on the given dialects"""
+        if dialects and self.dialect not in dialects:
+            return
+        if self._record(sql):
+            with self.engine.begin() as conn:
+                conn.execute(text(sql))
+
+    def create_tables(self, *tables: Table):
+        """Create tables that do not exist yet (from their SQLAlchemy definitions)"""
+        existing = set(inspect(self.engine).get_table_names())
+        missing = [t for t in tables if t.name not in existing and t.name not in self.planned_tables]
+        if self.dry_run:
+            self.planned_tables.update(t.name for t in missing)
+        if missing and self._record(f"CREATE TABLE {', '.join(t.name for t in missing)}"):
+            missing[0].metadata.create_all(self.engine, tables=missing)
+
+    def add_column(self, table: str, column: str, ddl_type: str):
+        """Add a nullable column if it does not exist (no default, so no table rewrite on Postgres)"""
+        if self._skip_planned(table):
+            return
+        columns = {c["name"] for c in inspect(self.engine).get_columns(table)}
+        if column not in columns and self._record(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"):
+            with self.engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+    def create_index(self, name: str, table: str, columns: str, unique: bool = False):
+        """
+        Create an index if missing. On Postgres it is built CONCURRENTLY (outside a
+        transaction) so writes to the table are not blocked while it builds.
+
+        A partitioned table cannot build an index CONCURRENTLY, so the index is created
+        ON ONLY the parent (invalid, no rows read), built CONCURRENTLY on each partition,
+        and each of those attached to it; the parent's becomes valid with the last one.
+        """
+        if self._skip_planned(table):
+            return
+        unique_sql = "UNIQUE " if unique else ""
+        if self.dialect == "postgresql":
+            with self.engine.connect() as conn:
+                partitions = _partitions(conn, table)
+            if partitions is None:
+                sql = f"CREATE {unique_sql}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})"
+                if self._record(sql):
+                    self._build_concurrently(name, sql)
+                return
+            sql = f"CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON ONLY {table} ({columns})"
+            if self._record(sql):
+                with self.engine.begin() as conn:
+                    conn.execute(text(sql))
+            for partition in partitions:
+                child = f"{name[:40]}_{partition}"[:63]
+                sql = f"CREATE {unique_sql}INDEX CONCURRENTLY IF NOT EXISTS {child} ON {partition} ({columns})"
+                if self._record(sql):
+                    self._build_concurrently(child, sql)
+                # A no-op when it is attached already
+                attach = f"ALTER INDEX {name} ATTACH PARTITION {child}"
+                if self._record(attach):
+                    with self.engine.begin() as conn:
+                        conn.execute(text(attach))
+        else:
+            sql = f"CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON {table} ({columns})"
+            if self._record(sql):
+                with self.engine.begin() as conn:
+                    conn.execute(text(sql))
+
+    def _build_concurrently(self, name: str, sql: str):
+        # A failed concurrent build leaves an INVALID index behind; drop it so the retry rebuilds
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            invalid = conn.execute(text(
+                "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+                "WHERE c.relname = :name AND NOT i.indisvalid"
+            ), {"name": name}).scalar()
+            if invalid:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+            conn.execute(text(sql))
+
+    def backfill(self, name: str, table: str, assignments: str, pending: str):
+        """
+        Run `UPDATE table SET assignments WHERE pending` over primary-key ranges.
+        Each batch commits together with a checkpoint of the last processed id, so the
+        table is never locked for long and an interrupted backfill resumes where it stopped.
+        Rows inserted meanwhile must already be written complete by the application.
+        """
+        if self._skip_planned(table):
+            return
+        with self.engine.connect() as conn:
+            max_id = conn.execute(text(f"SELECT MAX(id) FROM {table}")).scalar() or 0
+        last_id = get_checkpoint(self.engine, name)
+        if last_id >= max_id:
+            return
+
+        if not self._record(f"BACKFILL {table} SET {assignments} WHERE {pending} "
+                            f"(ids {last_id + 1}..{max_id}, {self.batch_size} per batch)"):
+            return
+        while last_id < max_id:
+            upper = min(last_id + self.batch_size, max_id)
+            with self.engine.begin() as conn:
+                updated = conn.execute(
+                    text(f"UPDATE {table} SET {assignments} WHERE id > :lo AND id <= :hi AND ({pending})"),
+                    {"lo": last_id, "hi": upper}
+                ).rowcount
+                _save_checkpoint(conn, name, upper)
+            last_id = upper
+            self.log(f"    {name}: {last_id}/{max_id} ({updated} rows updated)")
+            if self.pause:
+                time.sleep(self.pause)
+
+
+def _partitions(conn, table: str) -> Optional[List[str]]:
+    """Names of a Postgres table's partitions, or None when it is not partitioned"""
+    if not conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = :table AND c.relnamespace = current_schema()::regnamespace)"
+    ), {"table": table}).scalar():
+        return None
+    return conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = CAST(:table AS regclass) ORDER BY c.relname"
+    ), {"table": table}).scalars().all()
+
+
+def get_checkpoint(engine: Engine, name: str) -> int:
+    if not inspect(engine).has_table(migration_checkpoints.name):
+        return 0
+    with engine.connect() as conn:
+        last_id = conn.execute(
+            migration_checkpoints.select().with_only_columns(migration_checkpoints.c.last_id)
+            .where(migration_checkpoints.c.name == name)
+        ).scalar()
+    return last_id or 0
+
+
+def _save_checkpoint(conn, name: str, last_id: int):
+    values = {"last_id": last_id, "updated_at": datetime.utcnow()}
+    updated = conn.execute(
+        migration_checkpoints.update().where(migration_checkpoints.c.name == name).values(**values)
+    ).rowcount
+    if not updated:
+        conn.execute(migration_checkpoints.insert().values(name=name, **values))
+
+
+class _RunnerLock:
+    """Only one runner at a time: pg_advisory_lock on Postgres, a lock row elsewhere"""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.conn = None
+
+    def __enter__(self):
+        if self.engine.dialect.name == "postgresql":
+            # Autocommit: an idle open transaction here would block CREATE INDEX CONCURRENTLY
+            self.conn = self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+            if not self.conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": ADVISORY_LOCK_KEY}).scalar():
+                self.conn.close()
+                raise MigrationLockError("Another migration runner is active")
+            return self
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(migration_lock.insert().values(
+                    id=1, locked_by=f"{socket.gethostname()}:{os.getpid()}", locked_at=datetime.utcnow()
+                ))
+        except IntegrityError:
+            with self.engine.connect() as conn:
+                holder = conn.execute(migration_lock.select()).first()
+            raise MigrationLockError(
+                f"Another migration runner is active ({holder.locked_by} since {holder.locked_at:%Y-%m-%d %H:%M:%S}); "
+                "use --force-unlock if it is gone"
+            )
+        return self
+
+    def __exit__(self, *exc):
+        if self.conn is not None:
+            self.conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": ADVISORY_LOCK_KEY})
+            self.conn.close()
+        else:
+            with self.engine.begin() as conn:
+                conn.execute(migration_lock.delete())
+
+
+def _bootstrap(engine: Engine):
+    metadata.create_all(engine)
+
+
+def applied_migrations(engine: Engine) -> set:
+    if not inspect(engine).has_table(schema_migrations.name):
+        return set()
+    with engine.connect() as conn:
+        return set(conn.execute(schema_migrations.select().with_only_columns(schema_migrations.c.name)).scalars())
+
+
+def pending_migrations(engine: Engine, migrations: List[Migration]) -> List[Migration]:
+    applied = applied_migrations(engine)
+    return [m for m in migrations if m[0] not in applied]
+
+
+def upgrade(engine: Engine, migrations: Optional[List[Migration]] = None, batch_size: int = DEFAULT_BATCH_SIZE,
+            pause: float = 0.0, log: Callable[[str], None] = print) -> List[str]:
+    """Apply pending migrations in order under the runner lock; returns the applied names"""
+    if migrations is None:
+        from migrations.versions import MIGRATIONS as migrations
+    applied = []
+    _bootstrap(engine)
+    with _RunnerLock(engine):
+        # Re-read under the lock: another runner may have finished in the meantime
+        for name, func in pending_migrations(engine, migrations):
+            log(f"Applying {name}: {func.__doc__}")
+            func(Operations(engine, batch_size=batch_size, pause=pause, log=log))
+            with engine.begin() as conn:
+                conn.execute(schema_migrations.insert().values(name=name, applied_at=datetime.utcnow()))
+            applied.append(name)
+    return applied
+
+
+def plan(engine: Engine, migrations: Optional[List[Migration]] = None,
+         batch_size: int = DEFAULT_BATCH_SIZE) -> List[Tuple[str, List[str]]]:
+    """Dry run: the operations each pending migration would execute, without touching the schema"""
+    if migrations is None:
+        from migrations.versions import MIGRATIONS as migrations
+    result = []
+    planned_tables: set = set()
+    for name, func in pending_migrations(engine, migrations):
+        ops = Operations(engine, dry_run=True, batch_size=batch_size, planned_tables=planned_tables)
+        func(ops)
+        result.append((name, ops.plan))
+    return result
+
+
+def status(engine: Engine, migrations: Optional[List[Migration]] = None) -> List[Tuple[str, bool, str]]:
+    """(name, applied, description) for every known migration"""
+    if migrations is None:
+        from migrations.versions import MIGRATIONS as migrations
+    applied = applied_migrations(engine)
+    return [(name, name in applied, func.__doc__ or "") for name, func in migrations]
+
+
+def checkpoints(engine: Engine) -> List[Tuple[str, int, datetime]]:
+    """Backfill progress as (name, last processed id, updated_at)"""
+    if not inspect(engine).has_table(migration_checkpoints.name):
+        return []
+    with engine.connect() as conn:
+        return [tuple(row) for row in conn.execute(migration_checkpoints.select().order_by(migration_checkpoints.c.name))]
+
+
+def force_unlock(engine: Engine):
+    """Clear a lock row left behind by a crashed runner (Postgres advisory locks release on their own)"""
+    _bootstrap(engine)
+    with engine.begin() as conn:
+        conn.execute(migration_lock.delete())
@@ -0,0 +1,173 @@
+"""
+Ordered list of migrations. Append new entries at the end; never edit or reorder
+applied ones. Every operation must be safe to re-run (see runner.Operations).
+"""
+from migrations.runner import Operations
+
+
+def baseline(op: Operations):
+    """Tables as created by the former create_all at startup"""
+    import models
+    op.create_tables(*[
+        models.Base.metadata.tables[name]
+        for name in ("receipts", "items", "income", "settings", "users", "exchange_rates")
+    ])
+
+
+def items_user_id(op: Operations):
+    """Pending items: items.user_id and nullable receipt_id"""
+    op.add_column("items", "user_id", "VARCHAR")
+    op.create_index("ix_items_user_id", "items", "user_id")
+    op.execute("ALTER TABLE items ALTER COLUMN receipt_id DROP NOT NULL", dialects=("postgresql",))
+
+
+def money_minor_columns(op: Operations):
+    """Integer minor-unit columns next to the legacy Float amounts"""
+    op.add_column("receipts", "total_amount_minor", "BIGINT")
+    op.add_column("items", "price_minor", "BIGINT")
+    op.add_column("income", "amount_minor", "BIGINT")
+
+
+def backfill_money_minor(op: Operations):
+    """Fill the minor-unit columns from the Float columns in batches"""
+    from money import MONEY_SCALE
+    for table, source, target in [
+        ("receipts", "total_amount", "total_amount_minor"),
+        ("items", "price", "price_minor"),
+        ("income", "amount", "amount_minor"),
+    ]:
+        op.backfill(
+            name=f"backfill_money_minor:{table}",
+            table=table,
+            assignments=f"{target} = ROUND({source} * {MONEY_SCALE})",
+            pending=f"{target} IS NULL AND {source} IS NOT NULL",
+        )
+
+
+def user_date_indexes(op: Operations):
+    """Composite (user_id, date) indexes for dashboard and list date-range queries"""
+    op.create_index("ix_receipts_user_id_date", "receipts", "user_id, date")
+    op.create_index("ix_income_user_id_date", "income", "user_id, date")
+
+
+def webhook_events(op: Operations):
+    """Durable queue table for webhook ingestion"""
+    import models
+    op.create_tables(models.Base.metadata.tables["webhook_events"])
+
+
+def jobs(op: Operations):
+    """Background job table"""
+    import models
+    op.create_tables(models.Base.metadata.tables["jobs"])
+
+
+def receipt_archives(op: Operations):
+    """Manifest of receipt months moved to the Parquet archive"""
+    import models
+    op.create_tables(models.Base.metadata.tables["receipt_archives"])
+
+
+def product_catalog(op: Operations):
+    """Product catalog and price history index (filled by `python catalog.py rebuild`)"""
+    import models
+    op.create_tables(models.Base.metadata.tables["products"], models.Base.metadata.tables["product_prices"])
+
+
+def merchants(op: Operations):
+    """Canonical merchants, their aliases and receipts.merchant_id (filled by `python merchants.py normalize`)"""
+    import models
+    op.create_tables(models.Base.metadata.tables["merchants"], models.Base.metadata.tables["merchant_aliases"])
+    op.add_column("receipts", "merchant_id", "INTEGER")
+    op.create_index("ix_receipts_merchant_id", "receipts", "merchant_id")
+
+
+def purchase_patterns(op: Operations):
+    """Precomputed repurchase intervals for to-buy suggestions (filled by `python suggestions.py rebuild`)"""
+    import models
+    op.create_tables(models.Base.metadata.tables["purchase_patterns"])
+
+
+def budgets(op: Operations):
+    """Budgets, running spending totals and budget alerts (totals filled by `python budgets.py rebuild`)"""
+    import models
+    op.create_tables(*[
+        models.Base.metadata.tables[name] for name in ("budgets", "spending_totals", "budget_alerts")
+    ])
+
+
+def recurring_templates(op: Operations):
+    """Recurring receipt and income templates, materialized by recurring.py"""
+    import models
+    op.create_tables(models.Base.metadata.tables["recurring_templates"])
+
+
+def shard_directory(op: Operations):
+    """Shard directory overrides and user move progress (see sharding.py); created on every shard"""
+    import models
+    op.create_tables(models.Base.metadata.tables["user_shards"], models.Base.metadata.tables["shard_moves"])
+
+
+def job_traceparent(op: Operations):
+    """jobs.traceparent, so jobs continue the trace of the request that queued them"""
+    op.add_column("jobs", "traceparent", "VARCHAR")
+
+
+def receipt_fingerprints(op: Operations):
+    """Duplicate detection keys on receipts (older receipts filled by `python duplicates.py scan`)"""
+    op.add_column("receipts", "fingerprint", "VARCHAR")
+    op.add_column("receipts", "image_hash", "VARCHAR")
+    op.create_index("ix_receipts_user_id_fingerprint", "receipts", "user_id, fingerprint")
+    op.create_index("ix_receipts_user_id_image_hash", "receipts", "user_id, image_hash")
+
+
+def updated_at(op: Operations):
+    """Last change of receipts and income, part of the forecast cache's data fingerprint"""
+    op.add_column("receipts", "updated_at", "TIMESTAMP")
+    op.add_column("income", "updated_at", "TIMESTAMP")
+
+
+def receipt_budget_minor(op: Operations):
+    """What each receipt added to spending_totals (filled by `python budgets.py rebuild`)"""
+    op.add_column("receipts", "budget_minor", "BIGINT")
+
+
+def item_key_fingerprints(op: Operations):
+    """Clear fingerprints of receipts with items, hashed with the old item keys (refilled by `python duplicates.py scan`)"""
+    op.backfill(
+        "0018_item_key_fingerprints", "receipts", "fingerprint = NULL",
+        "fingerprint IS NOT NULL AND EXISTS (SELECT 1 FROM items WHERE items.receipt_id = receipts.id)"
+    )
+
+
+def currency_upper(op: Operations):
+    """Upper-case currency codes, which never matched exchange_rates otherwise (then run `python budgets.py rebuild`)"""
+    # A receipt's fingerprint hashes its currency
+    op.backfill("0019_currency_upper_receipts", "receipts", "currency = UPPER(currency), fingerprint = NULL",
+                "currency <> UPPER(currency)")
+    for table in ("income", "settings", "recurring_templates", "product_prices"):
+        op.backfill(f"0019_currency_upper_{table}", table, "currency = UPPER(currency)", "currency <> UPPER(currency)")
+
+
+MIGRATIONS = [
+    ("0000_baseline", baseline),
+    ("0001_items_user_id", items_user_id),
+    ("0002_money_minor_columns", money_minor_columns),
+    ("0003_backfill_money_minor", backfill_money_minor),
+    ("0004_user_date_indexes", user_date_indexes),
+    ("0005_webhook_events", webhook_events),
+    ("0006_jobs", jobs),
+    ("0007_receipt_archives", receipt_archives),
+    ("0008_product_catalog", product_catalog),
+    ("0009_merchants", merchants),
+    ("0010_purchase_patterns", purchase_patterns),
+    ("0011_budgets", budgets),
+    ("0012_recurring_templates", recurring_templates),
+    ("0013_shard_directory", shard_directory),
+    ("0014_job_traceparent", job_traceparent),
+    ("0015_receipt_fingerprints", receipt_fingerprints),
+    ("0016_updated_at", updated_at),
+    ("0017_receipt_budget_minor", receipt_budget_minor),
+    ("0018_item_key_fingerprints", item_key_fingerprints),
+    ("0019_currency_upper", currency_upper),
+]
@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, BigInteger, String, Float, Date, DateTime, ForeignKey, Index, UniqueConstraint, JSON
+from sqlalchemy.orm import relationship, validates
 from database import Base
+from money import to_minor
 from datetime import datetime
 
 class Item(Base):
@@ -9,40 +10,73 @@ class Item(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String)
     price = Column(Float, default=0.0) # Price might be 0 for pending items
+    price_minor = Column(BigInteger, default=0) # Exact price in minor units (see money.py)
     quantity = Column(Integer, default=1)
     user_id = Column(String, index=True, nullable=True) # Link to Supabase User ID (for pending items)
     receipt_id = Column(Integer, ForeignKey("receipts.id", ondelete="CASCADE"), nullable=True)
 
     receipt = relationship("Receipt", back_populates="items")
 
+    @validates("price")
+    def _sync_price_minor(self, key, value):
+        self.price_minor = to_minor(value)
+        return value
+
 class Receipt(Base):
     __tablename__ = "receipts"
+    __table_args__ = (
+        Index("ix_receipts_user_id_date", "user_id", "date"),
+        # Duplicate lookups (see duplicates.py)
+        Index("ix_receipts_user_id_fingerprint", "user_id", "fingerprint"),
+        Index("ix_receipts_user_id_image_hash", "user_id", "image_hash"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(String, index=True) # Link to Supabase User ID
     merchant_name = Column(String, index=True)
+    merchant_id = Column(Integer, index=True, nullable=True) # Canonical merchant (see merchants.py)
     date = Column(Date)
     total_amount = Column(Float)
+    total_amount_minor = Column(BigInteger) # Exact amount in minor units (see money.py)
     currency = Column(String, default="TND")
+    budget_minor = Column(BigInteger, nullable=True) # What the receipt added to spending_totals (see budgets.py)
     category = Column(String, index=True, default="Uncategorized")
     location = Column(String, nullable=True)
     image_url = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Also set by bulk updates
+    fingerprint = Column(String, nullable=True) # Merchant, date, amount and items hash (see duplicates.py)
+    image_hash = Column(String, nullable=True) # Perceptual hash of the uploaded image
 
     items = relationship("Item", back_populates="receipt", cascade="all, delete-orphan")
 
+    @validates("total_amount")
+    def _sync_total_amount_minor(self, key, value):
+        self.total_amount_minor = to_minor(value)
+        return value
+
 class Income(Base):
     __tablename__ = "income"
+    __table_args__ = (
+        Index("ix_income_user_id_date", "user_id", "date"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(String, index=True) # Link to Supabase User ID
     source = Column(String, index=True)
     amount = Column(Float)
+    amount_minor = Column(BigInteger) # Exact amount in minor units (see money.py)
     currency = Column(String, default="TND")
     category = Column(String, index=True)  # Salary, Freelance, Business, Investment, Other
     date = Column(Date)
     description = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @validates("amount")
+    def _sync_amount_minor(self, key, value):
+        self.amount_minor = to_minor(value)
+        return value
 
 class Settings(Base):
     __tablename__ = "settings"
@@ -60,3 +94,241 @@ class User(Base):
     avatar_url = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+class ExchangeRate(Base):
+    __tablename__ = "exchange_rates"
+    __table_args__ = (
+        # As-of lookups: latest rate for a pair on or before a date
+        UniqueConstraint("base_currency", "quote_currency", "date", name="uq_exchange_rates_pair_date"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    date = Column(Date, nullable=False)
+    base_currency = Column(String(3), nullable=False)  # 1 unit of base...
+    quote_currency = Column(String(3), nullable=False)  # ...is worth `rate` units of quote
+    rate = Column(Float, nullable=False)
+
+class WebhookEvent(Base):
+    """Durable queue of received webhooks, drained in batches by webhook_queue.py"""
+    __tablename__ = "webhook_events"
+    __table_args__ = (
+        # Drain order: oldest pending events first
+        Index("ix_webhook_events_status_id", "status", "id"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    event_id = Column(String, unique=True, nullable=False)  # Delivery id header, else hash of the body
+    source = Column(String, default="supabase_auth")
+    payload = Column(JSON, nullable=False)
+    status = Column(String, default="pending")  # pending, processed, ignored, failed
+    attempts = Column(Integer, default=0)
+    last_error = Column(String, nullable=True)
+    received_at = Column(DateTime, default=datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)
+
+class Job(Base):
+    """Background job run by jobs.JobRunner (user deletion, file cleanup...)"""
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # Claim order: due queued jobs, oldest first
+        Index("ix_jobs_status_run_after", "status", "run_after"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)
+    user_id = Column(String, index=True, nullable=True)  # Owner, for per-user visibility
+    payload = Column(JSON, nullable=False)
+    status = Column(String, default="queued")  # queued, running, succeeded, dead
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=5)
+    run_after = Column(DateTime, default=datetime.utcnow)
+    locked_by = Column(String, nullable=True)
+    locked_at = Column(DateTime, nullable=True)
+    last_error = Column(String, nullable=True)
+    result = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    traceparent = Column(String, nullable=True)  # W3C trace context of the request that queued it
+
+class ReceiptArchive(Base):
+    """A month of receipts (and their items) moved to Parquet files by archive.py"""
+    __tablename__ = "receipt_archives"
+
+    month = Column(Date, primary_key=True)  # First day of the archived month
+    receipts = Column(Integer, default=0)
+    items = Column(Integer, default=0)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+class Product(Base):
+    """Canonical product of a user; item names resolve to it through catalog.py"""
+    __tablename__ = "products"
+    __table_args__ = (
+        UniqueConstraint("user_id", "key", name="uq_products_user_id_key"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, nullable=False)
+    key = Column(String, nullable=False)  # Normalized name (see catalog.normalize)
+    name = Column(String, nullable=False)  # First name seen, for display
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ProductPrice(Base):
+    """One priced receipt line per row, denormalized for price history lookups"""
+    __tablename__ = "product_prices"
+    __table_args__ = (
+        Index("ix_product_prices_user_id_product_id_date", "user_id", "product_id", "date"),
+        Index("ix_product_prices_receipt_id", "receipt_id"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    receipt_id = Column(Integer, nullable=False)  # No FK: rows outlive archived receipts
+    item_id = Column(Integer, nullable=True)
+    date = Column(Date, nullable=False)
+    merchant_name = Column(String, nullable=True)
+    currency = Column(String, nullable=True)
+    price_minor = Column(BigInteger, nullable=False)  # Unit price in minor units
+    quantity = Column(Integer, default=1)
+
+class Merchant(Base):
+    """Canonical merchant of a user; raw receipt merchant names map to it through merchant_aliases"""
+    __tablename__ = "merchants"
+    __table_args__ = (
+        UniqueConstraint("user_id", "key", name="uq_merchants_user_id_key"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, nullable=False)
+    key = Column(String, nullable=False)  # Normalized name (see merchants.normalize)
+    name = Column(String, nullable=False)  # Display name
+    category = Column(String, nullable=True)  # Suggested category for new receipts
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class MerchantAlias(Base):
+    __tablename__ = "merchant_aliases"
+    __table_args__ = (
+        UniqueConstraint("user_id", "alias", name="uq_merchant_aliases_user_id_alias"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, nullable=False)
+    alias = Column(String, nullable=False)  # Normalized raw merchant name
+    merchant_id = Column(Integer, ForeignKey("merchants.id", ondelete="CASCADE"), nullable=False, index=True)
+
+class PurchasePattern(Base):
+    """Repurchase interval of a product for a user, precomputed by suggestions.py"""
+    __tablename__ = "purchase_patterns"
+    __table_args__ = (
+        UniqueConstraint("user_id", "product_id", name="uq_purchase_patterns_user_id_product_id"),
+        Index("ix_purchase_patterns_user_id_next_date", "user_id", "next_date"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    purchases = Column(Integer, nullable=False)  # Distinct purchase days
+    interval_days = Column(Float, nullable=False)  # Median days between purchases
+    regularity = Column(Float, nullable=False)  # 1 = perfectly regular, 0 = erratic
+    last_date = Column(Date, nullable=False)
+    next_date = Column(Date, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class Budget(Base):
+    """Monthly spending limit of a user, overall (category NULL) or for one category"""
+    __tablename__ = "budgets"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, index=True, nullable=False)
+    category = Column(String, nullable=True)
+    amount = Column(Float, nullable=False)  # In the user's settings currency
+    amount_minor = Column(BigInteger, nullable=False)
+    thresholds = Column(JSON, nullable=False)  # Percentages of the amount that raise an alert
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    @validates("amount")
+    def _sync_amount_minor(self, key, value):
+        self.amount_minor = to_minor(value)
+        return value
+
+class SpendingTotal(Base):
+    """Running spending total per user, month and category, maintained by budgets.py"""
+    __tablename__ = "spending_totals"
+    __table_args__ = (
+        UniqueConstraint("user_id", "month", "category", name="uq_spending_totals_user_id_month_category"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, nullable=False)
+    month = Column(Date, nullable=False)  # First day of the month
+    category = Column(String, nullable=False)  # Receipt category, or "*" for all spending
+    total_minor = Column(BigInteger, nullable=False, default=0)  # In the user's settings currency
+
+class BudgetAlert(Base):
+    """A budget threshold crossed in a month; raised once, polled through GET /budgets/alerts"""
+    __tablename__ = "budget_alerts"
+    __table_args__ = (
+        UniqueConstraint("budget_id", "month", "threshold", name="uq_budget_alerts_budget_id_month_threshold"),
+        Index("ix_budget_alerts_user_id_id", "user_id", "id"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, nullable=False)
+    budget_id = Column(Integer, ForeignKey("budgets.id", ondelete="CASCADE"), nullable=False)
+    category = Column(String, nullable=True)
+    month = Column(Date, nullable=False)
+    threshold = Column(Integer, nullable=False)  # Percent
+    spent_minor = Column(BigInteger, nullable=False)
+    limit_minor = Column(BigInteger, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    read_at = Column(DateTime, nullable=True)
+
+class RecurringTemplate(Base):
+    """A receipt or income repeated on a schedule; recurring.py materializes due occurrences"""
+    __tablename__ = "recurring_templates"
+    __table_args__ = (
+        Index("ix_recurring_templates_next_date_id", "next_date", "id"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, index=True, nullable=False)
+    kind = Column(String, nullable=False)  # receipt, income
+    name = Column(String, nullable=False)  # Merchant name for receipts, source for income
+    merchant_id = Column(Integer, nullable=True)  # Canonical merchant of receipt templates
+    amount = Column(Float, nullable=False)
+    amount_minor = Column(BigInteger, nullable=False)
+    currency = Column(String, default="TND")
+    category = Column(String, nullable=False)
+    description = Column(String, nullable=True)
+    frequency = Column(String, nullable=False)  # weekly, monthly
+    interval = Column(Integer, nullable=False, default=1)  # Every N weeks or months
+    day = Column(Integer, nullable=False)  # Day of the month (clamped to its end), or ISO weekday
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=True)
+    last_date = Column(Date, nullable=True)  # Last materialized occurrence
+    next_date = Column(Date, nullable=True)  # Next occurrence to materialize; NULL once ended
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    @validates("amount")
+    def _sync_amount_minor(self, key, value):
+        self.amount_minor = to_minor(value)
+        return value
+
+class UserShard(Base):
+    """Shard directory override, on the main database; users without a row live where the hash ring puts them"""
+    __tablename__ = "user_shards"
+
+    user_id = Column(String, primary_key=True)
+    shard = Column(String, nullable=False)
+    moving_to = Column(String, nullable=True)  # Set while sharding.py moves the user; writes are refused meanwhile
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class ShardMove(Base):
+    """Progress of a user move, kept on the target shard and committed with each copied batch"""
+    __tablename__ = "shard_moves"
+
+    user_id = Column(String, primary_key=True)
+    source = Column(String, nullable=False)
+    step = Column(String, nullable=False)  # See sharding.STEPS
+    last_id = Column(Integer, nullable=False, default=0)  # Last source id copied by a batched step
+    started_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,36 @@
+"""
+Exact money handling.
+
+Amounts are stored as integers in minor units alongside the legacy Float columns.
+A fixed scale of 1000 is used for every currency: it is exact for TND millimes
+as well as for cent-based currencies, and keeps cross-currency sums in one unit.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Optional
+
+from sqlalchemy import BigInteger, cast, func
+
+MONEY_SCALE = 1000
+
+
+def to_minor(amount: Optional[float]) -> Optional[int]:
+    """Major units (as entered) to integer minor units, rounding half up on the decimal value"""
+    if amount is None:
+        return None
+    return int((Decimal(str(amount)) * MONEY_SCALE).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def from_minor(minor: Optional[float]) -> float:
+    """Minor units (possibly a converted, fractional sum) back to major units"""
+    if minor is None:
+        return 0.0
+    return round(minor) / MONEY_SCALE
+
+
+def minor_amount(minor_column, float_column):
+    """
+    SQL expression for an amount in minor units.
+    Falls back to the legacy Float column for rows the backfill has not reached yet,
+    so aggregates stay correct while the migration runs on a live table.
+    """
+    return func.coalesce(minor_column, cast(func.round(float_column * MONEY_SCALE), BigInteger))
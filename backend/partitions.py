@@ -0,0 +1,265 @@
+"""
+Monthly range partitioning of `receipts` on Postgres.
+
+`convert` turns the plain receipts table into a table partitioned by month on
+`date`, with a DEFAULT partition for undated rows. Queries that filter on date
+ranges (dashboard, receipt list, analytics) then only scan the matching months.
+Partitions for upcoming months are created by `ensure` (run it from cron or the
+archive job), and old months are moved out by archive.py.
+
+The conversion renames and copies the table under an ACCESS EXCLUSIVE lock, so
+reads and writes of receipts both wait until it commits: run it in a maintenance
+window. The old table is kept as receipts_unpartitioned until dropped by hand.
+
+Partitioned receipts cannot be the target of items.receipt_id's foreign key, so
+the conversion replaces it with triggers (see INTEGRITY): items can only point at
+an existing receipt, and deleting a receipt deletes its items, as ON DELETE CASCADE
+did. `ensure` installs them too, for tables converted before they existed. On other
+databases every function here is a no-op.
+
+Usage:
+    python partitions.py status
+    python partitions.py convert [--months-ahead 3]
+    python partitions.py ensure [--months-ahead 3]
+"""
+import argparse
+import re
+import sys
+from datetime import date
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+MONTHS_AHEAD = 3
+PARTITION_NAME = re.compile(r"^receipts_(\d{4})_(\d{2})$")
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"receipts_{month:%Y_%m}"
+
+
+def supported(engine: Engine) -> bool:
+    return engine.dialect.name == "postgresql"
+
+
+def is_partitioned(conn: Connection) -> bool:
+    return bool(conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = 'receipts' AND c.relnamespace = current_schema()::regnamespace)"
+    )).scalar())
+
+
+def partitions(conn: Connection) -> List[Tuple[str, Optional[date]]]:
+    """(name, month) of every partition; month is None for the default partition"""
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'receipts'::regclass ORDER BY c.relname"
+    )).scalars().all()
+    result = []
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        result.append((name, date(int(match[1]), int(match[2]), 1) if match else None))
+    return result
+
+
+def create_partition(conn: Connection, month: date) -> bool:
+    """
+    Create the partition for `month` if missing. Rows of that month already sitting
+    in the default partition are moved into it first, otherwise ATTACH would fail.
+    """
+    name = partition_name(month)
+    if conn.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar():
+        return False
+    bounds = {"start": month, "end": next_month(month)}
+    conn.execute(text(f"CREATE TABLE {name} (LIKE receipts INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    if conn.execute(text("SELECT to_regclass('receipts_default')")).scalar():
+        # The rows are out of `receipts` until ATTACH: keep the delete trigger from taking their items along
+        conn.execute(text("SET LOCAL spendlog.moving_receipts = 'on'"))
+        conn.execute(text(
+            f"WITH moved AS (DELETE FROM receipts_default WHERE date >= :start AND date < :end RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        ), bounds)
+        conn.execute(text("SET LOCAL spendlog.moving_receipts = 'off'"))
+    conn.execute(text(
+        f"ALTER TABLE receipts ATTACH PARTITION {name} FOR VALUES FROM ('{bounds['start']}') TO ('{bounds['end']}')"
+    ))
+    return True
+
+
+# Stand-ins for the items.receipt_id foreign key, which cannot reference a partitioned table
+INTEGRITY = [
+    # Like the foreign key's check: KEY SHARE makes a concurrent delete of the receipt wait
+    """
+    CREATE OR REPLACE FUNCTION items_check_receipt() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.receipt_id IS NOT NULL THEN
+            PERFORM 1 FROM receipts WHERE id = NEW.receipt_id FOR KEY SHARE;
+            IF NOT FOUND THEN
+                RAISE foreign_key_violation USING MESSAGE = format('receipt %s does not exist', NEW.receipt_id);
+            END IF;
+        END IF;
+        RETURN NEW;
+    END $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER items_check_receipt BEFORE INSERT OR UPDATE OF receipt_id ON items
+    FOR EACH ROW EXECUTE FUNCTION items_check_receipt()
+    """,
+    # ON DELETE CASCADE. An UPDATE moving a receipt to another month's partition also
+    # fires DELETE triggers, so items are only deleted when the id is really gone.
+    """
+    CREATE OR REPLACE FUNCTION receipts_delete_items() RETURNS trigger AS $$
+    BEGIN
+        IF current_setting('spendlog.moving_receipts', true) IS DISTINCT FROM 'on'
+                AND NOT EXISTS (SELECT 1 FROM receipts WHERE id = OLD.id) THEN
+            DELETE FROM items WHERE receipt_id = OLD.id;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER receipts_delete_items AFTER DELETE ON receipts
+    FOR EACH ROW EXECUTE FUNCTION receipts_delete_items()
+    """,
+]
+
+
+def install_integrity(conn: Connection) -> bool:
+    """Create the INTEGRITY triggers if missing; returns True when they were created"""
+    if conn.execute(text("SELECT 1 FROM pg_trigger WHERE tgname = 'receipts_delete_items'")).scalar():
+        return False
+    for statement in INTEGRITY:
+        conn.execute(text(statement))
+    return True
+
+
+def ensure(engine: Engine, months_ahead: int = MONTHS_AHEAD, today: Optional[date] = None) -> List[str]:
+    """Create partitions from the current month through `months_ahead` months ahead"""
+    if not supported(engine):
+        return []
+    created = []
+    month = month_start(today or date.today())
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            return []
+        install_integrity(conn)
+        for _ in range(months_ahead + 1):
+            if create_partition(conn, month):
+                created.append(partition_name(month))
+            month = next_month(month)
+    return created
+
+
+# Indexes of the partitioned table (created on the parent, propagated to every partition)
+INDEXES = [
+    ("ix_receipts_id", "id"),
+    ("ix_receipts_user_id", "user_id"),
+    ("ix_receipts_user_id_date", "user_id, date"),
+    ("ix_receipts_merchant_name", "merchant_name"),
+    ("ix_receipts_merchant_id", "merchant_id"),
+    ("ix_receipts_category", "category"),
+    ("ix_receipts_user_id_fingerprint", "user_id, fingerprint"),
+    ("ix_receipts_user_id_image_hash", "user_id, image_hash"),
+]
+
+
+def convert(engine: Engine, months_ahead: int = MONTHS_AHEAD, log=print) -> bool:
+    """
+    Replace `receipts` by a month-partitioned copy in one transaction. Returns False
+    when there is nothing to do (not Postgres, or already partitioned).
+
+    A partitioned table cannot have a primary key on `id` alone (it must include the
+    partition key, and `date` is nullable), so `id` keeps its sequence default and a
+    plain index, and the items.receipt_id foreign key is replaced by the INTEGRITY
+    triggers. Nothing in the database enforces unique ids any more: they rely on the
+    sequence alone, so never insert receipts with explicit ids (moves between shards
+    take new ones). `status` reports any duplicates.
+
+    Renaming the table takes an ACCESS EXCLUSIVE lock: reads and writes of receipts
+    wait until the copy commits.
+    """
+    if not supported(engine):
+        log("Partitioning is only supported on Postgres")
+        return False
+    with engine.begin() as conn:
+        if is_partitioned(conn):
+            log("receipts is already partitioned")
+            return False
+        # Taken up front: the renames need this lock anyway, and upgrading a weaker one can deadlock
+        conn.execute(text("LOCK TABLE receipts IN ACCESS EXCLUSIVE MODE"))
+
+        for index in conn.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'receipts' AND schemaname = current_schema()"
+        )).scalars().all():
+            conn.execute(text(f'ALTER INDEX "{index}" RENAME TO "{index[:50]}_unpartitioned"'))
+        conn.execute(text("ALTER TABLE items DROP CONSTRAINT IF EXISTS items_receipt_id_fkey"))
+        conn.execute(text("ALTER TABLE receipts RENAME TO receipts_unpartitioned"))
+
+        conn.execute(text(
+            "CREATE TABLE receipts (LIKE receipts_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (date)"
+        ))
+        conn.execute(text("CREATE TABLE receipts_default PARTITION OF receipts DEFAULT"))
+        for name, columns in INDEXES:
+            conn.execute(text(f"CREATE INDEX {name} ON receipts ({columns})"))
+        conn.execute(text("ALTER SEQUENCE IF EXISTS receipts_id_seq OWNED BY receipts.id"))
+
+        first = conn.execute(text("SELECT min(date) FROM receipts_unpartitioned")).scalar()
+        month = month_start(first or date.today())
+        last = month_start(date.today())
+        for _ in range(months_ahead):
+            last = next_month(last)
+        count = 0
+        while month <= last:
+            create_partition(conn, month)
+            month = next_month(month)
+            count += 1
+
+        copied = conn.execute(text("INSERT INTO receipts SELECT * FROM receipts_unpartitioned")).rowcount
+        install_integrity(conn)
+        log(f"Copied {copied} receipts into {count} monthly partitions (+ default)")
+    with engine.connect() as conn:
+        conn.execute(text("ANALYZE receipts"))
+    return True
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "convert", "ensure"])
+    parser.add_argument("--months-ahead", type=int, default=MONTHS_AHEAD)
+    args = parser.parse_args(argv)
+
+    from database import engine
+    if not supported(engine):
+        print("Partitioning is only supported on Postgres")
+        return 1
+    if args.command == "convert":
+        convert(engine, args.months_ahead)
+    elif args.command == "ensure":
+        print(f"Created: {ensure(engine, args.months_ahead) or 'nothing'}")
+    with engine.connect() as conn:
+        if not is_partitioned(conn):
+            print("receipts is not partitioned")
+            return 0
+        for name, month in partitions(conn):
+            rows = conn.execute(text(f"SELECT count(*) FROM {name}")).scalar()
+            print(f"{name:<28}{rows:>10}")
+        duplicates = conn.execute(text(
+            "SELECT count(*) FROM (SELECT id FROM receipts GROUP BY id HAVING count(*) > 1) d"
+        )).scalar()
+        if duplicates:
+            print(f"{duplicates} receipt ids are used more than once")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,322 @@
+"""
+Per-user rate limiting and concurrency caps.
+
+RateLimitMiddleware is a plain ASGI middleware that, before routing, charges each
+request to a per-user token bucket and, for expensive routes, to a per-user
+per-route bucket and an in-flight counter. Rejected requests get 429 with
+Retry-After and never reach the threadpool or the database pool.
+
+Users are identified by the user id the bearer token last resolved to (recorded by
+auth_utils after Supabase validated it), else by client address: a token this
+process has not seen validated, forged or not, shares its address's bucket, so
+rotating made-up tokens does not buy fresh buckets.
+
+Backends: MemoryBackend (per process, default) and SharedBackend, which keeps the
+buckets in Redis through two atomic Lua scripts (RATE_LIMIT_BACKEND=redis, needs the
+optional `redis` package). StandInStore runs the same scripts' logic in-process, for
+tests and for exercising SharedBackend without a Redis server.
+"""
+import json
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+import env
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+
+
+@dataclass(frozen=True)
+class Limit:
+    rate: float    # tokens refilled per second
+    burst: int     # bucket size
+
+
+@dataclass(frozen=True)
+class RouteLimit:
+    name: str
+    limit: Optional[Limit] = None
+    concurrency: Optional[int] = None   # max in-flight requests per user
+
+
+# Every request of a user
+USER_LIMIT = Limit(rate=50, burst=100)
+
+# Expensive endpoints, keyed by (method, path without trailing slash)
+ROUTE_LIMITS: Dict[Tuple[str, str], RouteLimit] = {
+    ("GET", "/receipts/dashboard/stats"): RouteLimit("dashboard", Limit(5, 20), concurrency=2),
+    ("GET", "/receipts/dashboard/timeseries"): RouteLimit("timeseries", Limit(5, 20), concurrency=2),
+    ("GET", "/analytics"): RouteLimit("analytics", Limit(2, 10), concurrency=2),
+    ("GET", "/analytics/forecast"): RouteLimit("forecast", Limit(2, 10), concurrency=2),
+    ("POST", "/receipts/upload"): RouteLimit("upload", Limit(1, 10), concurrency=2),
+    ("POST", "/receipts/bulk/delete"): RouteLimit("bulk", Limit(1, 10), concurrency=1),
+    ("POST", "/receipts/bulk/update"): RouteLimit("bulk", Limit(1, 10), concurrency=1),
+    # Open streams are held for the whole connection, so the cap is on concurrent streams
+    ("GET", "/events/stream"): RouteLimit("events", Limit(1, 10), concurrency=5),
+}
+
+CONCURRENCY_RETRY_AFTER = 1
+MAX_IDENTITIES = 10000
+
+
+# Identity
+
+_identities: "OrderedDict[str, str]" = OrderedDict()
+
+
+def remember_identity(token: str, user_id: str) -> None:
+    """Record the user a validated bearer token or stream ticket belongs to"""
+    _identities[token] = user_id
+    if len(_identities) > MAX_IDENTITIES:
+        _identities.popitem(last=False)
+
+
+def identify(scope) -> str:
+    token = next(
+        (value.decode("latin-1").partition(" ")[2] for name, value in scope["headers"] if name == b"authorization"), None
+    )
+    if token is None:
+        # EventSource clients authenticate with a stream ?ticket=
+        token = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("ticket", [None])[0]
+    user_id = _identities.get(token) if token else None
+    if user_id:
+        return f"user:{user_id}"
+    client = scope.get("client")
+    return f"ip:{client[0]}" if client else "ip:unknown"
+
+
+# Backends
+
+class MemoryBackend:
+    """Buckets in a dict; only valid for a single process (the event loop serializes access)"""
+
+    def __init__(self, max_keys: int = 100000, idle_seconds: float = 300.0):
+        self.max_keys = max_keys
+        self.idle_seconds = idle_seconds
+        self._buckets: Dict[str, List[float]] = {}
+        self._in_flight: Dict[str, int] = {}
+
+    def _sweep(self, now: float) -> None:
+        cutoff = now - self.idle_seconds
+        self._buckets = {key: state for key, state in self._buckets.items() if state[1] > cutoff}
+
+    async def take(self, key: str, limit: Limit) -> float:
+        """Consume one token; returns 0 when allowed, else seconds until a token is available"""
+        now = time.monotonic()
+        state = self._buckets.get(key)
+        if state is None:
+            if len(self._buckets) >= self.max_keys:
+                self._sweep(now)
+            self._buckets[key] = [limit.burst - 1.0, now]
+            return 0.0
+        tokens = min(limit.burst, state[0] + (now - state[1]) * limit.rate)
+        state[1] = now
+        if tokens >= 1:
+            state[0] = tokens - 1
+            return 0.0
+        state[0] = tokens
+        return (1 - tokens) / limit.rate
+
+    async def acquire(self, key: str, cap: int) -> bool:
+        count = self._in_flight.get(key, 0)
+        if count >= cap:
+            return False
+        self._in_flight[key] = count + 1
+        return True
+
+    async def release(self, key: str) -> None:
+        count = self._in_flight.get(key, 1) - 1
+        if count:
+            self._in_flight[key] = count
+        else:
+            self._in_flight.pop(key, None)
+
+
+TAKE_SCRIPT = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+ACQUIRE_SCRIPT = """
+local count = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+if count > tonumber(ARGV[1]) then
+  redis.call('DECR', KEYS[1])
+  return 0
+end
+return 1
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('DECR', KEYS[1]) <= 0 then redis.call('DEL', KEYS[1]) end
+return 1
+"""
+
+
+class SharedBackend:
+    """
+    Buckets in a shared store (redis.asyncio client or StandInStore), so limits hold
+    across workers and hosts. Store errors fail open: the request is let through.
+    """
+
+    # In-flight counters expire in case a worker dies between acquire and release
+    IN_FLIGHT_TTL = 300
+
+    def __init__(self, store, prefix: str = "ratelimit:"):
+        self.store = store
+        self.prefix = prefix
+
+    async def take(self, key: str, limit: Limit) -> float:
+        try:
+            wait = await self.store.eval(TAKE_SCRIPT, 1, self.prefix + key, limit.rate, limit.burst)
+        except Exception as e:
+            logger.warning(f"Rate limit store error: {e}")
+            return 0.0
+        return float(wait)
+
+    async def acquire(self, key: str, cap: int) -> bool:
+        try:
+            return bool(int(await self.store.eval(ACQUIRE_SCRIPT, 1, self.prefix + key, cap, self.IN_FLIGHT_TTL)))
+        except Exception as e:
+            logger.warning(f"Rate limit store error: {e}")
+            return True
+
+    async def release(self, key: str) -> None:
+        try:
+            await self.store.eval(RELEASE_SCRIPT, 1, self.prefix + key)
+        except Exception as e:
+            logger.warning(f"Rate limit store error: {e}")
+
+
+class StandInStore:
+    """
+    Local stand-in for the Redis store: implements `eval` for the three scripts above
+    with the same semantics (shared state, string results, key expiry).
+    """
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[object, float]] = {}
+
+    def _get(self, key: str, now: float):
+        entry = self._data.get(key)
+        if entry is None or entry[1] <= now:
+            return None
+        return entry[0]
+
+    async def eval(self, script: str, numkeys: int, *keys_and_args):
+        key, args = keys_and_args[0], keys_and_args[numkeys:]
+        now = time.time()
+        if script == TAKE_SCRIPT:
+            rate, burst = float(args[0]), float(args[1])
+            tokens, ts = self._get(key, now) or (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - ts) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._data[key] = ((tokens, now), now + math.ceil(burst / rate) + 1)
+            return str(wait)
+        if script == ACQUIRE_SCRIPT:
+            count = (self._get(key, now) or 0) + 1
+            if count > int(args[0]):
+                self._data[key] = (count - 1, now + int(args[1]))
+                return 0
+            self._data[key] = (count, now + int(args[1]))
+            return 1
+        if script == RELEASE_SCRIPT:
+            count = (self._get(key, now) or 0) - 1
+            if count <= 0:
+                self._data.pop(key, None)
+            else:
+                self._data[key] = (count, self._data[key][1])
+            return 1
+        raise ValueError("Unknown script")
+
+
+def build_backend():
+    if RATE_LIMIT_BACKEND == "redis":
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis requires the redis package (pip install redis)")
+        return SharedBackend(redis.from_url(RATE_LIMIT_REDIS_URL, decode_responses=True))
+    if RATE_LIMIT_BACKEND == "standin":
+        return SharedBackend(StandInStore())
+    return MemoryBackend()
+
+
+# Middleware
+
+async def _reject(send, retry_after: float) -> None:
+    body = json.dumps({"detail": "Rate limit exceeded"}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 429,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, backend=None, enabled: Optional[bool] = None):
+        self.app = app
+        self.backend = backend or build_backend()
+        self.enabled = RATE_LIMIT_ENABLED if enabled is None else enabled
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.enabled or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        identity = identify(scope)
+        wait = await self.backend.take(identity, USER_LIMIT)
+        if wait:
+            await _reject(send, wait)
+            return
+
+        route = ROUTE_LIMITS.get((scope["method"], scope["path"].rstrip("/")))
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+
+        if route.limit:
+            wait = await self.backend.take(f"{route.name}:{identity}", route.limit)
+            if wait:
+                await _reject(send, wait)
+                return
+        if not route.concurrency:
+            await self.app(scope, receive, send)
+            return
+
+        key = f"{route.name}:inflight:{identity}"
+        if not await self.backend.acquire(key, route.concurrency):
+            await _reject(send, CONCURRENCY_RETRY_AFTER)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await self.backend.release(key)
@@ -0,0 +1,327 @@
+"""
+Recurring receipts and income.
+
+A template repeats a receipt (rent, subscriptions) or an income (salary) every N
+weeks on a weekday, or every N months on a day of the month (clamped to short
+months). Its next_date is the next occurrence not yet written.
+
+`materialize` turns every due occurrence into a real row. Due templates are read
+BATCH_SIZE at a time from the (next_date, id) index, and each batch is written in
+one transaction: one multi-row insert into receipts, one into income, and one bulk
+update moving the templates' next_date past today. Occurrences and the date that
+records them commit together, so a run that is interrupted, repeated, or catching
+up after downtime writes each occurrence exactly once. On Postgres batches are
+locked with SKIP LOCKED, so concurrent runs split the work instead of waiting.
+
+Generated receipts update the budget totals and live events like typed ones; they
+have no items, so the product catalog is not involved. The API process runs
+`materialize` on every shard every RECURRING_INTERVAL seconds (set
+RECURRING_WORKER=false when cron runs this module instead). Users being moved to
+another shard are skipped until the move completes.
+
+Usage:
+    python recurring.py status
+    python recurring.py run [--today 2024-05-01] [--batch-size 1000]
+"""
+import argparse
+import asyncio
+import calendar
+import logging
+import os
+import sys
+from datetime import date, datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import func, update
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+import env
+import budgets
+import duplicates
+import events
+import merchants
+import models
+import schemas
+import sharding
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Run the scheduler inside the API process; disable when cron runs `python recurring.py run`
+RECURRING_WORKER = os.getenv("RECURRING_WORKER", "true").lower() in ("1", "true", "yes")
+RECURRING_INTERVAL = float(os.getenv("RECURRING_INTERVAL", "3600"))
+BATCH_SIZE = 1000
+
+EXPENSE_CATEGORIES = {category.value for category in schemas.ExpenseCategory}
+INCOME_CATEGORIES = {category.value for category in schemas.IncomeCategory}
+
+
+# Schedule
+
+def _month_day(year: int, month: int, day: int) -> date:
+    return date(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+
+def _add_months(day: date, months: int, day_of_month: int) -> date:
+    index = day.year * 12 + day.month - 1 + months
+    return _month_day(index // 12, index % 12 + 1, day_of_month)
+
+
+def next_occurrence(template: models.RecurringTemplate, after: date) -> Optional[date]:
+    """The occurrence following `after`, or None past the end date"""
+    if template.frequency == schemas.RecurringFrequency.WEEKLY.value:
+        following = after + timedelta(weeks=template.interval)
+    else:
+        following = _add_months(after, template.interval, template.day)
+    if template.end_date and following > template.end_date:
+        return None
+    return following
+
+
+def first_occurrence(template: models.RecurringTemplate, on_or_after: date) -> Optional[date]:
+    """The first occurrence on or after a date, counting intervals from the start date"""
+    start = template.start_date
+    if template.frequency == schemas.RecurringFrequency.WEEKLY.value:
+        occurrence = start + timedelta(days=(template.day - 1 - start.weekday()) % 7)
+    else:
+        occurrence = _month_day(start.year, start.month, template.day)
+        if occurrence < start:
+            occurrence = _add_months(occurrence, 1, template.day)
+    if template.end_date and occurrence > template.end_date:
+        return None
+    while occurrence is not None and occurrence < on_or_after:
+        occurrence = next_occurrence(template, occurrence)
+    return occurrence
+
+
+# Materialization
+
+def _materialize(db: Session, templates: List[models.RecurringTemplate], today: date) -> int:
+    """Write the due occurrences of some templates and advance them; the caller commits"""
+    now = datetime.utcnow()
+    receipts, incomes, advances = [], [], []
+    spending = []
+    for template in templates:
+        day, last = template.next_date, template.last_date
+        while day is not None and day <= today:
+            if template.kind == schemas.RecurringKind.RECEIPT.value:
+                receipts.append({
+                    "user_id": template.user_id, "merchant_name": template.name, "merchant_id": template.merchant_id,
+                    "date": day, "total_amount": template.amount, "total_amount_minor": template.amount_minor,
+                    "currency": template.currency, "category": template.category, "created_at": now,
+                    "fingerprint": duplicates.fingerprint(template.name, day, template.amount_minor, template.currency, ()),
+                })
+                spending.append((
+                    template.user_id, None, budgets.Entry(day, template.category, template.amount_minor, template.currency)
+                ))
+            else:
+                incomes.append({
+                    "user_id": template.user_id, "source": template.name, "amount": template.amount,
+                    "amount_minor": template.amount_minor, "currency": template.currency,
+                    "category": template.category, "date": day, "description": template.description,
+                    "created_at": now,
+                })
+            last = day
+            day = next_occurrence(template, day)
+        advances.append({"id": template.id, "next_date": day, "last_date": last})
+
+    # One new state per receipt, in order
+    for row, counted in zip(receipts, budgets.apply_many(db, spending)):
+        row["budget_minor"] = counted
+    if receipts:
+        db.execute(models.Receipt.__table__.insert(), receipts)
+    if incomes:
+        db.execute(models.Income.__table__.insert(), incomes)
+    if advances:
+        db.execute(update(models.RecurringTemplate).execution_options(synchronize_session=False), advances)
+    for rows, type_ in ((receipts, "receipt"), (incomes, "income")):
+        for user_id in {row["user_id"] for row in rows}:
+            events.record(db, user_id, type_, "created", None)
+    return len(receipts) + len(incomes)
+
+
+def materialize(db: Session, today: Optional[date] = None, batch_size: int = BATCH_SIZE, log=None) -> int:
+    """Write every occurrence due up to `today` for all users; returns the rows created"""
+    today = today or date.today()
+    moving = sharding.moving_users()
+    total = 0
+    while True:
+        # Materialized templates leave the due set, so each query starts from the top
+        query = db.query(models.RecurringTemplate).filter(models.RecurringTemplate.next_date <= today)
+        if moving:
+            query = query.filter(models.RecurringTemplate.user_id.notin_(moving))
+        templates = query.order_by(
+            models.RecurringTemplate.next_date, models.RecurringTemplate.id
+        ).limit(batch_size).with_for_update(skip_locked=True).all()
+        if not templates:
+            break
+        total += _materialize(db, templates, today)
+        db.commit()
+        if log:
+            log(f"Materialized {total} occurrences")
+    return total
+
+
+def run_once(today: Optional[date] = None, batch_size: int = BATCH_SIZE, log=None) -> int:
+    """`materialize` on every shard"""
+    from database import shard_engines, shard_session
+    created = 0
+    with tracing.span("recurring.materialize") as span:
+        for name in shard_engines:
+            db = shard_session(name)
+            try:
+                created += materialize(db, today, batch_size=batch_size, log=log)
+            finally:
+                db.close()
+        span.set_attribute("recurring.created", created)
+    return created
+
+
+async def run_scheduler(interval: float = RECURRING_INTERVAL) -> None:
+    """Materialize due occurrences now and every `interval` seconds; started by the lifespan"""
+    while True:
+        try:
+            created = await run_in_threadpool(run_once)
+            if created:
+                logger.info(f"Recurring: {created} occurrences materialized")
+        except Exception as e:
+            logger.error(f"Recurring scheduler error: {e}")
+        await asyncio.sleep(interval)
+
+
+# Templates
+
+def _check(template: models.RecurringTemplate) -> None:
+    if template.frequency == schemas.RecurringFrequency.WEEKLY.value and template.day > 7:
+        raise ValueError("Weekly templates take an ISO weekday (1 = Monday to 7 = Sunday) as day")
+    categories = EXPENSE_CATEGORIES if template.kind == schemas.RecurringKind.RECEIPT.value else INCOME_CATEGORIES
+    if template.category not in categories:
+        raise ValueError(f"Invalid {template.kind} category: {template.category}")
+    if template.end_date and template.end_date < template.start_date:
+        raise ValueError("end_date is before start_date")
+
+
+def _schedule(db: Session, template: models.RecurringTemplate) -> models.RecurringTemplate:
+    """Set next_date after a schedule change and write what is already due"""
+    resume = template.last_date + timedelta(days=1) if template.last_date else template.start_date
+    template.next_date = first_occurrence(template, resume)
+    db.flush()
+    if template.next_date and template.next_date <= date.today():
+        _materialize(db, [template], date.today())
+    db.commit()
+    db.refresh(template)
+    return template
+
+
+def get_templates(db: Session, user_id: str) -> List[models.RecurringTemplate]:
+    return db.query(models.RecurringTemplate).filter(
+        models.RecurringTemplate.user_id == user_id
+    ).order_by(models.RecurringTemplate.id).all()
+
+
+def get_template(db: Session, template_id: int, user_id: str) -> Optional[models.RecurringTemplate]:
+    return db.query(models.RecurringTemplate).filter(
+        models.RecurringTemplate.id == template_id, models.RecurringTemplate.user_id == user_id
+    ).first()
+
+
+def create_template(db: Session, template: schemas.RecurringTemplateCreate, user_id: str) -> models.RecurringTemplate:
+    """Create a template and write its occurrences from start_date up to today; ValueError if invalid"""
+    db_template = models.RecurringTemplate(
+        user_id=user_id,
+        kind=template.kind.value,
+        name=template.name,
+        amount=template.amount,
+        currency=template.currency,
+        category=template.category,
+        description=template.description,
+        frequency=template.frequency.value,
+        interval=template.interval,
+        day=template.day,
+        start_date=template.start_date,
+        end_date=template.end_date,
+    )
+    if db_template.kind == schemas.RecurringKind.RECEIPT.value:
+        db_template.merchant_id = merchants.resolve(db, user_id, template.name)
+        if db_template.category is None and db_template.merchant_id is not None:
+            db_template.category = db.get(models.Merchant, db_template.merchant_id).category
+        db_template.category = db_template.category or schemas.ExpenseCategory.UNCATEGORIZED.value
+    else:
+        db_template.category = db_template.category or schemas.IncomeCategory.OTHER.value
+    try:
+        _check(db_template)
+    except ValueError:
+        db.rollback()
+        raise
+    db.add(db_template)
+    return _schedule(db, db_template)
+
+
+def update_template(db: Session, template_id: int, template_update: schemas.RecurringTemplateUpdate,
+                    user_id: str) -> Optional[models.RecurringTemplate]:
+    """Change a template from its next occurrence on; rows already written are left as they are"""
+    db_template = get_template(db, template_id, user_id)
+    if not db_template:
+        return None
+    update_data = template_update.model_dump(exclude_unset=True)
+    if update_data.get("frequency"):
+        update_data["frequency"] = update_data["frequency"].value
+    for field, value in update_data.items():
+        setattr(db_template, field, value)
+    if "name" in update_data and db_template.kind == schemas.RecurringKind.RECEIPT.value:
+        db_template.merchant_id = merchants.resolve(db, user_id, db_template.name)
+    try:
+        _check(db_template)
+    except ValueError:
+        db.rollback()
+        raise
+    if update_data.keys() & {"frequency", "interval", "day", "end_date"}:
+        return _schedule(db, db_template)
+    db.commit()
+    db.refresh(db_template)
+    return db_template
+
+
+def delete_template(db: Session, template_id: int, user_id: str) -> bool:
+    """Stop a template; the receipts and income it already wrote are kept"""
+    db_template = get_template(db, template_id, user_id)
+    if not db_template:
+        return False
+    db.delete(db_template)
+    db.commit()
+    return True
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "run"])
+    parser.add_argument("--today", type=date.fromisoformat, help="materialize up to this date (default: today)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    from database import shard_engines, shard_session
+    today = args.today or date.today()
+    if args.command == "run":
+        print(f"Created {run_once(today, batch_size=args.batch_size, log=print)} rows")
+    total = due = ended = 0
+    for name in shard_engines:
+        db = shard_session(name)
+        try:
+            total += db.query(func.count(models.RecurringTemplate.id)).scalar()
+            due += db.query(func.count(models.RecurringTemplate.id)).filter(
+                models.RecurringTemplate.next_date <= today
+            ).scalar()
+            ended += db.query(func.count(models.RecurringTemplate.id)).filter(
+                models.RecurringTemplate.next_date == None
+            ).scalar()
+        finally:
+            db.close()
+    print(f"Templates:    {total}")
+    print(f"Due:          {due}")
+    print(f"Ended:        {ended}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,43 @@
+from fastapi import Response
+from pydantic import BaseModel, TypeAdapter
+from typing import Any, Dict, Type
+import os
+
+import env
+
+# Opt-in fast serialization path for large responses.
+# When enabled, hot endpoints validate their ORM rows once and encode them with
+# pydantic-core straight to bytes, instead of FastAPI validating the return value
+# against response_model and re-encoding it through jsonable_encoder + json.dumps.
+FAST_JSON_RESPONSES = os.getenv("FAST_JSON_RESPONSES", "false").lower() in ("1", "true", "yes")
+
+_adapters: Dict[Type[BaseModel], TypeAdapter] = {}
+
+
+def _get_adapter(model: Type[BaseModel]) -> TypeAdapter:
+    adapter = _adapters.get(model)
+    if adapter is None:
+        adapter = _adapters[model] = TypeAdapter(model)
+    return adapter
+
+
+def dump_json(model: Type[BaseModel], content: Any) -> bytes:
+    """
+    Serialize content (pydantic model, ORM object or dict of ORM objects) as `model`.
+    Output matches Starlette's JSONResponse encoding (compact separators, UTF-8,
+    no ASCII escaping), so clients see the same bytes on either path.
+    """
+    adapter = _get_adapter(model)
+    if not isinstance(content, model):
+        content = adapter.validate_python(content, from_attributes=True)
+    return adapter.dump_json(content)
+
+
+def fast_json_response(model: Type[BaseModel], content: Any, status_code: int = 200) -> Any:
+    """
+    Return a pre-encoded JSON Response when FAST_JSON_RESPONSES is on.
+    Otherwise hand `content` back unchanged so FastAPI's response_model path applies.
+    """
+    if not FAST_JSON_RESPONSES:
+        return content
+    return Response(content=dump_json(model, content), status_code=status_code, media_type="application/json")
@@ -1,8 +1,11 @@
-from typing import List, Optional
-from pydantic import BaseModel
+from typing import Annotated, Any, Dict, List, Optional
+from pydantic import AfterValidator, BaseModel, Field
 import datetime
 from enum import Enum
 
+# ISO code as written: upper-cased, or it never matches exchange_rates ("eur" vs "EUR")
+Currency = Annotated[str, AfterValidator(lambda code: code.strip().upper())]
+
 class ExpenseCategory(str, Enum):
     FOOD = "Food"
     TRANSPORTATION = "Transportation"
@@ -46,7 +49,7 @@ class ReceiptBase(BaseModel):
     merchant_name: Optional[str] = None
     date: Optional[datetime.date] = None
     total_amount: Optional[float] = None
-    currency: Optional[str] = "TND"
+    currency: Optional[Currency] = "TND"
     category: Optional[ExpenseCategory] = ExpenseCategory.UNCATEGORIZED
     location: Optional[str] = None
     image_url: Optional[str] = None
@@ -62,7 +65,7 @@ class ReceiptUpdate(BaseModel):
     merchant_name: Optional[str] = None
     date: Optional[datetime.date] = None
     total_amount: Optional[float] = None
-    currency: Optional[str] = None
+    currency: Optional[Currency] = None
     category: Optional[ExpenseCategory] = None
     location: Optional[str] = None
     image_url: Optional[str] = None
@@ -70,12 +73,41 @@ class ReceiptUpdate(BaseModel):
 
 class Receipt(ReceiptBase):
     id: int
+    merchant_id: Optional[int] = None
     created_at: datetime.datetime
     items: List[Item] = []
 
     class Config:
         from_attributes = True
 
+class ReceiptCreated(Receipt):
+    possible_duplicates: List[int] = []  # Ids of the user's receipts this one likely repeats
+
+class ReceiptFilter(BaseModel):
+    # Receipts a bulk operation applies to: the GET /receipts/ filters, combined with AND
+    ids: Optional[List[int]] = Field(default=None, max_length=10000)
+    category: Optional[ExpenseCategory] = None
+    merchant_name: Optional[str] = None  # Case-insensitive substring
+    merchant_id: Optional[int] = None
+    start_date: Optional[datetime.date] = None
+    end_date: Optional[datetime.date] = None
+
+class ReceiptBulkDelete(BaseModel):
+    filter: ReceiptFilter
+
+class ReceiptBulkUpdate(BaseModel):
+    filter: ReceiptFilter
+    category: Optional[ExpenseCategory] = None
+    merchant_name: Optional[str] = None
+
+class BulkResult(BaseModel):
+    receipts: int  # Receipts deleted or updated
+    items: int = 0  # Items deleted with them
+
+class DuplicateGroups(BaseModel):
+    groups: List[List[int]]  # Receipt ids that likely record the same purchase
+    pending: int = 0  # Receipts not fingerprinted yet, left out until the find_duplicates job has run
+
 class PaginatedReceipts(BaseModel):
     items: List[Receipt]
     total: int
@@ -94,6 +126,7 @@ class DashboardStats(BaseModel):
 
 class MerchantStat(BaseModel):
     merchant_name: str
+    merchant_id: Optional[int] = None  # Canonical merchant, when the receipts are linked to one
     amount: float
     percentage: float
     count: int
@@ -110,6 +143,75 @@ class DashboardData(BaseModel):
     spending_by_category: List[CategoryStat]
     top_income_sources: List[MerchantStat]  # Reusing MerchantStat for source-based stats
     income_by_category: List[CategoryStat]  # Reusing CategoryStat for category-based stats
+    currency: Optional[str] = None  # All amounts are converted into this currency
+    unconverted: int = 0  # Receipts and income left out of the amounts: no exchange rate into `currency`
+
+class TimeSeriesInterval(str, Enum):
+    DAY = "day"
+    WEEK = "week"
+    MONTH = "month"
+
+class TimeSeriesData(BaseModel):
+    # Columnar layout: spent[i] / income[i] belong to periods[i]
+    interval: TimeSeriesInterval
+    periods: List[datetime.date]
+    spent: List[float]
+    income: List[float]
+    spending_by_category: Optional[Dict[str, List[float]]] = None
+    currency: Optional[str] = None
+
+# Analytics Schemas
+class CategoryTrend(BaseModel):
+    # Monthly series aligned with AnalyticsData.months; None where a delta is undefined
+    category: str
+    totals: List[float]
+    rolling_avg: List[float]
+    mom_delta: List[Optional[float]]
+    mom_pct: List[Optional[float]]
+    yoy_delta: List[Optional[float]]
+    yoy_pct: List[Optional[float]]
+
+class ReceiptOutlier(BaseModel):
+    receipt_id: int
+    merchant_name: str
+    category: str
+    date: datetime.date
+    amount: float
+    score: float
+
+class AnalyticsData(BaseModel):
+    months: List[datetime.date]
+    spending: List[CategoryTrend]
+    income: List[CategoryTrend]
+    outliers: List[ReceiptOutlier]
+    currency: Optional[str] = None
+
+class RecurringSeries(BaseModel):
+    kind: str  # "income" or "expense"
+    name: str  # merchant name or income source
+    category: str
+    period_days: float
+    amount: float
+    occurrences: int
+    last_date: datetime.date
+    next_date: datetime.date
+
+class ForecastPoint(BaseModel):
+    # Projected totals and end-of-month balance, with the confidence band around it.
+    # The first point also carries recurring flows still due later in the current month.
+    month: datetime.date
+    income: float
+    spending: float
+    balance: float
+    lower: float
+    upper: float
+
+class CashFlowForecast(BaseModel):
+    starting_balance: float
+    confidence: float
+    recurring: List[RecurringSeries]
+    months: List[ForecastPoint]
+    currency: Optional[str] = None
 
 # Income Schemas
 class IncomeCategory(str, Enum):
@@ -122,7 +224,7 @@ class IncomeCategory(str, Enum):
 class IncomeBase(BaseModel):
     source: str
     amount: float
-    currency: Optional[str] = "TND"
+    currency: Optional[Currency] = "TND"
     category: IncomeCategory
     date: datetime.date
     description: Optional[str] = None
@@ -133,7 +235,7 @@ class IncomeCreate(IncomeBase):
 class IncomeUpdate(BaseModel):
     source: Optional[str] = None
     amount: Optional[float] = None
-    currency: Optional[str] = None
+    currency: Optional[Currency] = None
     category: Optional[IncomeCategory] = None
     date: Optional[datetime.date] = None
     description: Optional[str] = None
@@ -152,10 +254,10 @@ class PaginatedIncomes(BaseModel):
     limit: int
 
 class SettingsBase(BaseModel):
-    currency: str = "TND"
+    currency: Currency = "TND"
 
 class SettingsUpdate(BaseModel):
-    currency: Optional[str] = "TND"
+    currency: Optional[Currency] = "TND"
 
 class Settings(SettingsBase):
     id: int
@@ -163,6 +265,18 @@ class Settings(SettingsBase):
     class Config:
         from_attributes = True
 
+class ExchangeRateCreate(BaseModel):
+    date: datetime.date
+    base_currency: str = Field(min_length=3, max_length=3)
+    quote_currency: str = Field(min_length=3, max_length=3)
+    rate: float = Field(gt=0)
+
+class ExchangeRate(ExchangeRateCreate):
+    id: int
+
+    class Config:
+        from_attributes = True
+
 class UserCreate(BaseModel):
     id: str
     email: str
@@ -182,3 +296,171 @@ class User(BaseModel):
 
     class Config:
         from_attributes = True
+
+class Job(BaseModel):
+    id: int
+    kind: str
+    user_id: Optional[str] = None
+    status: str
+    attempts: int
+    max_attempts: int
+    run_after: datetime.datetime
+    last_error: Optional[str] = None
+    result: Optional[Dict[str, Any]] = None
+    created_at: datetime.datetime
+    finished_at: Optional[datetime.datetime] = None
+
+    class Config:
+        from_attributes = True
+
+# Product catalog Schemas
+class Product(BaseModel):
+    id: int
+    name: str
+    purchases: int = 0
+    last_date: Optional[datetime.date] = None
+
+    class Config:
+        from_attributes = True
+
+class PricePoint(BaseModel):
+    date: datetime.date
+    merchant_name: Optional[str] = None
+    price: float  # Unit price, converted into the response currency
+    quantity: int
+    receipt_id: int
+
+class PriceHistory(BaseModel):
+    product: Product
+    points: List[PricePoint]
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    avg_price: Optional[float] = None
+    currency: Optional[str] = None
+
+class MerchantPrice(BaseModel):
+    merchant_name: str
+    min_price: float
+    avg_price: float
+    purchases: int
+    last_date: datetime.date
+
+class CheapestMerchants(BaseModel):
+    product: Product
+    merchants: List[MerchantPrice]
+    since: Optional[datetime.date] = None
+    currency: Optional[str] = None
+
+# Merchant Schemas
+class Merchant(BaseModel):
+    id: int
+    name: str
+    category: Optional[str] = None
+    receipts: int = 0
+
+    class Config:
+        from_attributes = True
+
+class MerchantSuggestion(BaseModel):
+    id: int
+    name: str
+    category: Optional[str] = None
+
+class MerchantMerge(BaseModel):
+    into_id: int
+
+class MerchantMergeSuggestion(BaseModel):
+    # Confirmed with POST /merchants/{source_id}/merge {"into_id": into_id}
+    source_id: int
+    source_name: str
+    into_id: int
+    into_name: str
+
+class BuySuggestion(BaseModel):
+    product_id: int
+    name: str
+    interval_days: float  # "You usually buy it every N days"
+    purchases: int
+    last_date: datetime.date
+    next_date: datetime.date
+    due_in_days: int  # Negative when overdue
+    confidence: float
+
+# Budget Schemas
+class BudgetBase(BaseModel):
+    category: Optional[ExpenseCategory] = None  # None: all spending
+    amount: float = Field(gt=0)  # Monthly limit in the user's settings currency
+    thresholds: List[Annotated[int, Field(ge=1, le=1000)]] = Field(default=[80, 100], min_length=1)  # Percent of the amount
+
+class BudgetCreate(BudgetBase):
+    pass
+
+class BudgetUpdate(BaseModel):
+    amount: Optional[float] = Field(default=None, gt=0)
+    thresholds: Optional[List[Annotated[int, Field(ge=1, le=1000)]]] = Field(default=None, min_length=1)
+
+class Budget(BudgetBase):
+    id: int
+    category: Optional[str] = None
+    month: datetime.date
+    spent: float  # This month so far
+    remaining: float
+    percent: float
+    currency: Optional[str] = None
+
+class BudgetAlert(BaseModel):
+    id: int
+    budget_id: int
+    category: Optional[str] = None
+    month: datetime.date
+    threshold: int
+    spent: float
+    limit: float
+    created_at: datetime.datetime
+    read: bool
+
+class BudgetAlertsRead(BaseModel):
+    up_to_id: int
+
+class RecurringKind(str, Enum):
+    RECEIPT = "receipt"
+    INCOME = "income"
+
+class RecurringFrequency(str, Enum):
+    WEEKLY = "weekly"
+    MONTHLY = "monthly"
+
+class RecurringTemplateBase(BaseModel):
+    kind: RecurringKind
+    name: str  # Merchant name for receipts, source for income
+    amount: float = Field(gt=0)
+    currency: Optional[Currency] = "TND"
+    category: Optional[str] = None  # An ExpenseCategory or IncomeCategory value, by kind
+    description: Optional[str] = None
+    frequency: RecurringFrequency = RecurringFrequency.MONTHLY
+    interval: int = Field(default=1, ge=1, le=52)  # Every N weeks or months
+    day: int = Field(ge=1, le=31)  # Day of the month, or ISO weekday (1 = Monday) when weekly
+    start_date: datetime.date
+    end_date: Optional[datetime.date] = None
+
+class RecurringTemplateCreate(RecurringTemplateBase):
+    pass
+
+class RecurringTemplateUpdate(BaseModel):
+    name: Optional[str] = None
+    amount: Optional[float] = Field(default=None, gt=0)
+    currency: Optional[Currency] = None
+    category: Optional[str] = None
+    description: Optional[str] = None
+    frequency: Optional[RecurringFrequency] = None
+    interval: Optional[int] = Field(default=None, ge=1, le=52)
+    day: Optional[int] = Field(default=None, ge=1, le=31)
+    end_date: Optional[datetime.date] = None
+
+class RecurringTemplate(RecurringTemplateBase):
+    id: int
+    last_date: Optional[datetime.date] = None
+    next_date: Optional[datetime.date] = None  # None once the template has ended
+
+    class Config:
+        from_attributes = True
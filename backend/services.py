@@ -1,25 +1,59 @@
 from sqlalchemy.orm import Session, selectinload
-from sqlalchemy import func, extract
+from sqlalchemy import func, case, literal, literal_column, cast, union_all, Integer, String, Date
 from typing import List, Optional, Tuple, Any
 from datetime import datetime, timedelta, date
 import models
 import schemas
+import fx
+import catalog
+import duplicates
+import merchants
+import suggestions
+import budgets
+import events
+import jobs
+from money import from_minor, minor_amount
+
+BULK_CHUNK_SIZE = 1000
 
 
 # Receipt CRUD Operations
+def _reindex_receipt(db: Session, receipt: models.Receipt) -> None:
+    """
+    Refresh the price history of a receipt's items, the buying patterns it feeds and
+    its fingerprint. Only exact catalog hits are indexed here; new names queue the
+    index_receipt job, which runs once the caller commits.
+    """
+    resolver = catalog.Resolver(db, receipt.user_id, exact=True)
+    suggestions.refresh(db, receipt.user_id, catalog.index_receipt(db, receipt, resolver))
+    duplicates.refresh(db, receipt)
+    if resolver.missed:
+        jobs.enqueue(db, "index_receipt", {"receipt_id": receipt.id}, user_id=receipt.user_id, commit=False)
+
+
 def create_receipt(db: Session, receipt: schemas.ReceiptCreate, user_id: str) -> models.Receipt:
     """Create a new receipt with associated items (new or pending)"""
+    merchant_id = merchants.resolve(db, user_id, receipt.merchant_name)
+    category = receipt.category.value if receipt.category else "Uncategorized"
+    if "category" not in receipt.model_fields_set and merchant_id is not None:
+        # No category given: use the one suggested for the merchant
+        category = db.get(models.Merchant, merchant_id).category or category
+
     # Create receipt instance
     db_receipt = models.Receipt(
         merchant_name=receipt.merchant_name,
+        merchant_id=merchant_id,
         date=receipt.date,
         total_amount=receipt.total_amount,
         currency=receipt.currency,
-        category=receipt.category.value if receipt.category else "Uncategorized",
+        category=category,
         location=receipt.location,
         image_url=receipt.image_url,
+        image_hash=duplicates.image_hash(receipt.image_url),
         user_id=user_id
     )
+    merchants.learn_category(db, merchant_id, category)
+    db_receipt.budget_minor = budgets.apply(db, user_id, None, budgets.entry(db_receipt))
     
     db.add(db_receipt)
     db.flush()  # Get the receipt ID
@@ -57,8 +91,12 @@ def create_receipt(db: Session, receipt: schemas.ReceiptCreate, user_id: str) ->
             # the expense data is on the RECEIPT. 
             pass
 
+    _reindex_receipt(db, db_receipt)
+    # Saved either way; the caller shows the likely duplicates so the user can remove one
+    possible_duplicates = duplicates.find(db, db_receipt)
     db.commit()
     db.refresh(db_receipt)
+    db_receipt.possible_duplicates = possible_duplicates
     return db_receipt
 
 
@@ -70,6 +108,31 @@ def get_receipt(db: Session, receipt_id: int, user_id: str) -> Optional[models.R
     ).first()
 
 
+def _filter_receipts(
+    query,
+    category: Optional[str] = None,
+    merchant_name: Optional[str] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    merchant_id: Optional[int] = None,
+    ids: Optional[List[int]] = None
+):
+    """The receipt list filters, shared with the bulk operations"""
+    if ids is not None:
+        query = query.filter(models.Receipt.id.in_(ids))
+    if start_date:
+        query = query.filter(models.Receipt.date >= start_date)
+    if end_date:
+        query = query.filter(models.Receipt.date <= end_date)
+    if category:
+        query = query.filter(models.Receipt.category == category)
+    if merchant_name:
+        query = query.filter(models.Receipt.merchant_name.ilike(f"%{merchant_name}%"))
+    if merchant_id:
+        query = query.filter(models.Receipt.merchant_id == merchant_id)
+    return query
+
+
 def get_receipts(
     db: Session, 
     user_id: str,
@@ -78,15 +141,17 @@ def get_receipts(
     sort_by: str = "date",
     order: str = "desc",
     category: Optional[str] = None,
-    merchant_name: Optional[str] = None
+    merchant_name: Optional[str] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    merchant_id: Optional[int] = None
 ) -> Tuple[List[models.Receipt], int]:
     """Retrieve receipts with optional filtering, sorting and pagination"""
-    query = db.query(models.Receipt).filter(models.Receipt.user_id == user_id)
-    
-    if category:
-        query = query.filter(models.Receipt.category == category)
-    if merchant_name:
-        query = query.filter(models.Receipt.merchant_name.ilike(f"%{merchant_name}%"))
+    query = _filter_receipts(
+        db.query(models.Receipt).filter(models.Receipt.user_id == user_id),
+        category=category, merchant_name=merchant_name, start_date=start_date, end_date=end_date,
+        merchant_id=merchant_id
+    )
     
     total = query.count()
     
@@ -107,14 +172,17 @@ def get_receipts(
 
 def update_receipt(db: Session, receipt_id: int, receipt_update: schemas.ReceiptUpdate, user_id: str) -> Optional[models.Receipt]:
     """Update a receipt and optionally its items"""
+    # Locked until commit: concurrent edits of the receipt must not both apply a delta from the same old values
     db_receipt = db.query(models.Receipt).filter(
         models.Receipt.id == receipt_id,
         models.Receipt.user_id == user_id
-    ).first()
+    ).with_for_update().first()
     
     if not db_receipt:
         return None
     
+    before = budgets.entry(db_receipt)
+
     # Update receipt fields
     update_data = receipt_update.dict(exclude_unset=True, exclude={'items'})
     
@@ -124,6 +192,11 @@ def update_receipt(db: Session, receipt_id: int, receipt_update: schemas.Receipt
     
     for field, value in update_data.items():
         setattr(db_receipt, field, value)
+    if 'merchant_name' in update_data:
+        db_receipt.merchant_id = merchants.resolve(db, user_id, db_receipt.merchant_name)
+    if 'image_url' in update_data:
+        db_receipt.image_hash = duplicates.image_hash(db_receipt.image_url)
+    db_receipt.budget_minor = budgets.apply(db, user_id, before, budgets.entry(db_receipt))
     
     # Handle items update if provided
     if receipt_update.items is not None:
@@ -136,10 +209,12 @@ def update_receipt(db: Session, receipt_id: int, receipt_update: schemas.Receipt
                 name=item_data.name,
                 price=item_data.price,
                 quantity=item_data.quantity,
-                receipt_id=receipt_id
+                receipt_id=receipt_id,
+                user_id=user_id
             )
             db.add(db_item)
     
+    _reindex_receipt(db, db_receipt)
     db.commit()
     db.refresh(db_receipt)
     return db_receipt
@@ -150,16 +225,101 @@ def delete_receipt(db: Session, receipt_id: int, user_id: str) -> bool:
     db_receipt = db.query(models.Receipt).filter(
         models.Receipt.id == receipt_id,
         models.Receipt.user_id == user_id
-    ).first()
+    ).with_for_update().first()
     
     if not db_receipt:
         return False
     
+    suggestions.refresh(db, user_id, catalog.unindex_receipt(db, receipt_id))
+    budgets.apply(db, user_id, budgets.entry(db_receipt), None)
     db.delete(db_receipt)
     db.commit()
     return True
 
 
+# Bulk receipt operations: set-based statements over the matching ids, in one transaction
+
+def _select_receipts(db: Session, user_id: str, selection: schemas.ReceiptFilter):
+    return _filter_receipts(
+        db.query(models.Receipt).filter(models.Receipt.user_id == user_id),
+        category=selection.category.value if selection.category else None,
+        merchant_name=selection.merchant_name,
+        start_date=selection.start_date,
+        end_date=selection.end_date,
+        merchant_id=selection.merchant_id,
+        ids=selection.ids
+    )
+
+
+def _chunks(ids: List[int]):
+    for start in range(0, len(ids), BULK_CHUNK_SIZE):
+        yield ids[start:start + BULK_CHUNK_SIZE]
+
+
+def bulk_delete_receipts(db: Session, user_id: str, selection: schemas.ReceiptFilter) -> schemas.BulkResult:
+    """Delete every matching receipt with its items, price history and uploaded image"""
+    # Locked in id order until commit, so the budget deltas use the values actually deleted
+    rows = _select_receipts(db, user_id, selection).with_entities(
+        models.Receipt.id, models.Receipt.date, models.Receipt.category,
+        models.Receipt.total_amount_minor, models.Receipt.currency, models.Receipt.budget_minor,
+        models.Receipt.image_url
+    ).order_by(models.Receipt.id).with_for_update().all()
+    if not rows:
+        return schemas.BulkResult(receipts=0)
+
+    product_ids, items = set(), 0
+    for chunk in _chunks([row.id for row in rows]):
+        product_ids |= catalog.unindex_receipts(db, chunk)
+        # Explicit rather than ON DELETE CASCADE: partitioned receipts cannot be an FK target
+        items += db.query(models.Item).filter(models.Item.receipt_id.in_(chunk)).delete(synchronize_session=False)
+        db.query(models.Receipt).filter(models.Receipt.id.in_(chunk)).delete(synchronize_session=False)
+    suggestions.refresh(db, user_id, product_ids)
+    budgets.apply_many(db, [(user_id, budgets.entry(row), None) for row in rows])
+    files = [name for name in (jobs.upload_filename(row.image_url) for row in rows) if name]
+    if files:
+        jobs.enqueue(db, "delete_uploads", {"filenames": files}, user_id=user_id, commit=False)
+    events.record(db, user_id, "receipt", "deleted", None)
+    db.commit()
+    return schemas.BulkResult(receipts=len(rows), items=items)
+
+
+def bulk_update_receipts(db: Session, user_id: str, bulk_update: schemas.ReceiptBulkUpdate) -> schemas.BulkResult:
+    """Set the category and/or merchant of every matching receipt"""
+    values = {}
+    if bulk_update.category is not None:
+        values[models.Receipt.category] = bulk_update.category.value
+    if bulk_update.merchant_name is not None:
+        values[models.Receipt.merchant_name] = bulk_update.merchant_name
+        values[models.Receipt.merchant_id] = merchants.resolve(db, user_id, bulk_update.merchant_name)
+    # Locked in id order until commit: concurrent recategorizations wait, then see the categories this one wrote
+    rows = _select_receipts(db, user_id, bulk_update.filter).with_entities(
+        models.Receipt.id, models.Receipt.date, models.Receipt.category,
+        models.Receipt.total_amount_minor, models.Receipt.currency, models.Receipt.budget_minor
+    ).order_by(models.Receipt.id).with_for_update().all()
+    if not rows or not values:
+        db.rollback()
+        return schemas.BulkResult(receipts=0)
+
+    for chunk in _chunks([row.id for row in rows]):
+        db.query(models.Receipt).filter(models.Receipt.id.in_(chunk)).update(values, synchronize_session=False)
+        if bulk_update.merchant_name is not None:
+            db.query(models.ProductPrice).filter(models.ProductPrice.receipt_id.in_(chunk)).update(
+                {models.ProductPrice.merchant_name: bulk_update.merchant_name}, synchronize_session=False
+            )
+            duplicates.refresh_many(db, chunk)
+    if bulk_update.category is not None:
+        # Amounts are unchanged, so each receipt moves what it counted for (budget_minor stays)
+        budgets.apply_many(db, [
+            (user_id, budgets.entry(row), budgets.entry(row)._replace(category=bulk_update.category.value))
+            for row in rows if row.category != bulk_update.category.value
+        ])
+    events.record(db, user_id, "receipt", "updated", None)
+    db.commit()
+
+    merchants.refresh_categories(db, user_id)
+    return schemas.BulkResult(receipts=len(rows))
+
+
 # Item CRUD Operations
 def create_item(db: Session, item: schemas.ItemCreate, user_id: str, receipt_id: Optional[int] = None) -> models.Item:
     """Create a new item (either for a receipt or pending)"""
@@ -171,6 +331,8 @@ def create_item(db: Session, item: schemas.ItemCreate, user_id: str, receipt_id:
         user_id=user_id
     )
     db.add(db_item)
+    if receipt_id is not None:
+        _reindex_receipt(db, db.get(models.Receipt, receipt_id))
     db.commit()
     db.refresh(db_item)
     return db_item
@@ -251,6 +413,7 @@ def update_item(db: Session, item_id: int, item_update: schemas.ItemCreate, user
     db_item.name = item_update.name
     db_item.price = item_update.price
     db_item.quantity = item_update.quantity
+    _reindex_receipt(db, db_item.receipt)
     
     db.commit()
     db.refresh(db_item)
@@ -267,7 +430,9 @@ def delete_item(db: Session, item_id: int, user_id: str) -> bool:
     if not db_item:
         return False
     
+    receipt = db_item.receipt
     db.delete(db_item)
+    _reindex_receipt(db, receipt)
     db.commit()
     return True
 
@@ -276,6 +441,17 @@ def delete_item(db: Session, item_id: int, user_id: str) -> bool:
 def get_dashboard_stats(db: Session, user_id: str, start_date: Optional[date] = None, end_date: Optional[date] = None) -> schemas.DashboardData:
     """Calculate dashboard statistics with optional date range filtering"""
     
+    # Amounts are summed as integer minor units, converted into the user's settings currency
+    # (an amount in a currency without a rate converts to NULL: left out, and counted in `unconverted`)
+    currency = fx.user_currency(db, user_id)
+    receipt_minor = minor_amount(models.Receipt.total_amount_minor, models.Receipt.total_amount)
+    income_minor = minor_amount(models.Income.amount_minor, models.Income.amount)
+    receipt_amount = fx.converted(receipt_minor, models.Receipt.currency, models.Receipt.date, currency)
+    income_amount = fx.converted(income_minor, models.Income.currency, models.Income.date, currency)
+    # Labelled sums let GROUP BY queries order by the alias instead of repeating the conversion
+    receipt_total = func.sum(receipt_amount).label('amount')
+    income_total = func.sum(income_amount).label('amount')
+
     # Base queries for receipts and income
     receipt_query = db.query(models.Receipt).filter(models.Receipt.user_id == user_id)
     income_query = db.query(models.Income).filter(models.Income.user_id == user_id)
@@ -302,24 +478,32 @@ def get_dashboard_stats(db: Session, user_id: str, start_date: Optional[date] =
     # Logic: "This Month" usually means generic "current calendar month" stats, while charts follow filters.
     # However, filtering by user is MUST.
     
+    # A date range rather than extract(month/year), so partitioned tables prune to one month
+    month_start = date(current_year, current_month, 1)
     this_month_query = db.query(func.count(models.Receipt.id)).filter(
         models.Receipt.user_id == user_id,
-        extract('month', models.Receipt.date) == current_month,
-        extract('year', models.Receipt.date) == current_year
+        models.Receipt.date >= month_start,
+        models.Receipt.date < _next_period(month_start, schemas.TimeSeriesInterval.MONTH)
     )
     this_month = this_month_query.scalar()
     
     # Total spent in range
-    total_spent = receipt_query.with_entities(func.sum(models.Receipt.total_amount)).scalar() or 0.0
+    total_spent, unconverted_receipts = receipt_query.with_entities(
+        func.sum(receipt_amount), func.count(receipt_minor) - func.count(receipt_amount)
+    ).one()
+    total_spent = float(total_spent or 0)
     
     # Total income in range
-    total_income = income_query.with_entities(func.sum(models.Income.amount)).scalar() or 0.0
+    total_income, unconverted_income = income_query.with_entities(
+        func.sum(income_amount), func.count(income_minor) - func.count(income_amount)
+    ).one()
+    total_income = float(total_income or 0)
     
     # Average receipt in range
-    avg_receipt = receipt_query.with_entities(func.avg(models.Receipt.total_amount)).scalar() or 0.0
+    avg_receipt = float(receipt_query.with_entities(func.avg(receipt_amount)).scalar() or 0)
     
     # Most expensive in range
-    most_expensive = receipt_query.with_entities(func.max(models.Receipt.total_amount)).scalar() or 0.0
+    most_expensive = float(receipt_query.with_entities(func.max(receipt_amount)).scalar() or 0)
     
     # Receipts per week (last 30 days - keeping this static as a "velocity" indicator)
     thirty_days_ago = datetime.now() - timedelta(days=30)
@@ -329,19 +513,26 @@ def get_dashboard_stats(db: Session, user_id: str, start_date: Optional[date] =
     ).scalar()
     receipts_per_week = (recent_receipts_count / 4.0) if recent_receipts_count else 0.0
     
-    # Top merchants in range
+    # Top merchants in range, grouped on the integer merchant id; receipts the
+    # normalizer has not linked yet are grouped on their raw name
+    unlinked_name = case((models.Receipt.merchant_id == None, models.Receipt.merchant_name))
     top_merchants_data = receipt_query.with_entities(
-        models.Receipt.merchant_name,
-        func.sum(models.Receipt.total_amount).label('amount'),
+        models.Receipt.merchant_id,
+        unlinked_name.label('merchant_name'),
+        receipt_total,
         func.count(models.Receipt.id).label('count')
-    ).group_by(models.Receipt.merchant_name).order_by(func.sum(models.Receipt.total_amount).desc()).limit(5).all()
+    ).group_by(models.Receipt.merchant_id, unlinked_name).order_by(receipt_total.desc().nulls_last()).limit(5).all()
+    merchant_names = dict(db.query(models.Merchant.id, models.Merchant.name).filter(
+        models.Merchant.id.in_([m.merchant_id for m in top_merchants_data if m.merchant_id is not None])
+    ).all())
     
     top_merchants = []
     for merchant in top_merchants_data:
-        percentage = (merchant.amount / total_spent * 100) if total_spent > 0 else 0
+        percentage = (float(merchant.amount or 0) / total_spent * 100) if total_spent > 0 else 0
         top_merchants.append(schemas.MerchantStat(
-            merchant_name=merchant.merchant_name,
-            amount=merchant.amount,
+            merchant_id=merchant.merchant_id,
+            merchant_name=merchant_names.get(merchant.merchant_id) or merchant.merchant_name or "Unknown",
+            amount=from_minor(merchant.amount or 0),
             percentage=round(percentage, 2),
             count=merchant.count
         ))
@@ -349,16 +540,16 @@ def get_dashboard_stats(db: Session, user_id: str, start_date: Optional[date] =
     # Spending by category in range
     category_data = receipt_query.with_entities(
         models.Receipt.category,
-        func.sum(models.Receipt.total_amount).label('amount'),
+        receipt_total,
         func.count(models.Receipt.id).label('count')
-    ).group_by(models.Receipt.category).order_by(func.sum(models.Receipt.total_amount).desc()).all()
+    ).group_by(models.Receipt.category).order_by(receipt_total.desc().nulls_last()).all()
     
     spending_by_category = []
     for category in category_data:
-        percentage = (category.amount / total_spent * 100) if total_spent > 0 else 0
+        percentage = (float(category.amount or 0) / total_spent * 100) if total_spent > 0 else 0
         spending_by_category.append(schemas.CategoryStat(
             category=category.category,
-            amount=category.amount,
+            amount=from_minor(category.amount or 0),
             percentage=round(percentage, 2),
             count=category.count
         ))
@@ -366,16 +557,16 @@ def get_dashboard_stats(db: Session, user_id: str, start_date: Optional[date] =
     # Income by category in range
     income_category_data = income_query.with_entities(
         models.Income.category,
-        func.sum(models.Income.amount).label('amount'),
+        income_total,
         func.count(models.Income.id).label('count')
-    ).group_by(models.Income.category).order_by(func.sum(models.Income.amount).desc()).all()
+    ).group_by(models.Income.category).order_by(income_total.desc().nulls_last()).all()
     
     income_by_category = []
     for category in income_category_data:
-        percentage = (category.amount / total_income * 100) if total_income > 0 else 0
+        percentage = (float(category.amount or 0) / total_income * 100) if total_income > 0 else 0
         income_by_category.append(schemas.CategoryStat(
             category=category.category,
-            amount=category.amount,
+            amount=from_minor(category.amount or 0),
             percentage=round(percentage, 2),
             count=category.count
         ))
@@ -383,16 +574,16 @@ def get_dashboard_stats(db: Session, user_id: str, start_date: Optional[date] =
     # Top income sources in range
     top_income_sources_data = income_query.with_entities(
         models.Income.source,
-        func.sum(models.Income.amount).label('amount'),
+        income_total,
         func.count(models.Income.id).label('count')
-    ).group_by(models.Income.source).order_by(func.sum(models.Income.amount).desc()).limit(5).all()
+    ).group_by(models.Income.source).order_by(income_total.desc().nulls_last()).limit(5).all()
     
     top_income_sources = []
     for source in top_income_sources_data:
-        percentage = (source.amount / total_income * 100) if total_income > 0 else 0
+        percentage = (float(source.amount or 0) / total_income * 100) if total_income > 0 else 0
         top_income_sources.append(schemas.MerchantStat(
             merchant_name=source.source,
-            amount=source.amount,
+            amount=from_minor(source.amount or 0),
             percentage=round(percentage, 2),
             count=source.count
         ))
@@ -400,10 +591,10 @@ def get_dashboard_stats(db: Session, user_id: str, start_date: Optional[date] =
     stats = schemas.DashboardStats(
         total_receipts=total_receipts,
         this_month=this_month or 0,
-        total_spent=round(total_spent, 2),
-        total_income=round(total_income, 2),
-        avg_receipt=round(avg_receipt, 2),
-        most_expensive=round(most_expensive, 2),
+        total_spent=from_minor(total_spent),
+        total_income=from_minor(total_income),
+        avg_receipt=from_minor(avg_receipt),
+        most_expensive=from_minor(most_expensive),
         receipts_per_week=round(receipts_per_week, 2)
     )
     
@@ -412,7 +603,126 @@ def get_dashboard_stats(db: Session, user_id: str, start_date: Optional[date] =
         top_merchants=top_merchants,
         spending_by_category=spending_by_category,
         top_income_sources=top_income_sources,
-        income_by_category=income_by_category
+        income_by_category=income_by_category,
+        currency=currency,
+        unconverted=(unconverted_receipts or 0) + (unconverted_income or 0)
+    )
+
+def _period_bucket(db: Session, column, interval: schemas.TimeSeriesInterval):
+    """SQL expression truncating a date column to the start of its day/week/month bucket"""
+    if db.bind.dialect.name == "postgresql":
+        # Inline the unit so the SELECT and GROUP BY expressions compile identically
+        return cast(func.date_trunc(literal_column(f"'{interval.value}'"), column), Date)
+    # SQLite: weeks start on Monday to match Postgres date_trunc('week')
+    if interval == schemas.TimeSeriesInterval.MONTH:
+        return func.strftime('%Y-%m-01', column)
+    if interval == schemas.TimeSeriesInterval.WEEK:
+        weekday = (cast(func.strftime('%w', column), Integer) + 6) % 7
+        return func.date(column, '-' + cast(weekday, String) + ' days')
+    return func.date(column)
+
+
+def _truncate_date(value: date, interval: schemas.TimeSeriesInterval) -> date:
+    if interval == schemas.TimeSeriesInterval.MONTH:
+        return value.replace(day=1)
+    if interval == schemas.TimeSeriesInterval.WEEK:
+        return value - timedelta(days=value.weekday())
+    return value
+
+
+def _next_period(value: date, interval: schemas.TimeSeriesInterval) -> date:
+    if interval == schemas.TimeSeriesInterval.MONTH:
+        return date(value.year + value.month // 12, value.month % 12 + 1, 1)
+    if interval == schemas.TimeSeriesInterval.WEEK:
+        return value + timedelta(days=7)
+    return value + timedelta(days=1)
+
+
+def get_dashboard_timeseries(
+    db: Session,
+    user_id: str,
+    interval: schemas.TimeSeriesInterval = schemas.TimeSeriesInterval.MONTH,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    by_category: bool = False
+) -> schemas.TimeSeriesData:
+    """Spending and income bucketed by day/week/month in a single query, with empty buckets filled in"""
+    currency = fx.user_currency(db, user_id)
+    receipt_bucket = _period_bucket(db, models.Receipt.date, interval)
+    income_bucket = _period_bucket(db, models.Income.date, interval)
+
+    receipt_category = models.Receipt.category if by_category else literal(None, String)
+    receipts = db.query(
+        receipt_bucket.label('period'),
+        literal('spent').label('kind'),
+        receipt_category.label('category'),
+        func.sum(fx.converted(
+            minor_amount(models.Receipt.total_amount_minor, models.Receipt.total_amount),
+            models.Receipt.currency, models.Receipt.date, currency
+        )).label('amount')
+    ).filter(models.Receipt.user_id == user_id)
+    incomes = db.query(
+        income_bucket.label('period'),
+        literal('income').label('kind'),
+        literal(None, String).label('category'),
+        func.sum(fx.converted(
+            minor_amount(models.Income.amount_minor, models.Income.amount),
+            models.Income.currency, models.Income.date, currency
+        )).label('amount')
+    ).filter(models.Income.user_id == user_id)
+
+    if start_date:
+        receipts = receipts.filter(models.Receipt.date >= start_date)
+        incomes = incomes.filter(models.Income.date >= start_date)
+    if end_date:
+        receipts = receipts.filter(models.Receipt.date <= end_date)
+        incomes = incomes.filter(models.Income.date <= end_date)
+
+    receipts = receipts.group_by(receipt_bucket, models.Receipt.category) if by_category else receipts.group_by(receipt_bucket)
+    incomes = incomes.group_by(income_bucket)
+
+    rows = db.execute(union_all(receipts.statement, incomes.statement)).all()
+
+    # SQLite returns buckets as ISO strings
+    buckets = [
+        (row.period if isinstance(row.period, date) else date.fromisoformat(str(row.period)[:10]), row)
+        for row in rows if row.period is not None
+    ]
+
+    first = _truncate_date(start_date, interval) if start_date else min((b for b, _ in buckets), default=None)
+    last = _truncate_date(end_date, interval) if end_date else max((b for b, _ in buckets), default=None)
+
+    periods: List[date] = []
+    if first and last:
+        current = first
+        while current <= last:
+            periods.append(current)
+            current = _next_period(current, interval)
+    index = {period: i for i, period in enumerate(periods)}
+
+    spent = [0.0] * len(periods)
+    income = [0.0] * len(periods)
+    by_cat = {} if by_category else None
+    for bucket, row in buckets:
+        i = index.get(bucket)
+        if i is None:
+            continue
+        amount = float(row.amount or 0)  # minor units
+        if row.kind == 'income':
+            income[i] += amount
+        else:
+            spent[i] += amount
+            if by_cat is not None:
+                series = by_cat.setdefault(row.category or "Uncategorized", [0.0] * len(periods))
+                series[i] += amount
+
+    return schemas.TimeSeriesData(
+        interval=interval,
+        periods=periods,
+        spent=[from_minor(v) for v in spent],
+        income=[from_minor(v) for v in income],
+        spending_by_category={k: [from_minor(v) for v in vals] for k, vals in by_cat.items()} if by_cat is not None else None,
+        currency=currency
     )
 
 # Income CRUD Operations
@@ -515,9 +825,13 @@ def get_settings(db: Session, user_id: str) -> models.Settings:
 def update_settings(db: Session, settings_update: schemas.SettingsUpdate, user_id: str) -> models.Settings:
     """Update user settings"""
     settings = get_settings(db, user_id)
+    changed = settings_update.currency and settings_update.currency != settings.currency
     if settings_update.currency:
         settings.currency = settings_update.currency
     
     db.commit()
+    if changed:
+        # Running totals are kept in the settings currency
+        budgets.rebuild(db, user_id=user_id, log=lambda message: None)
     db.refresh(settings)
     return settings
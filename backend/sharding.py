@@ -0,0 +1,448 @@
+"""
+User-id sharding across several databases.
+
+DATABASE_URL is the "main" shard and DATABASE_SHARDS adds more
+("eu2=postgresql://...,eu3=postgresql://..."); every shard has the full schema
+(`python -m migrations` upgrades them all). All of a user's rows live on one shard:
+the one named by their user_shards directory entry, else the one owning their
+point on a consistent-hash ring. The ring hashes VNODES points per shard name, so
+adding a shard re-homes only the users whose points it takes over. Pin everyone
+where they are before starting the API with a new shard list, then move users:
+
+    python sharding.py pin                # with the new DATABASE_SHARDS
+    python sharding.py move USER_ID eu3
+
+database.get_db looks the caller up on every request (one primary-key read on
+main) and binds the session to their shard. Tables shared by all users (users,
+webhook_events and the directory) stay on main; exchange_rates are written to
+every shard, since SQL aggregates convert amounts in the user's own database.
+
+A move copies the user's settings, merchants, budgets, recurring templates, income
+and receipts with their items under new ids, rebuilds the derived tables (product
+catalog, suggestions, spending totals) on the target, switches the directory and
+deletes the rows left on the source. Progress is stored on the target in the same
+transaction as each copied batch, so an interrupted move resumes where it stopped
+when run again. Meanwhile the user's writes are refused with 503 (reads still come
+from the source) and the recurring scheduler skips them. Archived receipt months
+and uploaded files are not per shard and do not move.
+
+Usage:
+    python sharding.py status
+    python sharding.py locate USER_ID
+    python sharding.py pin
+    python sharding.py move USER_ID SHARD [--batch-size 1000] [--grace 10]
+    python sharding.py abort USER_ID
+"""
+import argparse
+import bisect
+import hashlib
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import func, insert, select, union
+from sqlalchemy.orm import Session
+
+import budgets
+import catalog
+import models
+import suggestions
+from database import MAIN_SHARD, engine, read_engine, shard_engines, shard_session
+
+# Ring points per shard: more points, more even shares
+VNODES = 128
+BATCH_SIZE = 1000
+# Seconds to wait after marking a user as moving, for requests routed just before to finish
+GRACE_SECONDS = 10.0
+
+STEPS = ["settings", "merchants", "budgets", "recurring", "income", "receipts", "items",
+         "rebuild", "switch", "cleanup"]
+
+# Tables scanned to find the users stored on a shard
+USER_TABLES = [models.Receipt, models.Income, models.Settings, models.RecurringTemplate, models.Budget]
+
+
+def _point(key: str) -> int:
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, shards: Iterable[str], vnodes: int = VNODES):
+        points = sorted((_point(f"{shard}#{i}"), shard) for shard in shards for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, user_id: str) -> str:
+        """The shard owning the first point clockwise from the user's"""
+        return self._shards[bisect.bisect(self._points, _point(user_id)) % len(self._points)]
+
+
+class ShardRouter:
+    """Directory entry if any, else the ring; the directory is read from main on every call"""
+
+    def __init__(self, shards: Iterable[str]):
+        self.ring = HashRing(shards)
+
+    def locate(self, user_id: str) -> Tuple[str, bool]:
+        # The SQLite read engine never waits for the writer queue
+        with (read_engine or engine).connect() as conn:
+            row = conn.execute(
+                select(models.UserShard.shard, models.UserShard.moving_to).where(models.UserShard.user_id == user_id)
+            ).first()
+        if row is None:
+            return self.ring.shard_for(user_id), False
+        return row.shard, row.moving_to is not None
+
+
+router = ShardRouter(shard_engines)
+
+
+def moving_users() -> Set[str]:
+    """Users with a move in progress; background writers leave them alone"""
+    if len(shard_engines) == 1:
+        return set()
+    with (read_engine or engine).connect() as conn:
+        return set(conn.execute(
+            select(models.UserShard.user_id).where(models.UserShard.moving_to != None)
+        ).scalars())
+
+
+def _set_directory(main: Session, user_id: str, shard: str, moving_to: Optional[str]) -> None:
+    """Point the user at a shard; ring placement needs no entry"""
+    entry = main.get(models.UserShard, user_id)
+    if shard == router.ring.shard_for(user_id) and moving_to is None:
+        if entry is not None:
+            main.delete(entry)
+    elif entry is None:
+        main.add(models.UserShard(user_id=user_id, shard=shard, moving_to=moving_to))
+    else:
+        entry.shard, entry.moving_to, entry.updated_at = shard, moving_to, datetime.utcnow()
+    main.commit()
+
+
+def stored_users(db: Session) -> Set[str]:
+    """Every user with rows on a shard"""
+    query = union(*[select(model.user_id).where(model.user_id != None) for model in USER_TABLES])
+    return set(db.execute(query).scalars())
+
+
+@contextmanager
+def _session(name: str, *open_sessions: Session):
+    """
+    A session on a shard: one of `open_sessions` when it is already bound there (on
+    SQLite a second session would wait for the first one's write lock), else a new one.
+    """
+    for db in open_sessions:
+        if db.bind is shard_engines[name]:
+            yield db
+            return
+    db = shard_session(name)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def has_rows(db: Session, user_id: str) -> bool:
+    return any(db.query(model.id).filter(model.user_id == user_id).first() is not None for model in USER_TABLES)
+
+
+def pin(log=print) -> int:
+    """Add directory entries for users stored away from their ring shard; returns the entries added"""
+    main = shard_session(MAIN_SHARD)
+    added = 0
+    try:
+        directory = dict(main.query(models.UserShard.user_id, models.UserShard.shard))
+        for name in shard_engines:
+            with _session(name, main) as db:
+                users = stored_users(db)
+            for user_id in sorted(users):
+                if user_id in directory:
+                    if directory[user_id] != name:
+                        log(f"{user_id}: rows on {name} but the directory says {directory[user_id]}; left as is")
+                    continue
+                if router.ring.shard_for(user_id) != name:
+                    main.add(models.UserShard(user_id=user_id, shard=name))
+                    directory[user_id] = name
+                    added += 1
+            main.commit()
+            log(f"{name}: {len(users)} users")
+    finally:
+        main.close()
+    return added
+
+
+# Moves
+
+def _rows(db: Session, model, *criteria, after: int = 0, limit: Optional[int] = None) -> List[dict]:
+    table = model.__table__
+    query = select(table).where(*criteria, table.c.id > after).order_by(table.c.id).limit(limit)
+    return [dict(row) for row in db.execute(query).mappings()]
+
+
+def _copy(db: Session, model, rows: List[dict], **remap: Dict[int, int]) -> List[int]:
+    """Insert rows under new ids, translating the `remap` columns; returns the new ids in row order"""
+    if not rows:
+        return []
+    values = []
+    for row in rows:
+        value = {column: v for column, v in row.items() if column != "id"}
+        for column, ids in remap.items():
+            if value[column] is not None:
+                value[column] = ids.get(value[column])
+        values.append(value)
+    table = model.__table__
+    return list(db.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), values).scalars())
+
+
+def purge(db: Session, user_id: str, batch_size: int = BATCH_SIZE) -> int:
+    """Delete a user's rows from one shard in committed batches; returns the rows deleted"""
+    import jobs
+    total = 0
+    while True:
+        ids = [row_id for (row_id,) in db.query(models.Receipt.id).filter(
+            models.Receipt.user_id == user_id
+        ).limit(batch_size)]
+        if not ids:
+            break
+        total += db.query(models.Item).filter(models.Item.receipt_id.in_(ids)).delete(synchronize_session=False)
+        total += db.query(models.Receipt).filter(models.Receipt.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+    for model in jobs.USER_OWNED:
+        while True:
+            ids = [row_id for (row_id,) in db.query(model.id).filter(model.user_id == user_id).limit(batch_size)]
+            if not ids:
+                break
+            total += db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+            db.commit()
+    return total
+
+
+class UserMove:
+    """One user's move to `target`; each step commits its rows together with the progress row"""
+
+    def __init__(self, src: Session, dst: Session, progress: models.ShardMove, target: str,
+                 batch_size: int = BATCH_SIZE, log=print):
+        self.src = src
+        self.dst = dst
+        self.progress = progress
+        self.user_id = progress.user_id
+        self.target = target
+        self.batch_size = batch_size
+        self.log = log
+        self.merchant_ids: Optional[Dict[int, int]] = None
+
+    def run(self) -> None:
+        while self.progress is not None:
+            step = self.progress.step
+            done = getattr(self, f"_{step}")()
+            if done and self.progress is not None:
+                self._advance(STEPS[STEPS.index(step) + 1])
+
+    def _advance(self, step: str, last_id: int = 0) -> None:
+        self.progress.step, self.progress.last_id, self.progress.updated_at = step, last_id, datetime.utcnow()
+        self.dst.commit()
+
+    def _owned(self, model) -> list:
+        return [model.user_id == self.user_id]
+
+    def _map_merchants(self) -> Dict[int, int]:
+        """Source -> target merchant ids, matched on their unique key"""
+        target = dict(self.dst.query(models.Merchant.key, models.Merchant.id).filter(*self._owned(models.Merchant)))
+        return {
+            source_id: target[key]
+            for source_id, key in self.src.query(models.Merchant.id, models.Merchant.key).filter(*self._owned(models.Merchant))
+            if key in target
+        }
+
+    # Small per-user sets: copied in one transaction each
+
+    def _settings(self) -> bool:
+        _copy(self.dst, models.Settings, _rows(self.src, models.Settings, *self._owned(models.Settings)))
+        return True
+
+    def _merchants(self) -> bool:
+        rows = _rows(self.src, models.Merchant, *self._owned(models.Merchant))
+        ids = dict(zip([row["id"] for row in rows], _copy(self.dst, models.Merchant, rows)))
+        aliases = _rows(self.src, models.MerchantAlias, *self._owned(models.MerchantAlias))
+        _copy(self.dst, models.MerchantAlias, aliases, merchant_id=ids)
+        return True
+
+    def _budgets(self) -> bool:
+        rows = _rows(self.src, models.Budget, *self._owned(models.Budget))
+        ids = dict(zip([row["id"] for row in rows], _copy(self.dst, models.Budget, rows)))
+        alerts = _rows(self.src, models.BudgetAlert, *self._owned(models.BudgetAlert))
+        _copy(self.dst, models.BudgetAlert, alerts, budget_id=ids)
+        return True
+
+    def _recurring(self) -> bool:
+        rows = _rows(self.src, models.RecurringTemplate, *self._owned(models.RecurringTemplate))
+        _copy(self.dst, models.RecurringTemplate, rows, merchant_id=self._map_merchants())
+        return True
+
+    # Batched in source id order; a batch and its progress commit together
+
+    def _income(self) -> bool:
+        rows = _rows(self.src, models.Income, *self._owned(models.Income),
+                     after=self.progress.last_id, limit=self.batch_size)
+        if not rows:
+            return True
+        _copy(self.dst, models.Income, rows)
+        self._advance("income", rows[-1]["id"])
+        self.log(f"income: copied up to id {rows[-1]['id']}")
+        return False
+
+    def _receipts(self) -> bool:
+        rows = _rows(self.src, models.Receipt, *self._owned(models.Receipt),
+                     after=self.progress.last_id, limit=self.batch_size)
+        if not rows:
+            return True
+        if self.merchant_ids is None:
+            self.merchant_ids = self._map_merchants()
+        ids = dict(zip([row["id"] for row in rows], _copy(self.dst, models.Receipt, rows, merchant_id=self.merchant_ids)))
+        items = self.src.execute(
+            select(models.Item.__table__).where(models.Item.receipt_id.in_(list(ids))).order_by(models.Item.id)
+        ).mappings()
+        _copy(self.dst, models.Item, [dict(item) for item in items], receipt_id=ids)
+        self._advance("receipts", rows[-1]["id"])
+        self.log(f"receipts: copied up to id {rows[-1]['id']}")
+        return False
+
+    def _items(self) -> bool:
+        # Pending items, not yet attached to a receipt
+        _copy(self.dst, models.Item, _rows(self.src, models.Item, *self._owned(models.Item), models.Item.receipt_id == None))
+        return True
+
+    def _rebuild(self) -> bool:
+        # Each rebuild commits as it goes and is safe to repeat
+        quiet = lambda message: None
+        catalog.rebuild(self.dst, self.user_id, batch_size=self.batch_size, log=quiet)
+        suggestions.rebuild(self.dst, self.user_id, log=quiet)
+        budgets.rebuild(self.dst, self.user_id, log=quiet)
+        self.progress = self.dst.get(models.ShardMove, self.user_id)  # The catalog rebuild expunges the session
+        return True
+
+    def _switch(self) -> bool:
+        with _session(MAIN_SHARD, self.src, self.dst) as main:
+            _set_directory(main, self.user_id, self.target, None)
+        self.log(f"{self.user_id} now reads and writes on {self.target}")
+        return True
+
+    def _cleanup(self) -> bool:
+        deleted = purge(self.src, self.user_id, self.batch_size)
+        self.log(f"Deleted {deleted} rows from {self.progress.source}")
+        self.dst.delete(self.progress)
+        self.dst.commit()
+        self.progress = None
+        return True
+
+
+def move_user(user_id: str, target: str, batch_size: int = BATCH_SIZE, grace: float = GRACE_SECONDS,
+              log=print) -> None:
+    """Move a user's rows to another shard; resumes an interrupted move. ValueError if it cannot start"""
+    if target not in shard_engines:
+        raise ValueError(f"Unknown shard {target!r}")
+    dst = shard_session(target)
+    try:
+        progress = dst.get(models.ShardMove, user_id)
+        if progress is None:
+            source, moving = router.locate(user_id)
+            with _session(MAIN_SHARD, dst) as main:
+                entry = main.get(models.UserShard, user_id)
+                if moving and entry.moving_to != target:
+                    raise ValueError(f"{user_id} is being moved to {entry.moving_to}")
+                if source == target:
+                    raise ValueError(f"{user_id} is already on {target}")
+                if has_rows(dst, user_id):
+                    raise ValueError(f"{target} already has rows of {user_id}; abort or clean up first")
+                if not moving:
+                    _set_directory(main, user_id, source, target)
+                    log(f"Writes of {user_id} paused; waiting {grace:.0f}s for requests in flight")
+                    time.sleep(grace)
+            progress = models.ShardMove(user_id=user_id, source=source, step=STEPS[0], last_id=0)
+            dst.add(progress)
+            dst.commit()
+        else:
+            log(f"Resuming move of {user_id} from {progress.source} at step {progress.step}")
+        src = shard_session(progress.source)
+        try:
+            UserMove(src, dst, progress, target, batch_size, log).run()
+        finally:
+            src.close()
+    finally:
+        dst.close()
+
+
+def abort_move(user_id: str, log=print) -> bool:
+    """Give up a move before its switch: drop the copied rows and resume writes on the source"""
+    main = shard_session(MAIN_SHARD)
+    try:
+        entry = main.get(models.UserShard, user_id)
+        if entry is None or entry.moving_to is None:
+            return False
+        with _session(entry.moving_to, main) as dst:
+            progress = dst.get(models.ShardMove, user_id)
+            if progress is not None and STEPS.index(progress.step) >= STEPS.index("switch"):
+                raise ValueError(f"The move of {user_id} is past its switch; run it again to finish")
+            log(f"Deleted {purge(dst, user_id)} copied rows from {entry.moving_to}")
+            if progress is not None:
+                dst.delete(progress)
+                dst.commit()
+        _set_directory(main, user_id, entry.shard, None)
+        return True
+    finally:
+        main.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "locate", "pin", "move", "abort"])
+    parser.add_argument("args", nargs="*", help="locate/abort: USER_ID; move: USER_ID SHARD")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--grace", type=float, default=GRACE_SECONDS, help="seconds between pausing writes and copying")
+    args = parser.parse_args(argv)
+
+    if args.command in ("locate", "abort") and len(args.args) != 1:
+        parser.error(f"{args.command} needs USER_ID")
+    if args.command == "move" and len(args.args) != 2:
+        parser.error("move needs USER_ID SHARD")
+    try:
+        if args.command == "locate":
+            shard, moving = router.locate(args.args[0])
+            print(f"{args.args[0]}: {shard}{' (moving)' if moving else ''}")
+        elif args.command == "pin":
+            print(f"Pinned {pin()} users")
+        elif args.command == "move":
+            move_user(args.args[0], args.args[1], batch_size=args.batch_size, grace=args.grace)
+        elif args.command == "abort":
+            print("Aborted" if abort_move(args.args[0]) else "No move in progress")
+        else:
+            main_db = shard_session(MAIN_SHARD)
+            try:
+                pinned = dict(main_db.query(models.UserShard.shard, func.count(models.UserShard.user_id)).group_by(
+                    models.UserShard.shard
+                ).all())
+                moving = main_db.query(models.UserShard.user_id, models.UserShard.shard, models.UserShard.moving_to).filter(
+                    models.UserShard.moving_to != None
+                ).all()
+            finally:
+                main_db.close()
+            print(f"{'shard':<16}{'users':>10}{'pinned':>10}")
+            for name in shard_engines:
+                db = shard_session(name)
+                try:
+                    print(f"{name:<16}{len(stored_users(db)):>10}{pinned.get(name, 0):>10}")
+                finally:
+                    db.close()
+            for user_id, source, target in moving:
+                print(f"moving: {user_id} {source} -> {target}")
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""
+Application lifecycle: startup profiling, lifespan-managed initialization and readiness.
+
+Nothing here runs at import time beyond recording the process start; filesystem and
+database setup happen in `lifespan`, and long-lived clients are created on first
+use and closed when the lifespan ends.
+"""
+from contextlib import asynccontextmanager, contextmanager, suppress
+import asyncio
+import logging
+import os
+import time
+
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = "uploads"
+
+
+class StartupProfile:
+    """Wall-clock duration of each startup phase, reported by /ready and the startup log"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+        self.ready_after_ms = None
+
+    @contextmanager
+    def phase(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, round((time.perf_counter() - t0) * 1000, 2)))
+
+    def mark_ready(self):
+        self.ready_after_ms = round((time.perf_counter() - self.started) * 1000, 2)
+
+    def report(self) -> dict:
+        return {
+            "phases_ms": dict(self.phases),
+            "ready_after_ms": self.ready_after_ms,
+        }
+
+
+profile = StartupProfile()
+state = {"ready": False}
+
+
+def check_database() -> bool:
+    from database import engine
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        return True
+    except Exception as e:
+        logger.warning(f"Database not reachable: {e}")
+        return False
+
+
+@asynccontextmanager
+async def lifespan(app):
+    with profile.phase("uploads_dir"):
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+    with profile.phase("database_warmup"):
+        # Opens the first pooled connection so the first request does not pay for it.
+        # A database that is not up yet only delays readiness, it does not fail startup.
+        await run_in_threadpool(check_database)
+
+    import events
+    import jobs
+    import recurring
+    import webhook_queue
+    events.attach(asyncio.get_running_loop())
+    workers = []
+    if webhook_queue.WEBHOOK_WORKER:
+        workers.append(asyncio.create_task(webhook_queue.run_worker()))
+    if jobs.JOB_WORKER:
+        workers.append(asyncio.create_task(jobs.runner.run()))
+    if recurring.RECURRING_WORKER:
+        workers.append(asyncio.create_task(recurring.run_scheduler()))
+
+    state["ready"] = True
+    profile.mark_ready()
+    logger.info(f"Startup profile: {profile.report()}")
+    try:
+        yield
+    finally:
+        state["ready"] = False
+        for worker in workers:
+            worker.cancel()
+            with suppress(asyncio.CancelledError):
+                await worker
+        await events.broker.close()
+        import supabase_client
+        supabase_client.close_client()
+        from database import read_engines, replica_engines, shard_engines
+        for pooled in [*shard_engines.values(), *read_engines.values(), *replica_engines]:
+            pooled.dispose()
+        import tracing
+        await run_in_threadpool(tracing.processor.shutdown)
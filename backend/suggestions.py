@@ -0,0 +1,178 @@
+"""
+To-buy suggestions from purchase frequency.
+
+For every catalog product a user bought on at least MIN_PURCHASES distinct days,
+the median interval between purchases gives "you usually buy X every N days" and
+the expected next purchase date. These patterns are precomputed into
+purchase_patterns and refreshed incrementally: when a receipt is written, only the
+products on it are recomputed (services calls `refresh`), from the
+(user_id, product_id, date) index of product_prices.
+
+The ranked list (due soonest first, products already on the to-buy list left out)
+is cached per user by data fingerprint, like the forecast, so repeated reads cost
+one indexed aggregate query.
+
+Usage:
+    python suggestions.py rebuild [--user USER_ID]
+"""
+import argparse
+import sys
+from datetime import date, datetime, timedelta
+from statistics import median
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import catalog
+import models
+import schemas
+from cache import UserCache
+from database import insert_for
+
+MIN_PURCHASES = 3
+# Products not bought for this many intervals are considered dropped
+ABANDONED_INTERVALS = 3
+
+suggestion_cache = UserCache()
+
+
+def pattern(dates: List[date]) -> Optional[dict]:
+    """Interval statistics of sorted distinct purchase dates, or None if too few"""
+    if len(dates) < MIN_PURCHASES:
+        return None
+    intervals = [(later - earlier).days for earlier, later in zip(dates, dates[1:])]
+    interval = float(median(intervals))
+    spread = median(abs(days - interval) for days in intervals)
+    return {
+        "purchases": len(dates),
+        "interval_days": interval,
+        "regularity": round(max(0.0, 1 - spread / interval), 3),
+        "last_date": dates[-1],
+        "next_date": dates[-1] + timedelta(days=round(interval)),
+    }
+
+
+def _save(db: Session, user_id: str, patterns: Dict[int, Optional[dict]]) -> None:
+    dropped = [product_id for product_id, values in patterns.items() if values is None]
+    if dropped:
+        db.query(models.PurchasePattern).filter(
+            models.PurchasePattern.user_id == user_id, models.PurchasePattern.product_id.in_(dropped)
+        ).delete(synchronize_session=False)
+    now = datetime.utcnow()
+    for product_id, values in patterns.items():
+        if values is None:
+            continue
+        insert = insert_for(db, models.PurchasePattern).values(
+            user_id=user_id, product_id=product_id, updated_at=now, **values
+        )
+        db.execute(insert.on_conflict_do_update(
+            index_elements=["user_id", "product_id"],
+            set_={**values, "updated_at": now}
+        ))
+
+
+def refresh(db: Session, user_id: str, product_ids: Iterable[int]) -> None:
+    """Recompute the patterns of some products of a user; the caller commits"""
+    product_ids = set(product_ids)
+    if not product_ids:
+        return
+    dates: Dict[int, List[date]] = {product_id: [] for product_id in product_ids}
+    for product_id, day in db.query(models.ProductPrice.product_id, models.ProductPrice.date).filter(
+        models.ProductPrice.user_id == user_id, models.ProductPrice.product_id.in_(product_ids)
+    ).distinct().order_by(models.ProductPrice.product_id, models.ProductPrice.date):
+        dates[product_id].append(day)
+    # Products may have been deleted with their user in the meantime
+    existing = {row[0] for row in db.query(models.Product.id).filter(models.Product.id.in_(product_ids))}
+    _save(db, user_id, {product_id: pattern(days) for product_id, days in dates.items() if product_id in existing})
+
+
+def rebuild(db: Session, user_id: Optional[str] = None, log=print) -> int:
+    """Recompute every pattern from product_prices, one user at a time"""
+    users = db.query(models.Product.user_id).distinct()
+    if user_id:
+        users = users.filter(models.Product.user_id == user_id)
+    total = 0
+    for (owner,) in users.all():
+        product_ids = [row[0] for row in db.query(models.Product.id).filter(models.Product.user_id == owner)]
+        db.query(models.PurchasePattern).filter(
+            models.PurchasePattern.user_id == owner, ~models.PurchasePattern.product_id.in_(product_ids)
+        ).delete(synchronize_session=False)
+        refresh(db, owner, product_ids)
+        db.commit()
+        total += db.query(func.count(models.PurchasePattern.id)).filter(models.PurchasePattern.user_id == owner).scalar()
+        log(f"{owner}: {total} patterns so far")
+    return total
+
+
+def data_fingerprint(db: Session, user_id: str):
+    """Changes whenever the user's patterns or pending items change"""
+    patterns = db.query(
+        func.count(models.PurchasePattern.id), func.max(models.PurchasePattern.updated_at)
+    ).filter(models.PurchasePattern.user_id == user_id)
+    pending = db.query(func.count(models.Item.id), func.max(models.Item.id)).filter(
+        models.Item.user_id == user_id, models.Item.receipt_id == None
+    )
+    return tuple(patterns.one()) + tuple(pending.one())
+
+
+def _rank(db: Session, user_id: str, today: date) -> List[schemas.BuySuggestion]:
+    pending = {
+        catalog.normalize(name) for (name,) in db.query(models.Item.name).filter(
+            models.Item.user_id == user_id, models.Item.receipt_id == None
+        ) if name
+    }
+    rows = db.query(models.PurchasePattern, models.Product.name, models.Product.key).join(
+        models.Product, models.Product.id == models.PurchasePattern.product_id
+    ).filter(models.PurchasePattern.user_id == user_id).order_by(
+        models.PurchasePattern.next_date, models.PurchasePattern.regularity.desc()
+    ).all()
+
+    suggestions = []
+    for row, name, key in rows:
+        if key in pending:
+            continue
+        if (today - row.last_date).days > ABANDONED_INTERVALS * max(row.interval_days, 1):
+            continue
+        suggestions.append(schemas.BuySuggestion(
+            product_id=row.product_id,
+            name=name,
+            interval_days=round(row.interval_days, 1),
+            purchases=row.purchases,
+            last_date=row.last_date,
+            next_date=row.next_date,
+            due_in_days=(row.next_date - today).days,
+            # More observed intervals and more regular ones are more trustworthy
+            confidence=round(row.regularity * (1 - 1 / row.purchases), 3)
+        ))
+    return suggestions
+
+
+def get_suggestions(db: Session, user_id: str, limit: int = 20, today: Optional[date] = None) -> List[schemas.BuySuggestion]:
+    """Ranked to-buy suggestions, due soonest first; served from cache until the data changes"""
+    today = today or date.today()
+    fingerprint = (data_fingerprint(db, user_id), today)
+    suggestions = suggestion_cache.get(user_id, "suggestions", fingerprint)
+    if suggestions is None:
+        suggestions = _rank(db, user_id, today)
+        suggestion_cache.set(user_id, "suggestions", fingerprint, suggestions)
+    return suggestions[:limit]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--user", help="only this user")
+    args = parser.parse_args(argv)
+
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        print(f"Patterns: {rebuild(db, user_id=args.user)}")
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+"""
+Process-wide client for the Supabase Auth (GoTrue) REST API.
+
+One httpx.Client with a keep-alive pool is shared by token validation and the
+admin endpoints, so requests reuse TLS connections instead of building a new SDK
+client each time. Calls have explicit timeouts, retry transient failures with
+exponential backoff and go through a circuit breaker, so an Auth outage fails
+fast with 503 instead of tying up workers.
+
+Point SUPABASE_URL at a local HTTP stand-in to exercise it without Supabase, or
+pass an httpx transport to SupabaseAuthClient directly.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+import httpx
+
+import env
+import tracing
+
+logger = logging.getLogger(__name__)
+
+SUPABASE_URL = os.environ.get("SUPABASE_URL") or os.environ.get("NEXT_PUBLIC_SUPABASE_URL")
+SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+
+TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "5"))
+CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", "2"))
+RETRIES = int(os.getenv("SUPABASE_RETRIES", "2"))
+BACKOFF = 0.1               # seconds, doubled per attempt, with jitter
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE = 10
+
+# Circuit breaker: open after this many consecutive failed calls, try again after the cooldown
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30.0
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class NotConfiguredError(Exception):
+    """SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY are missing"""
+
+
+class UnavailableError(Exception):
+    """Supabase Auth could not be reached, kept failing, or the circuit is open"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker; half-open lets a single trial call through"""
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class SupabaseAuthClient:
+    def __init__(self, url: str, service_key: str, timeout: float = TIMEOUT, retries: int = RETRIES,
+                 breaker: Optional[CircuitBreaker] = None, transport: Optional[httpx.BaseTransport] = None):
+        self.retries = retries
+        self.breaker = breaker or CircuitBreaker()
+        self._service_key = service_key
+        self._http = httpx.Client(
+            base_url=url.rstrip("/") + "/auth/v1",
+            headers={"apikey": service_key},
+            timeout=httpx.Timeout(timeout, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE),
+            transport=transport
+        )
+
+    def close(self) -> None:
+        self._http.close()
+
+    def _request(self, method: str, path: str, token: str) -> httpx.Response:
+        """
+        Send a request, retrying connection errors and RETRY_STATUSES.
+        Other responses (including 4xx) are returned to the caller as-is and count
+        as a healthy upstream for the circuit breaker.
+        """
+        if not self.breaker.allow():
+            raise UnavailableError("Supabase Auth circuit is open")
+
+        with tracing.span(f"supabase {method}", {"http.request.method": method, "url.path": path},
+                          kind=tracing.CLIENT, root=False) as span:
+            headers = {"Authorization": f"Bearer {token}"}
+            traceparent = tracing.traceparent()
+            if traceparent:
+                headers["traceparent"] = traceparent
+            for attempt in range(self.retries + 1):
+                try:
+                    response = self._http.request(method, path, headers=headers)
+                    if response.status_code not in RETRY_STATUSES:
+                        self.breaker.record_success()
+                        span.set_attribute("http.response.status_code", response.status_code)
+                        return response
+                    error = f"HTTP {response.status_code}"
+                except httpx.HTTPError as e:
+                    error = repr(e)
+                if attempt < self.retries:
+                    delay = BACKOFF * 2 ** attempt
+                    time.sleep(delay + random.uniform(0, delay))
+
+            span.set_attribute("http.request.resend_count", self.retries)
+            self.breaker.record_failure()
+            logger.warning(f"Supabase Auth {method} {path} failed after {self.retries + 1} attempts: {error}")
+            raise UnavailableError(error)
+
+    def get_user_id(self, access_token: str) -> Optional[str]:
+        """User id for a valid access token, None when Supabase rejects the token"""
+        response = self._request("GET", "/user", access_token)
+        if response.status_code != 200:
+            return None
+        return response.json().get("id")
+
+    def delete_user(self, user_id: str) -> bool:
+        """Delete an Auth user with the service role; False when it did not exist"""
+        response = self._request("DELETE", f"/admin/users/{user_id}", self._service_key)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        return True
+
+
+_client: Optional[SupabaseAuthClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> SupabaseAuthClient:
+    """The process-wide client, created on first use and closed by the app lifespan"""
+    global _client
+    if _client is None:
+        if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
+            raise NotConfiguredError("Supabase credentials not configured in backend")
+        with _client_lock:
+            if _client is None:
+                _client = SupabaseAuthClient(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+    return _client
+
+
+def close_client() -> None:
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
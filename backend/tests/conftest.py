@@ -0,0 +1,37 @@
+import os
+import sys
+import tempfile
+
+# The app reads its configuration at import: point it at throwaway SQLite databases first
+_tmp = tempfile.mkdtemp(prefix="spendlog-tests-")
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{_tmp}/main.db",
+    "DATABASE_SHARDS": f"second=sqlite:///{_tmp}/second.db",
+    "DATABASE_REPLICA_URLS": "",
+    "RATE_LIMIT_ENABLED": "false",
+    "WEBHOOK_WORKER": "false",
+    "JOB_WORKER": "false",
+    "TRACE_EXPORTER": "none",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import migrations
+from database import shard_engines, shard_session
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    for shard_engine in shard_engines.values():
+        migrations.upgrade(shard_engine, log=lambda message: None)
+
+
+@pytest.fixture
+def db():
+    session = shard_session("main")
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
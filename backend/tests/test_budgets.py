@@ -0,0 +1,55 @@
+import datetime
+
+import pytest
+
+import budgets
+import fx
+import models
+import schemas
+import services
+
+DAY = datetime.date(2024, 3, 5)
+
+
+@pytest.fixture(autouse=True)
+def empty_tables(db):
+    for model in (models.Item, models.Receipt, models.SpendingTotal, models.ExchangeRate):
+        db.query(model).delete()
+    db.commit()
+    fx.rate_cache.invalidate()
+
+
+def _rate(db, rate):
+    fx.upsert_rates(db, [schemas.ExchangeRateCreate(date=DAY, base_currency="EUR", quote_currency="TND", rate=rate)])
+
+
+def _totals(db):
+    return dict(db.query(models.SpendingTotal.category, models.SpendingTotal.total_minor).filter(
+        models.SpendingTotal.user_id == "u1"
+    ))
+
+
+def _create(db):
+    return services.create_receipt(db, schemas.ReceiptCreate(
+        merchant_name="Monoprix", date=DAY, total_amount=10.0, currency="EUR", category="Food"
+    ), "u1")
+
+
+def test_delete_subtracts_what_was_added_after_rates_change(db):
+    _rate(db, 3.0)
+    receipt = _create(db)
+    assert receipt.budget_minor == 30000
+    assert _totals(db) == {"Food": 30000, budgets.ALL: 30000}
+
+    _rate(db, 3.5)
+    assert services.delete_receipt(db, receipt.id, "u1")
+    assert set(_totals(db).values()) == {0}
+
+
+def test_rebuild_uses_current_rates(db):
+    _rate(db, 3.0)
+    receipt_id = _create(db).id
+    _rate(db, 3.5)
+    budgets.rebuild(db, "u1", log=lambda line: None)
+    assert db.get(models.Receipt, receipt_id).budget_minor == 35000
+    assert _totals(db) == {"Food": 35000, budgets.ALL: 35000}
@@ -0,0 +1,18 @@
+import catalog
+import models
+
+
+def test_normalize_keeps_order_and_size():
+    assert catalog.normalize("Lait Délice 1L") == catalog.normalize("lait delice 1000 ml") == "lait delice 1000ml"
+    assert catalog.normalize("Lait Délice 6x1L") == "lait delice x6 1000ml"
+    assert catalog.normalize("Lait Délice 500ml") != catalog.normalize("Lait Délice 1L")
+    assert catalog.normalize("Tomatoes x6") == "tomato x6"
+
+
+def test_fuzzy_match_needs_the_same_size(db):
+    db.query(models.Product).delete()
+    resolver = catalog.Resolver(db, "u1")
+    one = resolver.resolve("Lait Delice 1L")
+    assert resolver.resolve("Lait Delise 1L") == one
+    assert resolver.resolve("Lait Delice 500ml") != one
+    db.rollback()
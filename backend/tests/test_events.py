@@ -0,0 +1,64 @@
+import asyncio
+import datetime
+
+import pytest
+
+import events
+import models
+
+
+class Recorder:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, user_id, payloads):
+        self.published.append((user_id, payloads))
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    recorder = Recorder()
+    monkeypatch.setattr(events, "broker", recorder)
+    return recorder
+
+
+def test_published_on_commit_only(db, recorder):
+    receipt = models.Receipt(user_id="u1", merchant_name="a", date=datetime.date(2024, 1, 1), total_amount=1)
+    db.add(receipt)
+    db.flush()
+    db.rollback()
+    assert recorder.published == []
+
+    db.add(models.Income(user_id="u1", source="s", amount=1, date=datetime.date(2024, 1, 1)))
+    db.commit()
+    income_id = db.query(models.Income.id).filter(models.Income.user_id == "u1").scalar()
+    assert recorder.published == [("u1", [{"type": "income", "action": "created", "id": income_id}])]
+    db.query(models.Income).filter(models.Income.id == income_id).delete()
+    db.commit()
+
+
+def test_shared_broker_reaches_other_workers():
+    async def run():
+        hub = events.StandInPubSub()
+        writer, reader = events.SharedBroker(hub), events.SharedBroker(hub)
+        subscription = reader.subscribe("u1")
+        writer._loop = asyncio.get_running_loop()
+        await asyncio.sleep(0.01)  # Let the reader's listener subscribe
+        writer.publish("u1", [{"type": "receipt", "action": "created", "id": 1}])
+        writer.publish("u2", [{"type": "receipt", "action": "created", "id": 2}])
+        received = [await subscription.get(1), await subscription.get(0.05)]
+        await reader.close()
+        return received
+
+    assert asyncio.run(run()) == [{"type": "receipt", "action": "created", "id": 1}, None]
+
+
+def test_overflow_asks_for_resync():
+    async def run():
+        broker = events.LocalBroker()
+        subscription = broker.subscribe("u1")
+        broker.deliver("u1", [{"type": "item", "action": "created", "id": n} for n in range(events.QUEUE_SIZE + 1)])
+        received = [await subscription.get(0.1) for _ in range(events.QUEUE_SIZE + 1)]
+        return received[-1], await subscription.get(0.01)
+
+    assert asyncio.run(run()) == ({"type": "resync"}, None)
@@ -0,0 +1,42 @@
+import datetime
+
+import pytest
+
+import fx
+import models
+import schemas
+import services
+
+DAY = datetime.date(2024, 3, 5)
+
+
+@pytest.fixture(autouse=True)
+def empty_tables(db):
+    for model in (models.Item, models.Receipt, models.Income, models.SpendingTotal, models.ExchangeRate):
+        db.query(model).delete()
+    db.commit()
+    fx.rate_cache.invalidate()
+
+
+def _receipt(db, amount, currency):
+    return services.create_receipt(db, schemas.ReceiptCreate(
+        merchant_name="Shop", date=DAY, total_amount=amount, currency=currency
+    ), "u1")
+
+
+def test_currency_is_upper_cased():
+    assert schemas.ReceiptCreate(merchant_name="a", date=DAY, total_amount=1, currency=" eur").currency == "EUR"
+    assert schemas.SettingsUpdate(currency="usd").currency == "USD"
+
+
+def test_amounts_without_a_rate_are_left_out(db):
+    fx.upsert_rates(db, [schemas.ExchangeRateCreate(date=DAY, base_currency="EUR", quote_currency="TND", rate=3.0)])
+    _receipt(db, 10.0, "TND")
+    _receipt(db, 2.0, "eur")
+    unconvertible = _receipt(db, 5.0, "USD")
+    assert unconvertible.budget_minor == 0
+    assert fx.convert_amount(db, 500, "USD", DAY, "TND") is None
+
+    dashboard = services.get_dashboard_stats(db, "u1")
+    assert dashboard.stats.total_spent == 16.0
+    assert dashboard.unconverted == 1
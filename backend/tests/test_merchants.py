@@ -0,0 +1,22 @@
+import pytest
+
+import merchants
+import models
+
+
+@pytest.fixture(autouse=True)
+def empty_merchants(db):
+    db.query(models.MerchantAlias).delete()
+    db.query(models.Merchant).delete()
+    db.commit()
+
+
+def test_longer_names_are_suggested_not_merged(db):
+    resolver = merchants.Resolver(db, "u1")
+    cafe, flore = resolver.resolve("Cafe"), resolver.resolve("Café de Flore")
+    assert cafe != flore
+    assert resolver.resolve("CAFE ") == cafe
+    assert resolver.resolve("Cafee") == cafe  # Fuzzy: a typo
+    db.commit()
+    assert [(s.source_id, s.into_id) for s in merchants.merge_suggestions(db, "u1")] == [(flore, cafe)]
+    assert merchants.merge_suggestions(db, "u2") == []
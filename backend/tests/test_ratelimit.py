@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+import ratelimit
+
+
+def _scope(authorization=None, query=b"", client=("10.0.0.1", 5000)):
+    headers = [(b"authorization", authorization)] if authorization else []
+    return {"headers": headers, "query_string": query, "client": client}
+
+
+def test_identify_validated_tokens_by_user():
+    ratelimit.remember_identity("good-token", "u1")
+    ratelimit.remember_identity("good-ticket", "u2")
+    assert ratelimit.identify(_scope(b"Bearer good-token")) == "user:u1"
+    assert ratelimit.identify(_scope(query=b"ticket=good-ticket")) == "user:u2"
+
+
+def test_identify_unvalidated_tokens_by_address():
+    assert ratelimit.identify(_scope(b"Bearer forged-1")) == "ip:10.0.0.1"
+    assert ratelimit.identify(_scope(b"Bearer forged-2")) == "ip:10.0.0.1"
+    assert ratelimit.identify(_scope(query=b"ticket=forged")) == "ip:10.0.0.1"
+    assert ratelimit.identify(_scope(client=None)) == "ip:unknown"
+
+
+@pytest.mark.parametrize("backend", [
+    ratelimit.MemoryBackend, lambda: ratelimit.SharedBackend(ratelimit.StandInStore())
+], ids=["memory", "shared"])
+def test_bucket_allows_burst_then_waits(backend):
+    async def run():
+        limiter, limit = backend(), ratelimit.Limit(rate=0.5, burst=2)
+        waits = [await limiter.take("user:u1", limit) for _ in range(3)]
+        return waits, await limiter.take("user:u2", limit)
+
+    (first, second, third), other = asyncio.run(run())
+    assert first == second == 0
+    assert 1.9 < third <= 2  # One token at 0.5 per second
+    assert other == 0
+
+
+@pytest.mark.parametrize("backend", [
+    ratelimit.MemoryBackend, lambda: ratelimit.SharedBackend(ratelimit.StandInStore())
+], ids=["memory", "shared"])
+def test_in_flight_cap(backend):
+    async def run():
+        limiter = backend()
+        taken = [await limiter.acquire("k", 2) for _ in range(3)]
+        await limiter.release("k")
+        return taken, await limiter.acquire("k", 2)
+
+    assert asyncio.run(run()) == ([True, True, False], True)
@@ -0,0 +1,92 @@
+import datetime
+
+import pytest
+
+import models
+import schemas
+import services
+import sharding
+from database import shard_session
+
+
+def _quiet(message):
+    pass
+
+
+def _user_on_main(prefix):
+    return next(f"{prefix}-{n}" for n in range(1000) if sharding.router.ring.shard_for(f"{prefix}-{n}") == "main")
+
+
+def _count(shard, model, user_id):
+    db = shard_session(shard)
+    try:
+        return db.query(model).filter(model.user_id == user_id).count()
+    finally:
+        db.close()
+
+
+def _directory(user_id):
+    db = shard_session("main")
+    try:
+        entry = db.get(models.UserShard, user_id)
+        return entry and (entry.shard, entry.moving_to)
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def user(db):
+    user_id = _user_on_main("mover")
+    for n in range(5):
+        services.create_receipt(db, schemas.ReceiptCreate(
+            merchant_name=f"Shop {n % 2}", date=datetime.date(2024, 1, 1 + n), total_amount=10 + n,
+            items=[schemas.ItemCreate(name="milk", price=2, quantity=1)]
+        ), user_id)
+    db.close()
+    yield user_id
+    for shard in ("main", "second"):
+        session = shard_session(shard)
+        try:
+            sharding.purge(session, user_id)
+            session.query(models.UserShard).filter(models.UserShard.user_id == user_id).delete()
+            session.commit()
+        finally:
+            session.close()
+
+
+@pytest.fixture
+def interrupted(user, monkeypatch):
+    """A move that failed after copying its first batch of receipts"""
+    copy = sharding.UserMove._receipts
+    calls = []
+
+    def failing(self):
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError("connection lost")
+        return copy(self)
+
+    monkeypatch.setattr(sharding.UserMove, "_receipts", failing)
+    with pytest.raises(RuntimeError):
+        sharding.move_user(user, "second", batch_size=2, grace=0, log=_quiet)
+    monkeypatch.setattr(sharding.UserMove, "_receipts", copy)
+    assert _directory(user) == ("main", "second")
+    assert _count("second", models.Receipt, user) == 2
+    return user
+
+
+def test_move_user_resumes(interrupted):
+    sharding.move_user(interrupted, "second", batch_size=2, grace=0, log=_quiet)
+    assert _count("second", models.Receipt, interrupted) == 5
+    assert _count("second", models.Item, interrupted) == 5
+    assert _count("main", models.Receipt, interrupted) == 0
+    assert _directory(interrupted) == ("second", None)
+    assert sharding.router.locate(interrupted) == ("second", False)
+
+
+def test_abort_move_drops_the_copy(interrupted):
+    assert sharding.abort_move(interrupted, log=_quiet)
+    assert _count("second", models.Receipt, interrupted) == 0
+    assert _count("main", models.Receipt, interrupted) == 5
+    assert _directory(interrupted) is None
+    assert not sharding.abort_move(interrupted, log=_quiet)
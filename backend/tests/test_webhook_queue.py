@@ -0,0 +1,52 @@
+import pytest
+
+import models
+import webhook_queue
+
+
+@pytest.fixture(autouse=True)
+def empty_queue(db):
+    db.query(models.WebhookEvent).delete()
+    db.query(models.User).delete()
+    db.commit()
+
+
+def _queue(db, *events, prefix="evt"):
+    for n, (user_id, email) in enumerate(events):
+        webhook_queue.enqueue(db, f"{prefix}-{n}", {"id": user_id, "email": email})
+
+
+def test_drain_batch_inserts_users(db):
+    _queue(db, ("id1", "a@example.com"), ("id2", "b@example.com"))
+    assert webhook_queue.drain_batch(db) == {"processed": 2}
+    assert dict(db.query(models.User.id, models.User.email)) == {"id1": "a@example.com", "id2": "b@example.com"}
+
+
+def test_drain_batch_replay_is_idempotent(db):
+    _queue(db, ("id1", "a@example.com"))
+    webhook_queue.drain_batch(db)
+    assert webhook_queue.replay(db, statuses=["processed"]) == 1
+    assert webhook_queue.drain_batch(db) == {"processed": 1}
+    assert db.query(models.User).count() == 1
+
+
+def test_drain_batch_email_swap(db):
+    # id1 moves from x to y, id2 takes y, id3 takes x: the stale x -> id1 entry must not
+    # send id3's event after the already superseded id1
+    _queue(db, ("id1", "x@a"), ("id1", "y@a"), ("id2", "y@a"), ("id3", "x@a"))
+    assert webhook_queue.drain_batch(db) == {"ignored": 2, "processed": 2}
+    assert dict(db.query(models.User.id, models.User.email)) == {"id2": "y@a", "id3": "x@a"}
+    assert webhook_queue.queue_status(db) == {"ignored": 2, "processed": 2}
+
+
+def test_drain_batch_fails_only_conflicting_events(db):
+    _queue(db, ("id1", "x@a"))
+    webhook_queue.drain_batch(db)
+    _queue(db, ("id2", "x@a"), ("id3", "z@a"), prefix="later")
+    assert webhook_queue.drain_batch(db) == {"failed": 1, "processed": 1}
+    assert dict(db.query(models.User.id, models.User.email)) == {"id1": "x@a", "id3": "z@a"}
+
+
+def test_drain_batch_ignores_unknown_events(db):
+    webhook_queue.enqueue(db, "evt-unknown", {"type": "UPDATE", "record": {}})
+    assert webhook_queue.drain_batch(db) == {"ignored": 1}
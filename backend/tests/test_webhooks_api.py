@@ -0,0 +1,20 @@
+from fastapi.testclient import TestClient
+
+import main
+import models
+
+
+def test_auth_webhook_accepts_service_key(db, monkeypatch):
+    # Supabase sends its own key as the bearer token; it must not be checked as a user JWT
+    def reject(token):
+        raise AssertionError("webhook caller authenticated as a user")
+    monkeypatch.setattr("auth_utils._verify", reject)
+    client = TestClient(main.app)
+    response = client.post(
+        "/webhooks/auth",
+        json={"type": "INSERT", "record": {"id": "hook-user", "email": "hook@example.com"}},
+        headers={"Authorization": "Bearer service-role-key", "webhook-id": "hook-1"},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"status": "queued", "event_id": "hook-1"}
+    assert db.query(models.WebhookEvent).filter(models.WebhookEvent.event_id == "hook-1").count() == 1
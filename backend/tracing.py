@@ -0,0 +1,430 @@
+"""
+Tracing: spans for request handling, auth verification, SQL statements, storage
+and background work.
+
+Spans follow the OpenTelemetry data model and are exported as OTLP/JSON, so any
+OTLP collector or tracing backend reads them without the SDK as a dependency.
+Trace context travels in W3C `traceparent` headers: read from incoming requests,
+sent to Supabase Auth, and stored on jobs, so a job's spans join the trace of the
+request that queued it.
+
+Sampling keeps the overhead low:
+
+- Head: a trace is sampled when its incoming traceparent says so, else with
+  probability TRACE_SAMPLE_RATE.
+- Tail: other traces are still recorded in memory (at most MAX_SPANS per trace)
+  and exported anyway when they take longer than TRACE_SLOW_MS or end with an
+  error; the rest are dropped when their local root span ends.
+
+Exporters (TRACE_EXPORTER): "file" appends one OTLP/JSON export request per line
+to TRACE_FILE, "otlp" POSTs them to TRACE_OTLP_ENDPOINT, and "standin" keeps them
+in an in-process StandInCollector, for tests. Exports run in batches on a
+background thread; when its queue is full, spans are dropped rather than slowing
+requests. With the default "none" no spans are created at all.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import env
+
+logger = logging.getLogger(__name__)
+
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")  # none, file, otlp, standin
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.05"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1000"))
+SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "spendlog-api")
+ENABLED = TRACE_EXPORTER != "none"
+
+MAX_SPANS = 512  # Per trace; later spans are counted but not kept
+MAX_QUEUE = 10_000  # Spans waiting for export
+BATCH_SIZE = 512
+FLUSH_INTERVAL = 2.0
+MAX_STATEMENT = 2000  # Characters of SQL kept in db.query.text
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT, PRODUCER, CONSUMER = 1, 2, 3, 4, 5
+STATUS_ERROR = 2
+
+# Streams stay open for minutes; a span per connection would only measure idle time
+UNTRACED_PATHS = {"/events/stream"}
+
+
+class SpanContext(NamedTuple):
+    trace_id: str
+    span_id: str
+    sampled: bool
+
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+def extract(traceparent: Optional[str]) -> Optional[SpanContext]:
+    """Parse a W3C traceparent header; None when absent or malformed"""
+    match = _TRACEPARENT.match(traceparent.strip().lower()) if traceparent else None
+    if not match or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+    return SpanContext(match.group(1), match.group(2), bool(int(match.group(3), 16) & 1))
+
+
+class _Trace:
+    """Spans of one trace recorded in this process, held until its local root ends"""
+    __slots__ = ("sampled", "spans", "dropped", "error", "kept")
+
+    def __init__(self, sampled: bool):
+        self.sampled = sampled
+        self.spans: List["Span"] = []
+        self.dropped = 0
+        self.error = False
+        self.kept: Optional[bool] = None  # Decided when the local root ends
+
+
+class Span:
+    __slots__ = ("trace", "trace_id", "span_id", "parent_id", "name", "kind", "attributes",
+                 "start", "end", "status", "message", "_root", "_token")
+
+    def __init__(self, name: str, kind: int = INTERNAL, attributes: Optional[Dict[str, Any]] = None,
+                 parent: Optional[SpanContext] = None):
+        current = _current.get()
+        if parent is None and current is not None:
+            self.trace, self.trace_id, self.parent_id, self._root = current.trace, current.trace_id, current.span_id, False
+        else:
+            sampled = parent.sampled if parent else random.random() < TRACE_SAMPLE_RATE
+            self.trace = _Trace(sampled)
+            self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+            self.parent_id = parent.span_id if parent else None
+            self._root = True
+        self.span_id = os.urandom(8).hex()
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes) if attributes else {}
+        self.start = time.time_ns()
+        self.end: Optional[int] = None
+        self.status = 0
+        self.message: Optional[str] = None
+        self._token = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def record_error(self, error: Any) -> None:
+        self.status = STATUS_ERROR
+        self.message = f"{type(error).__name__}: {error}"[:500] if isinstance(error, BaseException) else str(error)
+        self.trace.error = True
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.trace.sampled else '00'}"
+
+    def finish(self) -> None:
+        if self.end is not None:
+            return
+        self.end = time.time_ns()
+        trace = self.trace
+        if trace.kept is not None:
+            # Ended after its root, e.g. work the request left running
+            if trace.kept:
+                processor.submit([self])
+            return
+        if len(trace.spans) < MAX_SPANS:
+            trace.spans.append(self)
+        else:
+            trace.dropped += 1
+        if self._root:
+            trace.kept = trace.sampled or trace.error or (self.end - self.start) / 1e6 >= TRACE_SLOW_MS
+            if trace.dropped:
+                self.attributes["trace.dropped_spans"] = trace.dropped
+            if trace.kept:
+                processor.submit(trace.spans)
+            trace.spans = []
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # HTTPExceptions below 500 (401, 404, ...) are answers, not failures
+        if exc is not None and getattr(exc, "status_code", 500) >= 500:
+            self.record_error(exc)
+        _current.reset(self._token)
+        self.finish()
+
+
+class _NoopSpan:
+    """Stands in for spans when tracing is disabled"""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def record_error(self, error: Any) -> None:
+        pass
+
+    def finish(self) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+NOOP = _NoopSpan()
+_current: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+
+def span(name: str, attributes: Optional[Dict[str, Any]] = None, kind: int = INTERNAL,
+         parent: Optional[SpanContext] = None, root: bool = True):
+    """
+    A span to use as a context manager. It is a child of the current span, or of
+    `parent` (a remote context) when given; with root=False no new trace is started
+    when there is no current span, for spans only worth having inside a trace.
+    """
+    if not ENABLED or (not root and parent is None and _current.get() is None):
+        return NOOP
+    return Span(name, kind, attributes, parent)
+
+
+def record_error(error: Any) -> None:
+    """Mark the current span as failed, for errors that are handled rather than raised"""
+    current = _current.get() if ENABLED else None
+    if current is not None:
+        current.record_error(error)
+
+
+def traceparent() -> Optional[str]:
+    """traceparent header for the current span, to propagate the trace; None outside traces"""
+    current = _current.get() if ENABLED else None
+    return current.traceparent() if current is not None else None
+
+
+# Export
+
+def _value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def encode(spans: List[Span]) -> dict:
+    """An OTLP/JSON ExportTraceServiceRequest"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{
+            "scope": {"name": "spendlog"},
+            "spans": [
+                {
+                    "traceId": s.trace_id,
+                    "spanId": s.span_id,
+                    **({"parentSpanId": s.parent_id} if s.parent_id else {}),
+                    "name": s.name,
+                    "kind": s.kind,
+                    "startTimeUnixNano": str(s.start),
+                    "endTimeUnixNano": str(s.end),
+                    "attributes": [{"key": key, "value": _value(value)} for key, value in s.attributes.items()],
+                    "status": {"code": s.status, **({"message": s.message} if s.message else {})},
+                }
+                for s in spans
+            ],
+        }],
+    }]}
+
+
+class FileExporter:
+    def __init__(self, path: str = TRACE_FILE):
+        self.path = path
+
+    def export(self, payload: dict) -> None:
+        with open(self.path, "a") as f:
+            f.write(json.dumps(payload, separators=(",", ":")) + "\n")
+
+
+class OTLPExporter:
+    """OTLP over HTTP with JSON bodies, to a collector's /v1/traces"""
+
+    def __init__(self, endpoint: str = TRACE_OTLP_ENDPOINT, timeout: float = 5.0):
+        import httpx
+        self.endpoint = endpoint
+        self._http = httpx.Client(timeout=timeout)
+
+    def export(self, payload: dict) -> None:
+        self._http.post(self.endpoint, json=payload).raise_for_status()
+
+
+class StandInCollector:
+    """In-process stand-in for an OTLP collector: keeps every export request"""
+
+    def __init__(self):
+        self.requests: List[dict] = []
+
+    def export(self, payload: dict) -> None:
+        self.requests.append(payload)
+
+    def spans(self) -> List[dict]:
+        return [
+            span_
+            for request in self.requests
+            for resource in request["resourceSpans"]
+            for scope in resource["scopeSpans"]
+            for span_ in scope["spans"]
+        ]
+
+
+class BatchProcessor:
+    """Queues finished spans and exports them from a daemon thread, BATCH_SIZE at a time"""
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.dropped = 0
+        self._queue: "queue.Queue[Optional[Span]]" = queue.Queue(MAX_QUEUE)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, spans: List[Span]) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-export", daemon=True)
+                    self._thread.start()
+        for s in spans:
+            try:
+                self._queue.put_nowait(s)
+            except queue.Full:
+                self.dropped += 1
+
+    def _export(self, batch: List[Span]) -> None:
+        try:
+            self.exporter.export(encode(batch))
+        except Exception as e:
+            logger.warning(f"Trace export failed, {len(batch)} spans lost: {e}")
+
+    def _run(self) -> None:
+        batch: List[Span] = []
+        deadline = time.monotonic() + FLUSH_INTERVAL
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0.01))
+            except queue.Empty:
+                item = False
+            if item:
+                batch.append(item)
+            if batch and (item is None or len(batch) >= BATCH_SIZE or time.monotonic() >= deadline):
+                self._export(batch)
+                batch = []
+            if item is None:
+                return
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + FLUSH_INTERVAL
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        """Export what is queued and stop the thread (called by the lifespan)"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+
+def build_exporter():
+    if TRACE_EXPORTER == "file":
+        return FileExporter()
+    if TRACE_EXPORTER == "otlp":
+        return OTLPExporter()
+    if TRACE_EXPORTER in ("standin", "none"):
+        return StandInCollector()
+    raise RuntimeError(f"Unknown TRACE_EXPORTER {TRACE_EXPORTER!r} (none, file, otlp, standin)")
+
+
+processor = BatchProcessor(build_exporter())
+atexit.register(processor.shutdown)  # CLIs (jobs.py run, recurring.py run) export before exiting
+
+
+# Requests
+
+class TracingMiddleware:
+    """Plain ASGI middleware: one server span per request, continuing the caller's traceparent"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ENABLED or scope["path"] in UNTRACED_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        parent = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                parent = extract(value.decode("latin-1"))
+        method = scope["method"]
+        request_span = Span(method, SERVER, {"http.request.method": method, "url.path": scope["path"]}, parent)
+
+        async def send_traced(message):
+            if message["type"] == "http.response.start":
+                request_span.set_attribute("http.response.status_code", message["status"])
+                if message["status"] >= 500:
+                    request_span.record_error(f"HTTP {message['status']}")
+            await send(message)
+
+        with request_span:
+            try:
+                await self.app(scope, receive, send_traced)
+            finally:
+                route = scope.get("route")
+                if getattr(route, "path", None):
+                    request_span.name = f"{method} {route.path}"
+                    request_span.set_attribute("http.route", route.path)
+
+
+# SQL: a client span per statement, inside traces only
+
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+"?(\w+)', re.IGNORECASE)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    if not ENABLED or _current.get() is None:
+        return
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "SQL"
+    table = _TABLE.search(statement)
+    statement_span = Span(f"{operation} {table.group(1)}" if table else operation, CLIENT, {
+        "db.system": conn.dialect.name,
+        "db.operation.name": operation,
+        "db.query.text": statement[:MAX_STATEMENT],
+    })
+    if executemany:
+        statement_span.set_attribute("db.operation.batch.size", len(parameters))
+    if context is not None:
+        context._trace_span = statement_span
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    statement_span = getattr(context, "_trace_span", None)
+    if statement_span is not None:
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            statement_span.set_attribute("db.response.rows", cursor.rowcount)
+        statement_span.finish()
+
+
+@event.listens_for(Engine, "handle_error")
+def _fail_statement(exception_context):
+    statement_span = getattr(exception_context.execution_context, "_trace_span", None)
+    if statement_span is not None:
+        statement_span.record_error(exception_context.original_exception)
+        statement_span.finish()
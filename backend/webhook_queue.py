@@ -0,0 +1,260 @@
+"""
+Durable webhook ingestion queue.
+
+The webhook endpoint only records each event in `webhook_events` (deduplicated by
+event id) and acknowledges it. A background worker started by the app lifespan
+drains pending events in batches and applies them with one
+INSERT ... ON CONFLICT DO UPDATE per batch, so replays and sign-up bursts neither
+duplicate work nor trip the unique email constraint.
+
+Usage:
+    python webhook_queue.py status
+    python webhook_queue.py drain [--batch-size 500]
+    python webhook_queue.py replay [--status failed] [--since 2026-01-01] [--event-id ID ...] [--no-drain]
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+import env
+import models
+from database import insert_for
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+DRAIN_INTERVAL = float(os.getenv("WEBHOOK_DRAIN_INTERVAL", "2"))
+# Run the drain loop inside the API process; disable when a separate worker runs `drain`
+WEBHOOK_WORKER = os.getenv("WEBHOOK_WORKER", "true").lower() in ("1", "true", "yes")
+
+# Delivery id headers, most specific first; events without one are keyed by a hash of the body
+EVENT_ID_HEADERS = ("webhook-id", "x-webhook-id", "x-supabase-event-id")
+
+
+def event_id_for(headers, body: bytes) -> str:
+    for header in EVENT_ID_HEADERS:
+        if headers.get(header):
+            return headers[header]
+    return "sha256:" + hashlib.sha256(body).hexdigest()
+
+
+def enqueue(db: Session, event_id: str, payload: dict, source: str = "supabase_auth") -> bool:
+    """Store an event; returns False when the same event id was already received"""
+    stmt = insert_for(db, models.WebhookEvent).values(
+        event_id=event_id, source=source, payload=payload, status="pending",
+        attempts=0, received_at=datetime.utcnow()
+    ).on_conflict_do_nothing(index_elements=["event_id"])
+    inserted = db.execute(stmt).rowcount
+    db.commit()
+    return inserted > 0
+
+
+def user_from_payload(payload: dict) -> Optional[dict]:
+    """users row from a Supabase auth webhook: database webhook (type/record) or a bare user object"""
+    if payload.get("type") == "INSERT" and payload.get("record"):
+        record = payload["record"]
+    elif "id" in payload and "email" in payload:
+        record = payload
+    else:
+        return None
+    if not record.get("id") or not record.get("email"):
+        return None
+    meta = record.get("raw_user_meta_data") or {}
+    return {
+        "id": record["id"],
+        "email": record["email"],
+        "full_name": meta.get("full_name") or meta.get("name"),
+        "avatar_url": meta.get("avatar_url"),
+    }
+
+
+def upsert_users(db: Session, rows: List[dict]) -> None:
+    """
+    Insert users or refresh their email. Profile fields only fill gaps, so a replayed
+    sign-up event never overwrites a name or avatar the user changed since.
+    """
+    now = datetime.utcnow()
+    stmt = insert_for(db, models.User).values([{**row, "created_at": now} for row in rows])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["id"],
+        set_={
+            "email": stmt.excluded.email,
+            "full_name": func.coalesce(models.User.full_name, stmt.excluded.full_name),
+            "avatar_url": func.coalesce(models.User.avatar_url, stmt.excluded.avatar_url),
+        }
+    )
+    db.execute(stmt)
+
+
+def _apply(db: Session, users: Dict[str, dict], events_by_user: Dict[str, List[models.WebhookEvent]]) -> None:
+    try:
+        with db.begin_nested():
+            upsert_users(db, list(users.values()))
+        return
+    except IntegrityError:
+        pass
+    # Some row conflicts on email with a different user id: apply one by one and fail only those events
+    for user_id, row in users.items():
+        try:
+            with db.begin_nested():
+                upsert_users(db, [row])
+        except IntegrityError as e:
+            for event in events_by_user[user_id]:
+                event.status = "failed"
+                event.last_error = str(e.orig)[:500]
+
+
+def drain_batch(db: Session, batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """Process up to `batch_size` pending events in one transaction; returns counts per outcome"""
+    events = db.query(models.WebhookEvent).filter(
+        models.WebhookEvent.status == "pending"
+    ).order_by(models.WebhookEvent.id).limit(batch_size).with_for_update(skip_locked=True).all()
+
+    now = datetime.utcnow()
+    users: Dict[str, dict] = {}
+    emails: Dict[str, str] = {}
+    events_by_user: Dict[str, List[models.WebhookEvent]] = {}
+    for event in events:
+        event.attempts = (event.attempts or 0) + 1
+        event.processed_at = now
+        row = user_from_payload(event.payload)
+        if row is None:
+            event.status = "ignored"
+            event.last_error = "unknown_event or missing id/email"
+            continue
+        event.status = "processed"
+        event.last_error = None
+        # Later events win within a batch, both per user id and per email; `emails`
+        # only maps the email of each user's latest row
+        previous = emails.get(row["email"])
+        if previous and previous != row["id"]:
+            users.pop(previous)
+            for superseded in events_by_user.pop(previous):
+                superseded.status = "ignored"
+                superseded.last_error = f"superseded by a later event for {row['email']}"
+        earlier = users.get(row["id"])
+        if earlier and earlier["email"] != row["email"]:
+            del emails[earlier["email"]]
+        users[row["id"]] = row
+        emails[row["email"]] = row["id"]
+        events_by_user.setdefault(row["id"], []).append(event)
+
+    if users:
+        _apply(db, users, events_by_user)
+    db.commit()
+
+    counts: Dict[str, int] = {}
+    for event in events:
+        counts[event.status] = counts.get(event.status, 0) + 1
+    return counts
+
+
+def drain(db: Session, batch_size: int = BATCH_SIZE, max_batches: Optional[int] = None) -> Dict[str, int]:
+    """Drain until the queue is empty (or `max_batches` batches ran)"""
+    totals: Dict[str, int] = {}
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        counts = drain_batch(db, batch_size)
+        if not counts:
+            break
+        for status, n in counts.items():
+            totals[status] = totals.get(status, 0) + n
+        batches += 1
+    return totals
+
+
+def replay(db: Session, statuses: Iterable[str] = ("failed",), since: Optional[datetime] = None,
+           event_ids: Optional[List[str]] = None) -> int:
+    """Put already handled events back in the queue; returns how many were reset"""
+    query = db.query(models.WebhookEvent)
+    if event_ids:
+        query = query.filter(models.WebhookEvent.event_id.in_(event_ids))
+    else:
+        query = query.filter(models.WebhookEvent.status.in_(list(statuses)))
+    if since:
+        query = query.filter(models.WebhookEvent.received_at >= since)
+    count = query.update({"status": "pending", "last_error": None}, synchronize_session=False)
+    db.commit()
+    return count
+
+
+def queue_status(db: Session) -> Dict[str, int]:
+    rows = db.query(models.WebhookEvent.status, func.count(models.WebhookEvent.id)).group_by(models.WebhookEvent.status).all()
+    return dict(rows)
+
+
+_wakeup: Optional[asyncio.Event] = None
+
+
+def notify() -> None:
+    """Wake the worker right away instead of waiting for the next poll (call from the event loop)"""
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+def _drain_once() -> Dict[str, int]:
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        return drain(db)
+    finally:
+        db.close()
+
+
+async def run_worker(interval: float = DRAIN_INTERVAL) -> None:
+    """Drain loop run by the app lifespan; polls every `interval` seconds or when notified"""
+    global _wakeup
+    _wakeup = asyncio.Event()
+    while True:
+        _wakeup.clear()
+        try:
+            counts = await run_in_threadpool(_drain_once)
+            if counts:
+                logger.info(f"Drained webhook events: {counts}")
+        except Exception as e:
+            logger.error(f"Webhook drain failed: {e}")
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "drain", "replay"])
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--status", action="append", choices=["processed", "ignored", "failed"],
+                        help="replay events with this status (repeatable, default: failed)")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="replay events received at or after this time")
+    parser.add_argument("--event-id", action="append", help="replay these events only (repeatable)")
+    parser.add_argument("--no-drain", action="store_true", help="replay: only re-queue, let the worker drain")
+    args = parser.parse_args(argv)
+
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        if args.command == "replay":
+            count = replay(db, args.status or ["failed"], args.since, args.event_id)
+            print(f"Re-queued {count} webhook events")
+            if args.no_drain:
+                return 0
+        if args.command in ("drain", "replay"):
+            print(f"Drained: {drain(db, args.batch_size)}")
+        print(f"Queue: {queue_status(db)}")
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())